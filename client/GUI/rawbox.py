@@ -4,20 +4,11 @@ from PyQt4 import QtCore
 from PyQt4 import QtGui
 import json
 import sys
-import os
 
 sys.path.insert(0, '../')
 from client_cmdmanager import *
 
 
-def get_dir_size(start_path = '.'):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            total_size += os.path.getsize(fp)
-    return total_size
-
 def load_config():
     with open('../config.json', 'r') as config_file:
         config = json.load(config_file)
@@ -31,9 +22,9 @@ class Main(QtGui.QDialog, Ui_Dialog):
         self.dir_path = config['dir_path']
         self.max_size = 2000000000 #bytes
         self.ui.lineEdit_5.setText(self.dir_path)
-        self.ui.progressBar.setValue((get_dir_size(self.dir_path) / float(self.max_size)) * 100)
-        self.ui.label_5.setText("of: " + str(self.max_size/1000000000) + " GB")
         self.executer = executer
+        self.load_usage()
+        self.ui.label_5.setText("of: " + str(self.max_size/1000000000) + " GB")
         self.load_status(config['snapshot_file_path'])
 
         self.ui.pushButton_2.clicked.connect(self.add_user) 
@@ -48,6 +39,17 @@ class Main(QtGui.QDialog, Ui_Dialog):
         group = str(self.ui.lineEdit_8.text())
         executer._create_group(group)
 
+    def load_usage(self):
+        """ the bytes stored are counted by the server: the directory is
+        not walked """
+        body = self.executer._get_usage()['body']
+        if body['result'] != 200:
+            return
+        usage = body['details'][0]
+        if usage['quota']:
+            self.max_size = usage['quota']
+        self.ui.progressBar.setValue((usage['bytes'] / float(self.max_size)) * 100)
+
     def load_status(self, snapshot_file_path):
         with open("../"+snapshot_file_path, 'r') as f:
             timestamp = json.load(f)['timestamp']
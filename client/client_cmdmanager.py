@@ -123,6 +123,24 @@ class RawBoxExecuter(object):
         self.comm_sock.send_message(command_type)
         self.print_response(self.comm_sock.read_message())
 
+    def _get_usage(self):
+        """retrieve the bytes stored by the user and its quota """
+        command_type = 'get_usage'
+
+        self.comm_sock.send_message(command_type)
+        response = self.comm_sock.read_message()
+        self.print_response(response)
+        return response
+
+    def _get_scan_progress(self):
+        """retrieve the progress of the scan of the directory """
+        command_type = 'get_scan_progress'
+
+        self.comm_sock.send_message(command_type)
+        response = self.comm_sock.read_message()
+        self.print_response(response)
+        return response
+
     def print_response(self, response):
         ''' print response from the daemon.
             the response is a dictionary as:
@@ -209,6 +227,18 @@ class RawBoxCmd(cmd.Cmd):
         """
         self.executer._get_shares_list()
 
+    def do_usage(self, line=None):
+        """
+        usage (the space used and the quota)
+        """
+        self.executer._get_usage()
+
+    def do_scan(self, line=None):
+        """
+        scan (the files found and hashed by the scan of the directory)
+        """
+        self.executer._get_scan_progress()
+
     def do_q(self, line=None):
         """ exit from RawBox"""
         if take_input('[Exit] are you sure? y/n ') == 'y':
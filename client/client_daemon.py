@@ -1,18 +1,21 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
 
-
-# inotify observer unable to detect 'dragging file to trash' events
-# from https://github.com/gorakhargosh/watchdog/issues/46 use polling solution
-
-# from watchdog.observers import Observer
-from watchdog.observers.polling import PollingObserver as Observer
+try:
+    # notified by the kernel, detecting the files dragged to the trash too
+    # (see https://github.com/gorakhargosh/watchdog/issues/46)
+    from inotify_observer import InotifyObserver as Observer
+except ImportError:
+    # no inotify on this system: the directory is polled
+    from watchdog.observers.polling import PollingObserver as Observer
 from watchdog.events import FileSystemEventHandler
 from requests.auth import HTTPBasicAuth
 import ConfigParser
 import requests
 import argparse
+import tempfile
 import hashlib
+import threading
 import logging
 import shutil
 import time
@@ -20,6 +23,10 @@ import json
 import os
 
 from communication_system import CmdMessageServer
+from hashing import HashingEngine, file_md5
+from coalescing import CoalescingQueue, QUIET_PERIOD
+from coalescing import CREATED, MODIFIED, DELETED, MOVED
+from transfers import TransferPool
 import asyncore
 
 SERVER_URL = "localhost"
@@ -27,6 +34,27 @@ SERVER_PORT = "5000"
 API_PREFIX = "API/v1"
 CONFIG_DIR_PATH = ""
 FILE_CONFIG = "config.ini"
+# refresh the session token when it's going to expire in less than this
+TOKEN_REFRESH_MARGIN = 60
+# a download is written in blocks of this size, and resumed from the last
+# byte received at most this number of times
+DOWNLOAD_CHUNK_SIZE = 2 ** 16
+DOWNLOAD_RESUME_ATTEMPTS = 10
+# files bigger than this are uploaded in chunks, through an upload session
+# saved in UPLOAD_SESSIONS_FILE until it's committed
+CHUNKED_UPLOAD_THRESHOLD = 4 * 2 ** 20
+UPLOAD_SESSIONS_FILE = "upload_sessions.json"
+# seconds a long poll of the server changes waits for a change (the server
+# may answer before), and seconds before polling again after an error
+LONG_POLL_TIMEOUT = 60
+LONG_POLL_RETRY_DELAY = 5
+# md5 of the local files, saved next to the snapshot file with the inode,
+# size and mtime they were computed for: only the files changed since are
+# hashed again at the start
+FILE_INDEX = "file_index.json"
+# seconds between two saves of the file index while the daemon runs (it's
+# saved only if it changed)
+FILE_INDEX_SAVE_INTERVAL = 30
 
 logger = logging.getLogger('RawBox')
 logger.setLevel(logging.DEBUG)
@@ -52,8 +80,20 @@ class ServerCommunicator(object):
             self.auth = HTTPBasicAuth(username, password)
         else:
             self.auth = None
+        self.username = username
+        self.password = password
+        self.token = None
+        self.token_expiry = 0
+        # position in the server change feed, known after the first
+        # full synchronization
+        self.cursor = None
+        # validator of the last full snapshot synchronized
+        self.snapshot_etag = None
         self.server_url = server_url
         self.snapshot_manager = snapshot_manager
+        # the transfers run in more threads: the token and the file of the
+        # upload sessions are changed holding it
+        self.lock = threading.RLock()
         self.msg = {
             "result": "",
             "details": []
@@ -74,13 +114,71 @@ class ServerCommunicator(object):
     def setExecuter(self, executer):
         self.executer = executer
 
+    def login(self):
+        """
+        authenticate with username and password, then switch to a session
+        token if the server gives one (else keep the basic authentication)
+        """
+        with self.lock:
+            self.auth = HTTPBasicAuth(self.username, self.password)
+            self.token = None
+            try:
+                r = requests.post(
+                    "{}/tokens/".format(self.server_url), auth=self.auth)
+            except requests.exceptions.RequestException:
+                logger.warning("cannot get a session token")
+                return False
+            if r.status_code != 201:
+                return False
+            self._set_token(r.json())
+            return True
+
+    def _set_token(self, token_data):
+        self.token = token_data["token"]
+        self.token_expiry = time.time() + token_data["ttl"]
+        self.auth = HTTPBasicAuth(self.username, self.token)
+
+    def _refresh_token(self):
+        """ extend the session token, or login again if it's not valid """
+        with self.lock:
+            try:
+                r = requests.put(
+                    "{}/tokens/".format(self.server_url), auth=self.auth)
+            except requests.exceptions.RequestException:
+                return False
+            if r.status_code == 200:
+                self._set_token(r.json())
+                return True
+            return self.login()
+
     def _try_request(self, callback, success='', error='', retry_delay=2, *args, **kwargs):
-        """ try a request until it's a success """
+        """
+        try a request until it's a success. The token is refreshed before
+        it expires and, if the server refuses it, a new login is made once:
+        then the 401 is returned
+        """
+        with self.lock:
+            # checked again holding the lock: refreshed once for all
+            if self.token and \
+                    self.token_expiry - time.time() < TOKEN_REFRESH_MARGIN:
+                self._refresh_token()
+        relogged = False
         while True:
+            auth = self.auth
             try:
                 request_result = callback(
-                    auth=self.auth,
+                    auth=auth,
                     *args, **kwargs)
+                if request_result.status_code == 401 and self.token and \
+                        not relogged:
+                    # the token is expired or revoked: login and retry
+                    relogged = True
+                    with self.lock:
+                        if self.auth is auth:
+                            # not done meanwhile by another transfer
+                            logger.info("session token refused, login again")
+                            self.login()
+                    continue
                 if request_result.status_code == 401:
                     logger.error("user not logged")
                 else:
@@ -93,12 +191,19 @@ class ServerCommunicator(object):
     def synchronize(self, operation_handler):
         """Synchronize client and server"""
 
+        if self.cursor is not None and self._synchronize_changes():
+            return
+
         server_url = "{}/files/".format(self.server_url)
         request = {"url": server_url}
+        if self.snapshot_etag:
+            request["headers"] = {"If-None-Match": self.snapshot_etag}
         sync = self._try_request(
             requests.get, "getFile success", "getFile fail", **request)
 
-        if sync.status_code != 401:
+        if sync.status_code == 304:
+            logger.debug("server snapshot not modified")
+        elif sync.status_code != 401:
             server_snapshot = sync.json()['snapshot']
 
             server_timestamp = float(sync.json()['timestamp'])
@@ -106,13 +211,82 @@ class ServerCommunicator(object):
             command_list = self.snapshot_manager.syncronize_dispatcher(server_timestamp, server_snapshot)
             self.executer.syncronize_executer(command_list)
             self.snapshot_manager.save_timestamp(server_timestamp)
+            self.cursor = sync.json().get('cursor')
+            self.snapshot_etag = sync.headers.get('ETag')
+
+    def _synchronize_changes(self):
+        """
+        apply only the server changes after the cursor. Return False if the
+        server doesn't have them anymore and the full snapshot is needed
+        """
+        server_url = "{}/changes".format(self.server_url)
+        request = {"url": server_url, "params": {"since": self.cursor}}
+        r = self._try_request(
+            requests.get, "getChanges success", "getChanges fail", **request)
+
+        if r.status_code == 410:
+            logger.info("server changes not available, full synchronization")
+            self.cursor = None
+            return False
+        if r.status_code == 200:
+            changes = r.json()
+            if changes['changes']:
+                command_list = self.snapshot_manager.changes_dispatcher(
+                    changes['changes'])
+                self.executer.syncronize_executer(command_list)
+                self.snapshot_manager.save_timestamp(
+                    float(changes['timestamp']))
+            self.cursor = changes['cursor']
+        return True
+
+    def wait_for_changes(self):
+        """
+        Long poll the server changes after the cursor. Return True when the
+        client has to synchronize, False if nothing changed before the
+        timeout
+        """
+        server_url = "{}/changes".format(self.server_url)
+        r = self._try_request(
+            requests.get, "", "waitChanges fail", url=server_url,
+            params={"since": self.cursor, "wait": LONG_POLL_TIMEOUT},
+            # the server answers at the timeout: a connection silent for
+            # longer is lost
+            timeout=2 * LONG_POLL_TIMEOUT)
+        if r.status_code == 200:
+            return bool(r.json()['changes'])
+        if r.status_code != 410:
+            # wait before polling again
+            time.sleep(LONG_POLL_RETRY_DELAY)
+        return True
+
+    def watch(self, server_changed):
+        """
+        Set the event server_changed when the files change on the server,
+        instead of synchronizing at fixed intervals. The event is cleared
+        by the synchronization: it's not set again until then.
+        """
+        while True:
+            if server_changed.is_set():
+                # synchronizing
+                time.sleep(1)
+            elif self.cursor is None:
+                # the last full synchronization failed: retry
+                time.sleep(LONG_POLL_RETRY_DELAY)
+                server_changed.set()
+            elif self.wait_for_changes():
+                server_changed.set()
 
     def get_url_relpath(self, abs_path):
         """ form get_abspath return the relative path for url """
         return get_relpath(abs_path).replace(os.path.sep, '/')
 
     def download_file(self, dst_path):
-        """ download a file from server"""
+        """
+        download a file from server into a temporary file, out of the
+        synchronized directory. If the transfer is interrupted, it's
+        resumed from the last byte received.
+        Return the local path and the temporary file
+        """
         error_log = "ERROR on download request " + dst_path
         success_log = "file downloaded! " + dst_path
 
@@ -120,24 +294,59 @@ class ServerCommunicator(object):
             self.server_url,
             self.get_url_relpath(dst_path))
 
-        request = {"url": server_url}
-
-        r = self._try_request(requests.get, success_log, error_log, **request)
         local_path = get_abspath(dst_path)
-
-        if r.status_code == 200:
-            return local_path, r.text
-        else:
-            return False, False
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix=".rawbox_download_")
+        received = 0
+        etag = None
+        with os.fdopen(tmp_fd, 'wb') as tmp_file:
+            for attempt in range(DOWNLOAD_RESUME_ATTEMPTS):
+                headers = {}
+                if received:
+                    # only the rest, if the file is still the same
+                    headers['Range'] = "bytes={}-".format(received)
+                    if etag:
+                        headers['If-Range'] = etag
+                request = {"url": server_url, "headers": headers, "stream": True}
+                r = self._try_request(requests.get, success_log, error_log, **request)
+
+                if r.status_code == 200:
+                    # the whole file (again, if it's changed meanwhile)
+                    tmp_file.seek(0)
+                    tmp_file.truncate()
+                    received = 0
+                elif r.status_code != 206:
+                    break
+                etag = r.headers.get('ETag')
+                expected = r.headers.get('Content-Length')
+                if expected is not None:
+                    expected = received + int(expected)
+                try:
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        tmp_file.write(chunk)
+                        received += len(chunk)
+                except requests.exceptions.RequestException:
+                    pass
+                if expected is None or received == expected:
+                    return local_path, tmp_path
+                logger.warning("download of {} interrupted at byte {}".format(
+                    dst_path, received))
+        os.remove(tmp_path)
+        return False, False
 
     def upload_file(self, dst_path, put_file=False):
         """ upload a file to server """
 
+        try:
+            if os.path.getsize(get_abspath(dst_path)) > CHUNKED_UPLOAD_THRESHOLD:
+                return self.upload_in_chunks(dst_path, put_file)
+        except OSError:
+            return False  # Atomic create and delete error!
+
         file_object = ''
         try:
             file_object = open(get_abspath(dst_path), 'rb')
-            file_content = open(get_abspath(dst_path), 'rb').read()
-        except IOError:
+            file_md5 = self.snapshot_manager.file_snapMd5(dst_path)
+        except EnvironmentError:
             return False  # Atomic create and delete error!
 
         server_url = "{}/files/{}".format(
@@ -149,7 +358,7 @@ class ServerCommunicator(object):
         request = {
             "url": server_url,
             "files": {'file_content': file_object},
-            "data": {'file_md5': hashlib.md5(file_content).hexdigest()}
+            "data": {'file_md5': file_md5}
         }
 
         if put_file:
@@ -161,11 +370,123 @@ class ServerCommunicator(object):
         if r.status_code == 409:
             logger.error("file {} already exists on server".format(dst_path))
         elif r.status_code == 201:
-            if put_file:
-                self.snapshot_manager.update_snapshot_update({"src_path": dst_path})
+            self._uploaded(dst_path, put_file, r.text)
+
+    def _uploaded(self, dst_path, put_file, timestamp):
+        if put_file:
+            self.snapshot_manager.update_snapshot_update({"src_path": dst_path})
+        else:
+            self.snapshot_manager.update_snapshot_upload({"src_path": dst_path})
+        self.snapshot_manager.save_snapshot(timestamp)
+
+    def _load_upload_sessions(self):
+        """ upload sessions not committed yet: { path: {"id", "md5", "put_file"} } """
+        with self.lock:
+            try:
+                with open(UPLOAD_SESSIONS_FILE) as f:
+                    return json.load(f)
+            except (IOError, ValueError):
+                return {}
+
+    def _save_upload_session(self, path, session=None):
+        """ save (or remove, without session) the upload session of path """
+        with self.lock:
+            sessions = self._load_upload_sessions()
+            if session:
+                sessions[path] = session
             else:
-                self.snapshot_manager.update_snapshot_upload({"src_path": dst_path})
-            self.snapshot_manager.save_snapshot(r.text)
+                sessions.pop(path, None)
+            with open(UPLOAD_SESSIONS_FILE, 'w') as f:
+                json.dump(sessions, f)
+
+    def _get_upload_session(self, rel_path, md5):
+        """ return the saved upload session of the file, if the server still has it """
+        session = self._load_upload_sessions().get(rel_path)
+        if not session or session['md5'] != md5:
+            return None
+        r = self._try_request(
+            requests.get, "upload session found", "ERROR upload session request",
+            url="{}/uploads/{}".format(self.server_url, session['id']))
+        if r.status_code != 200:
+            return None
+        return r.json()
+
+    def upload_in_chunks(self, dst_path, put_file=False):
+        """
+        upload a file in chunks. The upload session is saved, so after a
+        network error or a restart only the chunks missing are sent again
+        """
+        abs_path = get_abspath(dst_path)
+        rel_path = self.get_url_relpath(dst_path)
+        try:
+            md5 = self.snapshot_manager.file_snapMd5(abs_path)
+        except EnvironmentError:
+            return False  # Atomic create and delete error!
+
+        session = self._get_upload_session(rel_path, md5)
+        if session is None:
+            r = self._try_request(
+                requests.post, "upload session created", "ERROR upload session request",
+                url="{}/uploads/".format(self.server_url),
+                data={
+                    'path': rel_path,
+                    'size': os.path.getsize(abs_path),
+                    'file_md5': md5,
+                })
+            if r.status_code != 201:
+                logger.error("cannot upload {} in chunks".format(dst_path))
+                return False
+            session = r.json()
+            session['received'] = []
+            self._save_upload_session(
+                rel_path, {'id': session['id'], 'md5': md5, 'put_file': put_file})
+        session_url = "{}/uploads/{}".format(self.server_url, session['id'])
+
+        with open(abs_path, 'rb') as f:
+            for index in range(session['chunks']):
+                if index in session['received']:
+                    continue
+                f.seek(index * session['chunk_size'])
+                chunk = f.read(session['chunk_size'])
+                r = self._try_request(
+                    requests.put,
+                    "chunk {} of {} uploaded".format(index, dst_path),
+                    "ERROR upload of chunk {} of {}".format(index, dst_path),
+                    url="{}/{}".format(session_url, index),
+                    files={'file_content': chunk},
+                    data={'chunk_md5': hashlib.md5(chunk).hexdigest()})
+                if r.status_code == 400:
+                    # the file has changed meanwhile: it will be sent again
+                    logger.error("chunk {} of {} refused".format(index, dst_path))
+                    self._save_upload_session(rel_path)
+                    return False
+                if r.status_code != 201:
+                    # the session is resumed next time
+                    logger.error("upload of {} interrupted".format(dst_path))
+                    return False
+
+        r = self._try_request(
+            requests.post, "file uploaded! " + dst_path, "ERROR upload request " + dst_path,
+            url=session_url)
+        if r.status_code == 409:
+            # some chunk is missing: the session is resumed next time
+            logger.error("upload of {} not complete".format(dst_path))
+            return False
+        self._save_upload_session(rel_path)
+        if r.status_code == 201:
+            self._uploaded(dst_path, put_file, r.text)
+            return True
+        logger.error("upload of {} refused".format(dst_path))
+        return False
+
+    def resume_uploads(self):
+        """ complete the uploads interrupted by a restart """
+        for path, session in self._load_upload_sessions().items():
+            abs_path = get_abspath(path)
+            if os.path.isfile(abs_path):
+                self.upload_in_chunks(abs_path, session['put_file'])
+            else:
+                self._save_upload_session(path)
 
     def delete_file(self, dst_path):
         """ send to server a message of file delete """
@@ -388,6 +709,25 @@ class ServerCommunicator(object):
 
         return self.msg
 
+    def get_usage(self, param=None):
+        """ The bytes stored by the user, counted by the server (no local
+        file is read): details are [{"bytes", "files", "quota"}] """
+        self.msg["details"] = []
+        error_log = "Usage error"
+        success_log = "Usage downloaded!"
+        server_url = "{}/usage/".format(self.server_url)
+        request = {"url": server_url}
+        response = self._try_request(requests.get, success_log, error_log, **request)
+
+        self.msg["result"] = response.status_code
+        if response.status_code == 200:
+            self.msg["details"].append(response.json())
+        elif response.status_code == 401:
+            self.msg["details"].append("Unauthorized access")
+        else:
+            self.msg["details"].append("Bad request")
+        return self.msg
+
 class FileSystemOperator(object):
 
     def __init__(self, event_handler, server_com, snapshot_manager):
@@ -408,15 +748,14 @@ class FileSystemOperator(object):
             create file
             when watchdog see the first event on this path ignore it
         """
-        abs_path, content = self.server_com.download_file(path)
-        if abs_path and content:
+        abs_path, downloaded = self.server_com.download_file(path)
+        if abs_path and downloaded:
             self.add_event_to_ignore(get_abspath(path))
             try:
                 os.makedirs(os.path.split(abs_path)[0], 0755)
             except OSError:
                 pass
-            with open(abs_path, 'wb') as f:
-                f.write(content)
+            shutil.move(downloaded, abs_path)
             self.snapshot_manager.update_snapshot_upload({"src_path": get_abspath(abs_path)})
         else:
             logger.error("DOWNLOAD REQUEST for file {} , not found on server".format(path))
@@ -430,14 +769,16 @@ class FileSystemOperator(object):
             move the file from origin_path to dst_path
             when watchdog see the first event on this path ignore it
         """
-        self.add_event_to_ignore(get_abspath(origin_path))
-        self.add_event_to_ignore(get_abspath(dst_path))
+        origin_path = get_abspath(origin_path)
+        dst_path = get_abspath(dst_path)
+        self.add_event_to_ignore(origin_path)
+        self.add_event_to_ignore(dst_path)
         try:
             os.makedirs(os.path.split(dst_path)[0], 0755)
         except OSError:
             pass
         shutil.move(origin_path, dst_path)
-        self.snapshot_manager.update_snapshot_move({"src_path": get_abspath(origin_path), "dst_path": get_abspath(dst_path)})
+        self.snapshot_manager.update_snapshot_move({"src_path": origin_path, "dst_path": dst_path})
 
     def copy_a_file(self, origin_path, dst_path):
         """
@@ -555,11 +896,30 @@ def load_config():
 
 
 class DirectoryEventHandler(FileSystemEventHandler):
+    """
+    The changes of the files are coalesced by path (see coalescing), and sent
+    to the server by dispatch when the files are quiet
+    """
 
-    def __init__(self, cmd, snap):
+    def __init__(self, cmd, snap, quiet_period=QUIET_PERIOD, transfers=None):
         self.cmd = cmd
         self.snap = snap
         self.paths_ignored = []
+        self.changes = CoalescingQueue(quiet_period, self._is_synced)
+        # the pool sending the changes (None: sent one at a time)
+        self.transfers = transfers
+
+    def _send(self, kind, function, *paths):
+        if self.transfers is None:
+            function(*paths)
+        else:
+            keys = [get_abspath(path) for path in paths]
+            self.transfers.submit(kind, keys, function, *paths)
+
+    def _is_synced(self, abs_path):
+        """ check if the server has a file at abs_path """
+        return self.snap.find_file_md5(
+            self.snap.local_full_snapshot, get_relpath(abs_path), False) is not None
 
     def _is_copy(self, abs_path):
         """
@@ -570,9 +930,7 @@ class DirectoryEventHandler(FileSystemEventHandler):
         file_md5 = self.snap.file_snapMd5(abs_path)
         if not file_md5:
             return False
-        if file_md5 in self.snap.local_full_snapshot:
-            return self.snap.local_full_snapshot[file_md5][0]
-        return False
+        return self.snap.local_path_of(file_md5) or False
 
     def on_moved(self, event):
         """Called when a file or a directory is moved or renamed.
@@ -584,7 +942,7 @@ class DirectoryEventHandler(FileSystemEventHandler):
         """
         if event.src_path not in self.paths_ignored:
             if not event.is_directory:
-                self.cmd.move_file(event.src_path, event.dest_path)
+                self.changes.moved(event.src_path, event.dest_path)
         else:
             logger.debug("".format("ignored move on ", event.src_path))
             self.paths_ignored.remove(event.src_path)
@@ -598,19 +956,11 @@ class DirectoryEventHandler(FileSystemEventHandler):
         :type event:
             :class:`DirCreatedEvent` or :class:`FileCreatedEvent`
         """
-        copy = False
         if event.src_path not in self.paths_ignored:
             if not event.is_directory:
-                copy = self._is_copy(event.src_path)
-                if copy:
-                    self.cmd.copy_file(copy, event.src_path)
-                else:
-                    self.cmd.upload_file(event.src_path)
+                self.changes.created(event.src_path)
         else:
-            if copy:
-                logger.debug("".format("ignored copy on ", event.src_path))
-            else:
-                logger.debug("".format("ignored creation on ", event.src_path))
+            logger.debug("".format("ignored creation on ", event.src_path))
             self.paths_ignored.remove(event.src_path)
 
     def on_deleted(self, event):
@@ -623,7 +973,7 @@ class DirectoryEventHandler(FileSystemEventHandler):
         """
         if event.src_path not in self.paths_ignored:
             if not event.is_directory:
-                self.cmd.delete_file(event.src_path)
+                self.changes.deleted(event.src_path)
         else:
             logger.debug("".format("ignored deletion on ", event.src_path))
             self.paths_ignored.remove(event.src_path)
@@ -639,16 +989,89 @@ class DirectoryEventHandler(FileSystemEventHandler):
 
         if event.src_path not in self.paths_ignored:
             if not event.is_directory:
-                self.cmd.upload_file(event.src_path, put_file=True)
+                self.changes.modified(event.src_path)
         else:
             logger.debug("".format("ignored modified on ", event.src_path))
             self.paths_ignored.remove(event.src_path)
 
+    def dispatch(self, flush=False):
+        """ send to the server the changes ready (all the pending ones if flush) """
+        ready = self.changes.ready(flush)
+        by_action = dict((action, []) for action in (CREATED, MODIFIED, DELETED, MOVED))
+        for path, change in sorted(ready):
+            by_action[change['action']].append((path, change))
+
+        # deleted and created again with the same content: moved
+        moved_from = {}
+        for path, change in by_action[DELETED]:
+            md5 = self.snap.find_file_md5(
+                self.snap.local_full_snapshot, get_relpath(path), False)
+            if md5:
+                moved_from.setdefault(md5, []).append(path)
+        paired = set()
+
+        for path, change in by_action[MOVED]:
+            self._send('move', self.cmd.move_file, change['src'], path)
+        for path, change in by_action[CREATED]:
+            try:
+                md5 = self.snap.file_snapMd5(path)
+            except EnvironmentError:
+                continue  # deleted meanwhile: its deletion follows
+            if moved_from.get(md5):
+                src_path = moved_from[md5].pop(0)
+                paired.add(src_path)
+                self._send('move', self.cmd.move_file, src_path, path)
+                continue
+            copy = self._is_copy(path)
+            if copy:
+                self._send('copy', self.cmd.copy_file, copy, path)
+            else:
+                self._send('upload', self.cmd.upload_file, path)
+        for path, change in by_action[MODIFIED]:
+            self._send('upload', self._upload_modified, path)
+        for path, change in by_action[DELETED]:
+            if path not in paired:
+                self._send('delete', self.cmd.delete_file, path)
+
+    def _upload_modified(self, path):
+        self.cmd.upload_file(path, put_file=True)
+
+    def dispatch_changes(self, stopped):
+        """
+        dispatch the changes as they're ready, until stopped is set. The
+        file index is saved every FILE_INDEX_SAVE_INTERVAL seconds: the
+        files hashed meanwhile aren't hashed again after a crash
+        """
+        last_save = time.time()
+        while not stopped.is_set():
+            self.changes.wait(timeout=1.0)
+            self.dispatch()
+            if time.time() - last_save >= FILE_INDEX_SAVE_INTERVAL:
+                self.snap.save_index()
+                last_save = time.time()
+        self.dispatch(flush=True)
+        if self.transfers is not None:
+            self.transfers.join()
+
 
 class DirSnapshotManager(object):
-    def __init__(self, snapshot_file_path):
-        """ load the last global snapshot and create a instant_snapshot of local directory"""
+    def __init__(self, snapshot_file_path, hashing_engine=None, on_progress=None):
+        """
+        load the last global snapshot and create a instant_snapshot of local directory,
+        calling on_progress(progress) while the files are hashed
+        """
         self.snapshot_file_path = snapshot_file_path
+        self.hashing_engine = hashing_engine or HashingEngine()
+        self.on_progress = on_progress
+        self.index_file_path = os.path.join(
+            os.path.dirname(os.path.abspath(snapshot_file_path)), FILE_INDEX)
+        self.index_lock = threading.Lock()
+        self.file_index = self._load_index()
+        # the index changed since it was saved
+        self.index_changed = False
+        self.index_save_lock = threading.Lock()
+        # the transfers update the snapshot from more threads
+        self.snapshot_lock = threading.RLock()
         self.last_status = self._load_status()
         self.local_full_snapshot = self.instant_snapshot()
 
@@ -671,84 +1094,174 @@ class DirSnapshotManager(object):
         with open(self.snapshot_file_path) as f:
             return json.load(f)
 
+    def _load_index(self):
+        """ the index of the local files: { rel path: [inode, size, mtime, md5] } """
+        try:
+            with open(self.index_file_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_index(self):
+        """
+        save the index of the local files if it changed, replacing the old
+        one at once: it's written to a temporary file and renamed
+        """
+        with self.index_save_lock:
+            with self.index_lock:
+                if not self.index_changed:
+                    return
+                content = json.dumps(self.file_index)
+                self.index_changed = False
+            fd, tmp_path = tempfile.mkstemp(
+                prefix="{}.".format(FILE_INDEX), suffix=".tmp",
+                dir=os.path.dirname(self.index_file_path))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(content)
+                os.rename(tmp_path, self.index_file_path)
+            except EnvironmentError:
+                # saved the next time
+                with self.index_lock:
+                    self.index_changed = True
+                raise
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
     def file_snapMd5(self, file_path):
-        """ calculate the md5 of a file """
+        """
+        calculate the md5 of a file, or take it from the index if the file
+        didn't change since (same inode, size and mtime)
+        """
         file_path = get_abspath(file_path)
-        file_md5 = hashlib.md5()
         if os.path.isdir(file_path):
             return False
-        with open(file_path, 'rb') as afile:
-            buf = afile.read(2048)
-            while len(buf) > 0:
-                file_md5.update(buf)
-                buf = afile.read(2048)
-        return file_md5.hexdigest()
+        rel_path = get_relpath(file_path)
+        # taken before reading: a change while hashing makes it stale
+        stat = os.stat(file_path)
+        key = [stat.st_ino, stat.st_size, stat.st_mtime]
+        with self.index_lock:
+            indexed = self.file_index.get(rel_path)
+        if indexed and indexed[:3] == key:
+            return indexed[3]
+
+        md5 = file_md5(file_path)
+        with self.index_lock:
+            self.file_index[rel_path] = key + [md5]
+            self.index_changed = True
+        return md5
+
+    def _move_index(self, src_path, dst_path):
+        """ a renamed file keeps inode, size and mtime: its md5 is still valid """
+        with self.index_lock:
+            indexed = self.file_index.pop(get_relpath(src_path), None)
+            if indexed:
+                self.file_index[get_relpath(dst_path)] = indexed
+                self.index_changed = True
 
     def global_md5(self):
         """ calculate the global md5 of local_full_snapshot """
-        for k, v in self.local_full_snapshot.items():
-            v.sort()
-        snap_list = sorted(list(self.local_full_snapshot.items()))
+        with self.snapshot_lock:
+            for k, v in self.local_full_snapshot.items():
+                v.sort()
+            snap_list = sorted(list(self.local_full_snapshot.items()))
         return hashlib.md5(str(snap_list)).hexdigest()
 
+    def _walk(self):
+        for root, dirs, files in os.walk(CONFIG_DIR_PATH):
+            for f in files:
+                yield os.path.join(root, f)
+
     def instant_snapshot(self):
-        """ create a snapshot of directory """
+        """
+        create a snapshot of directory, hashing in parallel only the files
+        changed
+        """
 
         dir_snapshot = {}
-        for root, dirs, files in os.walk(CONFIG_DIR_PATH):
-            for f in files:
-                full_path = os.path.join(root, f)
-                file_md5 = self.file_snapMd5(full_path)
-                rel_path = get_relpath(full_path)
-                if file_md5 in dir_snapshot:
-                    dir_snapshot[file_md5].append(rel_path)
-                else:
-                    dir_snapshot[file_md5] = [rel_path]
+        hashed = self.hashing_engine.hash_files(
+            self._walk(), self.file_snapMd5, self.on_progress)
+        for full_path, file_md5 in hashed:
+            if not file_md5:
+                continue  # removed while the directory was scanned
+            rel_path = get_relpath(full_path)
+            if file_md5 in dir_snapshot:
+                dir_snapshot[file_md5].append(rel_path)
+            else:
+                dir_snapshot[file_md5] = [rel_path]
+        # the files removed while the daemon was stopped are forgotten
+        paths = set(path for paths in dir_snapshot.values() for path in paths)
+        with self.index_lock:
+            if set(self.file_index) - paths:
+                self.file_index = dict(
+                    (path, indexed) for path, indexed in self.file_index.items()
+                    if path in paths)
+                self.index_changed = True
+        self.save_index()
         return dir_snapshot
 
+    def _is_newer(self, timestamp):
+        """ the answers of the transfers running at once can arrive in any order """
+        try:
+            return float(timestamp) >= float(self.last_status['timestamp'])
+        except (TypeError, ValueError):
+            return True
+
     def save_snapshot(self, timestamp):
-        """ save snapshot to file """
-        self.last_status['timestamp'] = timestamp
-        self.last_status['snapshot'] = self.global_md5()
+        """ save snapshot to file, with the timestamp if it's the newest """
+        with self.snapshot_lock:
+            if self._is_newer(timestamp):
+                self.last_status['timestamp'] = timestamp
+            self.last_status['snapshot'] = self.global_md5()
 
-        with open(self.snapshot_file_path, 'w') as f:
-            f.write(
-                json.dumps({"timestamp": timestamp, "snapshot": self.last_status['snapshot']}))
+            with open(self.snapshot_file_path, 'w') as f:
+                f.write(
+                    json.dumps({"timestamp": self.last_status['timestamp'], "snapshot": self.last_status['snapshot']}))
 
     def update_snapshot_upload(self, body):
         """ update of local full snapshot by upload request"""
-        self.local_full_snapshot[self.file_snapMd5(body['src_path'])] = [get_relpath(body["src_path"])]
+        file_md5 = self.file_snapMd5(body['src_path'])
+        with self.snapshot_lock:
+            self.local_full_snapshot[file_md5] = [get_relpath(body["src_path"])]
 
     def update_snapshot_update(self, body):
         """ update of local full snapshot by update request"""
-        #delete the old path from full snapshot
-        self.update_snapshot_delete(body)
         new_file_md5 = self.file_snapMd5(body['src_path'])
-        if new_file_md5 in self.local_full_snapshot:
-            #is a copy of another file
-            self.local_full_snapshot[new_file_md5].append(get_relpath(body['src_path']))
-        else:
-            #else create a new md5
-            self.local_full_snapshot[new_file_md5] = [get_relpath(body['src_path'])]
+        with self.snapshot_lock:
+            #delete the old path from full snapshot
+            self.update_snapshot_delete(body)
+            if new_file_md5 in self.local_full_snapshot:
+                #is a copy of another file
+                self.local_full_snapshot[new_file_md5].append(get_relpath(body['src_path']))
+            else:
+                #else create a new md5
+                self.local_full_snapshot[new_file_md5] = [get_relpath(body['src_path'])]
 
     def update_snapshot_copy(self, body):
         """ update of local full snapshot by copy request"""
-        self.local_full_snapshot[self.file_snapMd5(body['src_path'])].append(get_relpath(body["dst_path"]))
+        file_md5 = self.file_snapMd5(body['src_path'])
+        with self.snapshot_lock:
+            self.local_full_snapshot[file_md5].append(get_relpath(body["dst_path"]))
 
     def update_snapshot_move(self, body):
         """ update of local full snapshot by move request"""
-        paths_of_file = self.local_full_snapshot[self.file_snapMd5(get_abspath(body["dst_path"]))]
-        paths_of_file.remove(get_relpath(body["src_path"]))
-        paths_of_file.append(get_relpath(body["dst_path"]))
+        self._move_index(get_abspath(body["src_path"]), get_abspath(body["dst_path"]))
+        file_md5 = self.file_snapMd5(get_abspath(body["dst_path"]))
+        with self.snapshot_lock:
+            paths_of_file = self.local_full_snapshot[file_md5]
+            paths_of_file.remove(get_relpath(body["src_path"]))
+            paths_of_file.append(get_relpath(body["dst_path"]))
 
     def update_snapshot_delete(self, body):
         """ update of local full snapshot by delete request"""
-        md5_file = self.find_file_md5(self.local_full_snapshot, get_relpath(body['src_path']), False)
-        logger.debug("find md5: " + md5_file)
-        if len(self.local_full_snapshot[md5_file]) == 1:
-            del self.local_full_snapshot[md5_file]
-        else:
-            self.local_full_snapshot[md5_file].remove(get_relpath(body['src_path']))
+        with self.snapshot_lock:
+            md5_file = self.find_file_md5(self.local_full_snapshot, get_relpath(body['src_path']), False)
+            logger.debug("find md5: " + md5_file)
+            if len(self.local_full_snapshot[md5_file]) == 1:
+                del self.local_full_snapshot[md5_file]
+            else:
+                self.local_full_snapshot[md5_file].remove(get_relpath(body['src_path']))
         logger.debug("path deleted: " + get_relpath(body['src_path']))
 
     def save_timestamp(self, timestamp):
@@ -756,10 +1269,13 @@ class DirSnapshotManager(object):
             save timestamp to file only if getfile
             timestamp is < than the last timestamp saved
         """
-        if self.last_status['timestamp'] < timestamp:
-            self.last_status['timestamp'] = timestamp
-            with open(self.snapshot_file_path, 'w') as f:
-                f.write(json.dumps(self.last_status, f))
+        with self.snapshot_lock:
+            if self.last_status['timestamp'] < timestamp:
+                self.last_status['timestamp'] = timestamp
+                with open(self.snapshot_file_path, 'w') as f:
+                    f.write(json.dumps(self.last_status, f))
+        # a batch of server changes is applied: the files hashed are kept
+        self.save_index()
 
     def diff_snapshot_paths(self, snap_client, snap_server):
         """
@@ -779,14 +1295,29 @@ class DirSnapshotManager(object):
 
     def find_file_md5(self, snapshot, new_path, is_server=True):
         """ from snapshot and a path find the md5 of file inside snapshot"""
-        for md5, paths in snapshot.items():
-            for path in paths:
-                if is_server:
-                    if path['path'] == new_path:
-                        return md5
-                else:
-                    if path == new_path:
-                        return md5
+        # the transfers change local_full_snapshot meanwhile
+        with self.snapshot_lock:
+            for md5, paths in snapshot.items():
+                for path in paths:
+                    if is_server:
+                        if path['path'] == new_path:
+                            return md5
+                    else:
+                        if path == new_path:
+                            return md5
+
+    def local_path_of(self, md5):
+        """ the first local path of a file with the md5, None if there's none """
+        with self.snapshot_lock:
+            paths = self.local_full_snapshot.get(md5)
+            return paths[0] if paths else None
+
+    def _local_snapshot(self):
+        """ a copy of local_full_snapshot: the transfers change it meanwhile """
+        with self.snapshot_lock:
+            return dict(
+                (md5, list(paths))
+                for md5, paths in self.local_full_snapshot.items())
 
     def check_files_timestamp(self, snapshot, new_path):
         paths_timestamps = [val for subl in snapshot.values() for val in subl]
@@ -796,24 +1327,25 @@ class DirSnapshotManager(object):
 
     def syncronize_dispatcher(self, server_timestamp, server_snapshot):
         """ return the list of command to do """
+        local_snapshot = self._local_snapshot()
         new_client_paths, new_server_paths, equal_paths = self.diff_snapshot_paths(
-            self.local_full_snapshot, server_snapshot)
+            local_snapshot, server_snapshot)
         command_list = []
         #NO internal conflict
         if self.local_check():  # 1)
             if not self.is_syncro(server_timestamp):  # 1) b.
                 for new_server_path in new_server_paths:  # 1) b 1
                     server_md5 = self.find_file_md5(server_snapshot, new_server_path)
-                    if not server_md5 in self.local_full_snapshot:  # 1) b 1 I
+                    if not server_md5 in local_snapshot:  # 1) b 1 I
                         logger.debug("download:\t" + new_server_path)
                         command_list.append({'local_download': [new_server_path]})
                     else:  # 1) b 1 II
                         logger.debug("copy or rename:\t" + new_server_path)
-                        src_local_path = self.local_full_snapshot[server_md5][0]
+                        src_local_path = local_snapshot[server_md5][0]
                         command_list.append({'local_copy': [src_local_path, new_server_path]})
 
                 for equal_path in equal_paths:  # 1) b 2
-                    client_md5 = self.find_file_md5(self.local_full_snapshot, equal_path, False)
+                    client_md5 = self.find_file_md5(local_snapshot, equal_path, False)
                     if client_md5 != self.find_file_md5(server_snapshot, equal_path):
                         #in this case i have a simple download because the update is a overwritten
                         logger.debug("update download:\t" + equal_path)
@@ -835,7 +1367,7 @@ class DirSnapshotManager(object):
                     logger.debug("remove:\t" + new_server_path)
                     command_list.append({'remote_delete': [new_server_path]})
                 for equal_path in equal_paths:  # 2) a 2
-                    if self.find_file_md5(self.local_full_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
+                    if self.find_file_md5(local_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
                         logger.debug("update:\t" + equal_path)
                         command_list.append({'remote_update': [equal_path, True]})
                     else:
@@ -851,16 +1383,16 @@ class DirSnapshotManager(object):
                         logger.debug("delete remote:\t" + new_server_path)
                         command_list.append({'remote_delete': [new_server_path]})
                     else:
-                        if not server_md5 in self.local_full_snapshot:  # 2) b 1 I
+                        if not server_md5 in local_snapshot:  # 2) b 1 I
                                 logger.debug("download local:\t" + new_server_path)
                                 command_list.append({'local_download': [new_server_path]})
                         else:  # 2) b 1 II
                             logger.debug("copy or rename:\t" + new_server_path)
-                            src_local_path = self.local_full_snapshot[server_md5][0]
+                            src_local_path = local_snapshot[server_md5][0]
                             command_list.append({'local_copy': [src_local_path, new_server_path]})
 
                 for equal_path in equal_paths:  # 2) b 2
-                    if self.find_file_md5(self.local_full_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
+                    if self.find_file_md5(local_snapshot, equal_path, False) != self.find_file_md5(server_snapshot, equal_path):
                         if self.check_files_timestamp(server_snapshot, equal_path):  # 2) b 2 I
                             logger.debug("server push:\t" + equal_path)
                             command_list.append({'remote_upload': [equal_path]})
@@ -880,14 +1412,73 @@ class DirSnapshotManager(object):
 
         return command_list
 
+    def changes_dispatcher(self, changes):
+        """
+        return the list of command to apply the changes of the server
+        change feed (the changes made by this client are already here)
+        """
+        command_list = []
+        local_snapshot = self._local_snapshot()
+        local_files = set(
+            path for paths in local_snapshot.values()
+            for path in paths)
+        # paths moved or deleted by the commands before
+        gone = set()
+
+        def local_paths(md5):
+            return [
+                path for path in local_snapshot.get(md5, [])
+                if path not in gone]
+
+        def is_local(path):
+            return path in local_files and path not in gone
+
+        for change in changes:
+            path = change['path']
+            if change['op'] == 'move':
+                src = change['src']
+                if src in local_paths(change['md5']) and not is_local(path):
+                    logger.debug("move:\t" + src + " -> " + path)
+                    command_list.append({'local_move': [src, path]})
+                    gone.add(src)
+                    continue
+                # the file isn't here as expected: delete and add
+                if is_local(src):
+                    logger.debug("remove local:\t" + src)
+                    command_list.append({'local_delete': [src]})
+                    gone.add(src)
+
+            if change['op'] == 'delete':
+                if is_local(path):
+                    logger.debug("remove local:\t" + path)
+                    command_list.append({'local_delete': [path]})
+                    gone.add(path)
+                continue
+
+            same_content = local_paths(change['md5'])
+            if path in same_content:
+                logger.debug("no action:\t" + path)
+            elif same_content:
+                logger.debug("copy:\t" + path)
+                command_list.append({'local_copy': [same_content[0], path]})
+            else:
+                logger.debug("download:\t" + path)
+                command_list.append({'local_download': [path]})
+            gone.discard(path)
+        return command_list
+
 
 class CommandExecuter(object):
 
-    """Execute a list of commands"""
+    """
+    Execute a list of commands, at once in the transfer pool if there's one
+    (the commands on the same path in order)
+    """
 
-    def __init__(self, file_system_op, server_com):
+    def __init__(self, file_system_op, server_com, transfers=None):
         self.local = file_system_op
         self.remote = server_com
+        self.transfers = transfers
 
     def syncronize_executer(self, command_list):
         logger.debug("EXECUTER\n")
@@ -897,22 +1488,34 @@ class CommandExecuter(object):
 
         logger.debug(command_list)
 
+        submitted = []
         for command_row in command_list:
             for command in command_row:
                 command_dest = command.split('_')[0]
                 command_type = command.split('_')[1]
                 if command_dest == 'remote':
-                    {
+                    function = {
                         'upload': self.remote.upload_file,
                         'update': self.remote.upload_file,
                         'delete': self.remote.delete_file,
-                    }.get(command_type, error)(*(command_row[command]))
+                    }.get(command_type, error)
                 else:
-                    {
+                    function = {
                         'copy': self.local.copy_a_file,
+                        'move': self.local.move_a_file,
                         'download': self.local.write_a_file,
                         'delete': self.local.delete_a_file,
-                    }.get(command_type, error)(*(command_row[command]))
+                    }.get(command_type, error)
+                args = command_row[command]
+                if self.transfers is None or function is error:
+                    function(*args)
+                    continue
+                kind = {'update': 'upload'}.get(command_type, command_type)
+                paths = [get_abspath(arg) for arg in args if isinstance(arg, basestring)]
+                submitted.append(self.transfers.submit(kind, paths, function, *args))
+        # the timestamp is saved by the caller when everything is applied
+        for done in submitted:
+            done.wait()
 
 
 def logger_init(crash_repo_path, stdout_level, file_level, disabled=False):
@@ -976,26 +1579,36 @@ def main():
         disabled=args.no_log,
     )
 
+    # the command manager can follow the first scan of the directory: the
+    # other commands are available after it
+    hashing_engine = HashingEngine()
+    client_command = {
+        "get_scan_progress": hashing_engine.get_progress
+    }
+    sock_server = CmdMessageServer(
+        config['host'],
+        int(config['port']),
+        client_command)
+
     snapshot_manager = DirSnapshotManager(
         snapshot_file_path=config['snapshot_file_path'],
+        hashing_engine=hashing_engine,
+        on_progress=lambda progress: asyncore.poll(timeout=0),
     )
-    
+
     server_com = ServerCommunicator(
         server_url=config['server_url'],
         username=None,
         password=None,
         snapshot_manager=snapshot_manager)
 
-    client_command = {
+    client_command.update({
         "create_user": server_com.create_user,
         "activate_user": server_com.activate_user,
         "delete_user": server_com.delete_user,
-        "get_shares_list": server_com.get_shares_list
-    }
-    sock_server = CmdMessageServer(
-        config['host'],
-        int(config['port']),
-        client_command)
+        "get_shares_list": server_com.get_shares_list,
+        "get_usage": server_com.get_usage
+    })
 
     while not user_exists:
         asyncore.poll(timeout=1.0)
@@ -1003,27 +1616,43 @@ def main():
 
     server_com.username = config['username']
     server_com.password = config['password']
-    server_com.auth = HTTPBasicAuth(server_com.username, server_com.password)
+    server_com.login()
+    server_com.resume_uploads()
 
-    event_handler = DirectoryEventHandler(server_com, snapshot_manager)
+    transfers = TransferPool()
+    event_handler = DirectoryEventHandler(
+        server_com, snapshot_manager, transfers=transfers)
     file_system_op = FileSystemOperator(event_handler, server_com, snapshot_manager)
-    executer = CommandExecuter(file_system_op, server_com)
+    executer = CommandExecuter(file_system_op, server_com, transfers)
     server_com.setExecuter(executer)
     observer = Observer()
     observer.schedule(event_handler, config['dir_path'], recursive=True)
 
     observer.start()
-
-    last_synk_time = 0
+    # the changes of the files are sent when they're quiet
+    stop_dispatch = threading.Event()
+    dispatcher = threading.Thread(
+        target=event_handler.dispatch_changes, args=(stop_dispatch,))
+    dispatcher.start()
+
+    # the first synchronization, then one every time the server changes
+    server_changed = threading.Event()
+    server_changed.set()
+    watcher = threading.Thread(target=server_com.watch, args=(server_changed,))
+    watcher.daemon = True
+    watcher.start()
     try:
         while True:
-            asyncore.poll(timeout=5.0)
-            if (time.time() - last_synk_time) >= 5.0:
-                last_synk_time = time.time()
+            asyncore.poll(timeout=1.0)
+            if server_changed.is_set():
                 server_com.synchronize(file_system_op)
+                server_changed.clear()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    stop_dispatch.set()
+    dispatcher.join()
+    snapshot_manager.save_index()
 
 
 if __name__ == '__main__':
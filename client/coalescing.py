@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import time
+import os
+
+"""
+The changes of the local files, coalesced before they're sent to the
+server: one change for every path, sent when the path has been quiet for a
+while and the file stopped changing (same size and mtime).
+    created, modified, modified     -> created (one upload)
+    created, deleted                -> nothing
+    moved, modified                 -> created, and the source deleted
+    deleted, created (same path)    -> modified
+    created, moved to a synced path -> modified (an atomic save)
+A file deleted and created elsewhere with the same content is a move: the
+two changes are paired by the caller, which knows the content of the files.
+"""
+
+# seconds a path must be quiet before its change is sent
+QUIET_PERIOD = 1.0
+
+CREATED = "created"
+MODIFIED = "modified"
+DELETED = "deleted"
+MOVED = "moved"
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+class CoalescingQueue(object):
+    """
+    The pending changes, { path: change }. A change is a dict with the
+    "action", the "src" of a move (the path the server knows), the "state"
+    of the file and the time of the last event ("since"). synced(path)
+    tells if the server has the file at path.
+    """
+    def __init__(self, quiet_period=QUIET_PERIOD, synced=None):
+        self.quiet_period = quiet_period
+        self.synced = synced or (lambda path: False)
+        self.changed = threading.Condition()
+        self.pending = {}
+
+    def _set(self, path, action, src=None):
+        self.pending[path] = {
+            "action": action,
+            "src": src,
+            "state": _file_state(path) if action != DELETED else None,
+            "since": time.time(),
+        }
+        self.changed.notify()
+
+    def _deleted_on_server(self, path):
+        """ the file of the server at path isn't there anymore """
+        change = self.pending.get(path)
+        if change and change["action"] in (CREATED, MODIFIED):
+            # another file took its place
+            self._set(path, MODIFIED)
+        else:
+            self._set(path, DELETED)
+
+    def _is_moved_away(self, path):
+        return any(
+            change["action"] == MOVED and change["src"] == path
+            for change in self.pending.values()
+        )
+
+    def created(self, path):
+        with self.changed:
+            change = self.pending.get(path)
+            if change and change["action"] == DELETED:
+                # replaced: the server has the old content
+                self._set(path, MODIFIED)
+            else:
+                self._set(path, CREATED)
+
+    def modified(self, path):
+        with self.changed:
+            change = self.pending.get(path)
+            if change is None or change["action"] == DELETED:
+                self._set(path, MODIFIED)
+            elif change["action"] == MOVED:
+                # the server can't move a content it doesn't have
+                self._set(path, CREATED)
+                self._deleted_on_server(change["src"])
+            else:
+                self._set(path, change["action"])
+
+    def deleted(self, path):
+        with self.changed:
+            change = self.pending.pop(path, None)
+            if change is None or change["action"] in (MODIFIED, DELETED):
+                self._set(path, DELETED)
+            elif change["action"] == MOVED:
+                self._deleted_on_server(change["src"])
+            # created and deleted: the server never knew it
+
+    def moved(self, src_path, dst_path):
+        with self.changed:
+            change = self.pending.pop(src_path, None)
+            action = change["action"] if change else None
+            # the path of the file on the server
+            origin = change["src"] if action == MOVED else src_path
+            dst_change = self.pending.get(dst_path)
+            # the server has a file at dst_path: it's updated (a PUT)
+            replaced = dst_change and dst_change["action"] == DELETED or \
+                self._is_moved_away(dst_path) or self.synced(dst_path)
+            if action == CREATED:
+                self._set(dst_path, MODIFIED if replaced else CREATED)
+            elif origin == dst_path:
+                # moved back
+                self.pending.pop(dst_path, None)
+            elif action == MODIFIED or replaced:
+                # uploaded again: a move can't overwrite a file of the server
+                self._set(dst_path, MODIFIED if replaced else CREATED)
+                self._deleted_on_server(origin)
+            else:
+                self._set(dst_path, MOVED, origin)
+
+    def ready(self, flush=False):
+        """
+        Take the changes ready to be sent (all of them if flush), as
+        [(path, change)]. A deletion waits for the creations pending, which
+        could be its new path.
+        """
+        with self.changed:
+            now = time.time()
+            ready = []
+            waiting_creations = False
+            for path, change in self.pending.items():
+                if flush:
+                    ready.append((path, change))
+                    continue
+                if now - change["since"] < self.quiet_period:
+                    waiting_creations |= change["action"] == CREATED
+                    continue
+                if change["action"] != DELETED:
+                    state = _file_state(path)
+                    if state != change["state"]:
+                        # still written
+                        change["state"] = state
+                        change["since"] = now
+                        waiting_creations |= change["action"] == CREATED
+                        continue
+                ready.append((path, change))
+            if waiting_creations:
+                ready = [(path, change) for path, change in ready
+                         if change["action"] != DELETED]
+            for path, change in ready:
+                del self.pending[path]
+            return ready
+
+    def wait(self, timeout):
+        """ Wait until a change may be ready, at most timeout seconds """
+        with self.changed:
+            changes = self.pending.values()
+            if any(change["action"] == CREATED for change in changes):
+                # the deletions wait for them
+                changes = [change for change in changes
+                           if change["action"] != DELETED]
+            if changes:
+                due = min(change["since"] for change in changes) + \
+                    self.quiet_period - time.time()
+                timeout = min(timeout, due)
+            if timeout > 0:
+                self.changed.wait(timeout)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import multiprocessing
+import threading
+import hashlib
+import Queue
+import time
+
+"""
+Hashing of many files at once, for the scan of the synchronized directory.
+The files are hashed by a pool of threads: hashlib releases the GIL while
+it hashes a big block, so the threads run on more cores (and keep more
+disks busy). The paths are fed by the directory walker through a bounded
+queue: the walk never gets far ahead of the hashing.
+"""
+
+# threads hashing the files
+HASH_WORKERS = multiprocessing.cpu_count()
+# bytes read and hashed at once
+HASH_BLOCK_SIZE = 2 ** 20
+# paths walked and waiting to be hashed, at most
+HASH_QUEUE_LENGTH = 256
+# seconds between two calls of the progress callback of a scan
+PROGRESS_INTERVAL = 0.5
+
+
+def file_md5(path, block_size=HASH_BLOCK_SIZE):
+    """ md5 of the file at path, read in blocks of block_size """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class _Stopped(Exception):
+    pass
+
+
+class HashingEngine(object):
+    """
+    Hash files in a pool of threads. The progress of the last scan is kept
+    for the command manager (get_progress)
+    """
+    def __init__(self, workers=HASH_WORKERS, queue_length=HASH_QUEUE_LENGTH):
+        self.workers = workers
+        self.queue_length = queue_length
+        self.progress = {"scanning": False, "found": 0, "hashed": 0}
+
+    def get_progress(self, param=None):
+        """ the progress of the scan, as answer to the command manager """
+        return {"result": "ok", "details": [dict(self.progress)]}
+
+    def hash_files(self, paths, hash_file=file_md5, on_progress=None):
+        """
+        Generate (path, hash_file(path)) for every path, in the order they're
+        hashed; the hash is None if the file vanished meanwhile. paths can be
+        a generator: it's consumed by a thread while the files are hashed.
+        on_progress is called by the caller's thread while it waits.
+        """
+        pending = Queue.Queue(self.queue_length)
+        results = Queue.Queue()
+        stopped = threading.Event()
+        done = object()
+
+        def put(queue, item):
+            # blocks while the queue is full, unless the scan is abandoned
+            while not stopped.is_set():
+                try:
+                    return queue.put(item, timeout=0.1)
+                except Queue.Full:
+                    pass
+            raise _Stopped()
+
+        def walk():
+            try:
+                for path in paths:
+                    put(pending, path)
+                    self.progress["found"] += 1
+            except _Stopped:
+                return
+            except Exception as e:
+                results.put((None, e))
+            for _ in range(self.workers):
+                try:
+                    put(pending, done)
+                except _Stopped:
+                    return
+
+        def work():
+            while not stopped.is_set():
+                path = pending.get()
+                if path is done:
+                    results.put((done, None))
+                    return
+                try:
+                    results.put((path, hash_file(path)))
+                except EnvironmentError:
+                    results.put((path, None))
+                except Exception as e:
+                    results.put((None, e))
+
+        self.progress = {"scanning": True, "found": 0, "hashed": 0}
+        threads = [threading.Thread(target=walk)] + [
+            threading.Thread(target=work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            finished = 0
+            last_progress = time.time()
+            while finished < self.workers:
+                try:
+                    path, result = results.get(timeout=PROGRESS_INTERVAL)
+                except Queue.Empty:
+                    path, result = None, None
+                else:
+                    if path is done:
+                        finished += 1
+                        continue
+                    if path is None:
+                        raise result
+                    self.progress["hashed"] += 1
+                    yield path, result
+                if on_progress and \
+                        time.time() - last_progress >= PROGRESS_INTERVAL:
+                    on_progress(dict(self.progress))
+                    last_progress = time.time()
+        finally:
+            stopped.set()
+            # the workers waiting for a path are woken up
+            for _ in range(self.workers):
+                try:
+                    pending.put_nowait(done)
+                except Queue.Full:
+                    break
+            self.progress["scanning"] = False
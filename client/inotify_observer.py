@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import select
+import errno
+import time
+import os
+
+from watchdog.observers.api import BaseObserver, EventEmitter
+from watchdog.observers.api import DEFAULT_OBSERVER_TIMEOUT
+from watchdog.observers.api import DEFAULT_EMITTER_TIMEOUT
+from watchdog.observers.inotify import ACTION_EVENT_MAP
+from watchdog.observers.inotify_c import Inotify, inotify_rm_watch
+from watchdog.utils.dirsnapshot import DirectorySnapshot
+from watchdog.utils.dirsnapshot import DirectorySnapshotDiff
+from watchdog.events import EVENT_TYPE_MOVED, EVENT_TYPE_DELETED
+from watchdog.events import EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED
+from watchdog.events import FileCreatedEvent, FileDeletedEvent
+from watchdog.events import FileModifiedEvent, FileMovedEvent
+from watchdog.events import DirCreatedEvent, DirDeletedEvent
+from watchdog.events import DirModifiedEvent, DirMovedEvent
+
+"""
+Observer of the synchronized directory notified by the kernel (inotify):
+the idle daemon reads nothing, whatever the size of the directory.
+
+The inotify observer of watchdog 0.7 drops a file moved out of the
+directory (e.g. dragged to the trash): an IN_MOVED_FROM without its
+IN_MOVED_TO. Here it's a deleted file, as for the polling observer, and a
+file moved in is a created one. When the inotify watches run out
+(fs.inotify.max_user_watches) the directory is polled.
+"""
+
+# errors of inotify when the watches or the instances of the user run out
+WATCH_LIMIT_ERRORS = (errno.ENOSPC, errno.EMFILE)
+# seconds waited for the IN_MOVED_TO of an IN_MOVED_FROM read last: the
+# two events of a rename can be split between two reads
+MOVE_PAIR_TIMEOUT = 0.1
+
+
+def watches_exhausted(error):
+    """
+    True if an OSError of inotify means that the watches ran out (watchdog
+    raises it with the message of the errno only)
+    """
+    if error.errno is not None:
+        return error.errno in WATCH_LIMIT_ERRORS
+    return bool(error.args) and \
+        error.args[0] in [os.strerror(e) for e in WATCH_LIMIT_ERRORS]
+
+
+def _is_under(path, directory):
+    return path == directory or path.startswith(directory + os.sep)
+
+
+class _Inotify(Inotify):
+    """
+    The inotify of watchdog, closed if it can't watch the whole tree, which
+    remembers if a watch added later failed because they ran out
+    """
+    def __init__(self, path, recursive):
+        self.exhausted = False
+        try:
+            Inotify.__init__(self, path, recursive)
+        except OSError:
+            if hasattr(self, "_inotify_fd"):
+                os.close(self._inotify_fd)
+            raise
+
+    def _add_watch(self, path, mask):
+        try:
+            return Inotify._add_watch(self, path, mask)
+        except OSError as e:
+            if watches_exhausted(e):
+                self.exhausted = True
+            raise
+
+    def forget_tree(self, path):
+        """
+        Stop watching a directory moved out of the tree and its content
+        (the bookkeeping is cleaned at the IN_IGNORED of every watch)
+        """
+        with self._lock:
+            for watched, wd in self._wd_for_path.items():
+                if _is_under(watched, path):
+                    inotify_rm_watch(self._inotify_fd, wd)
+
+    def wait(self, timeout):
+        """ True if there are events to read within timeout seconds """
+        return bool(select.select([self.fd], [], [], timeout)[0])
+
+
+class InotifyEmitter(EventEmitter):
+    """
+    The same events of the polling emitter, read from inotify. The files
+    of every directory are kept: the ones of a directory moved out of the
+    tree are deleted.
+    """
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT):
+        EventEmitter.__init__(self, event_queue, watch, timeout)
+        self._inotify = None
+        self._snapshot = None
+        # { directory : set(file paths) }
+        self._files = {}
+        try:
+            self._inotify = _Inotify(watch.path, watch.is_recursive)
+        except OSError as e:
+            if not watches_exhausted(e):
+                raise
+            self._start_polling()
+        else:
+            self._index(self._inotify.path)
+
+    @property
+    def polling(self):
+        """ True if the watches ran out: the tree is polled """
+        return self._snapshot is not None
+
+    def _index(self, path):
+        for root, dirnames, filenames in os.walk(path):
+            self._files[root] = set(
+                os.path.join(root, name) for name in filenames
+            )
+            if not self.watch.is_recursive:
+                break
+
+    def _start_polling(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._files = {}
+        self._snapshot = DirectorySnapshot(
+            self.watch.path, self.watch.is_recursive
+        )
+
+    def queue_event(self, event):
+        EventEmitter.queue_event(self, event)
+        if self.polling:
+            return
+        # the files of every directory
+        if event.is_directory:
+            if event.event_type == EVENT_TYPE_CREATED:
+                self._files.setdefault(event.src_path, set())
+            elif event.event_type == EVENT_TYPE_DELETED:
+                for directory in self._directories_under(event.src_path):
+                    del self._files[directory]
+            elif event.event_type == EVENT_TYPE_MOVED:
+                for directory in self._directories_under(event.src_path):
+                    files = self._files.pop(directory)
+                    self._files[self._rebase(
+                        directory, event.src_path, event.dest_path
+                    )] = set(
+                        self._rebase(f, event.src_path, event.dest_path)
+                        for f in files
+                    )
+            return
+        if event.event_type in (EVENT_TYPE_DELETED, EVENT_TYPE_MOVED):
+            self._files.get(os.path.dirname(event.src_path), set()) \
+                .discard(event.src_path)
+        if event.event_type == EVENT_TYPE_CREATED:
+            self._files.setdefault(os.path.dirname(event.src_path), set()) \
+                .add(event.src_path)
+        elif event.event_type == EVENT_TYPE_MOVED:
+            self._files.setdefault(os.path.dirname(event.dest_path), set()) \
+                .add(event.dest_path)
+
+    def _directories_under(self, path):
+        return [d for d in self._files if _is_under(d, path)]
+
+    @staticmethod
+    def _rebase(path, src_path, dest_path):
+        return dest_path + path[len(src_path):]
+
+    def _queue(self, event, event_type):
+        klass = ACTION_EVENT_MAP[(event.is_directory, event_type)]
+        self.queue_event(klass(event.src_path))
+
+    def _moved(self, event):
+        src_path = self._inotify.source_for_move(event)
+        if src_path is None:
+            self._moved_in(event.src_path, event.is_directory)
+            return
+        dest_path = event.src_path
+        if not event.is_directory:
+            self.queue_event(FileMovedEvent(src_path, dest_path))
+            return
+        # the content moved, as it was known: it may be moved again on disk
+        # meanwhile
+        sub_events = []
+        for directory in sorted(self._directories_under(src_path)):
+            if directory != src_path:
+                sub_events.append(DirMovedEvent(
+                    directory, self._rebase(directory, src_path, dest_path)
+                ))
+            for file_path in sorted(self._files[directory]):
+                sub_events.append(FileMovedEvent(
+                    file_path, self._rebase(file_path, src_path, dest_path)
+                ))
+        self.queue_event(DirMovedEvent(src_path, dest_path))
+        for sub_event in sub_events:
+            self.queue_event(sub_event)
+
+    def _moved_in(self, path, is_directory):
+        """ Moved from outside the tree: created, with its content """
+        if not is_directory:
+            self.queue_event(FileCreatedEvent(path))
+            return
+        self.queue_event(DirCreatedEvent(path))
+        for root, dirnames, filenames in os.walk(path):
+            try:
+                self._inotify.add_watch(root)
+            except OSError:
+                # removed meanwhile, or the watches ran out: the events are
+                # sent anyway, then the tree is polled
+                pass
+            for name in dirnames:
+                self.queue_event(DirCreatedEvent(os.path.join(root, name)))
+            for name in filenames:
+                self.queue_event(FileCreatedEvent(os.path.join(root, name)))
+            if not self.watch.is_recursive:
+                break
+
+    def _moved_out(self, event):
+        """ Moved outside the tree (e.g. to the trash): deleted """
+        path = event.src_path
+        if not event.is_directory:
+            self.queue_event(FileDeletedEvent(path))
+            return
+        self._inotify.forget_tree(path)
+        directories = self._directories_under(path)
+        for directory in directories:
+            for file_path in self._files.pop(directory):
+                self.queue_event(FileDeletedEvent(file_path))
+        for directory in sorted(directories, reverse=True):
+            self.queue_event(DirDeletedEvent(directory))
+
+    def _read(self, timeout):
+        if not self._inotify.wait(timeout):
+            return
+        events = self._inotify.read_events()
+        # the IN_MOVED_TO of a rename can be in the next read
+        while events and events[-1].is_moved_from and \
+                self._inotify.wait(MOVE_PAIR_TIMEOUT):
+            events.extend(self._inotify.read_events())
+        moved_to = set(event.cookie for event in events if event.is_moved_to)
+
+        for event in events:
+            if event.is_moved_from:
+                if event.cookie not in moved_to:
+                    self._moved_out(event)
+            elif event.is_moved_to:
+                self._moved(event)
+            elif event.is_attrib or event.is_modify:
+                self._queue(event, EVENT_TYPE_MODIFIED)
+            elif event.is_delete or event.is_delete_self:
+                self._queue(event, EVENT_TYPE_DELETED)
+            elif event.is_create:
+                self._queue(event, EVENT_TYPE_CREATED)
+        self._inotify.clear_move_records()
+
+        if self._inotify.exhausted:
+            self._start_polling()
+
+    def _poll(self, timeout):
+        # as the polling emitter of watchdog
+        time.sleep(timeout)
+        snapshot = DirectorySnapshot(self.watch.path, self.watch.is_recursive)
+        diff = DirectorySnapshotDiff(self._snapshot, snapshot)
+        self._snapshot = snapshot
+
+        for src_path in diff.files_deleted:
+            self.queue_event(FileDeletedEvent(src_path))
+        for src_path in diff.files_modified:
+            self.queue_event(FileModifiedEvent(src_path))
+        for src_path in diff.files_created:
+            self.queue_event(FileCreatedEvent(src_path))
+        for src_path, dest_path in diff.files_moved:
+            self.queue_event(FileMovedEvent(src_path, dest_path))
+        for src_path in diff.dirs_deleted:
+            self.queue_event(DirDeletedEvent(src_path))
+        for src_path in diff.dirs_modified:
+            self.queue_event(DirModifiedEvent(src_path))
+        for src_path in diff.dirs_created:
+            self.queue_event(DirCreatedEvent(src_path))
+        for src_path, dest_path in diff.dirs_moved:
+            self.queue_event(DirMovedEvent(src_path, dest_path))
+
+    def queue_events(self, timeout):
+        if self.polling:
+            self._poll(timeout)
+        else:
+            self._read(timeout)
+
+    def run(self):
+        try:
+            EventEmitter.run(self)
+        finally:
+            # closed by the thread reading it
+            if self._inotify is not None:
+                self._inotify.close()
+
+
+class InotifyObserver(BaseObserver):
+    def __init__(self, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        BaseObserver.__init__(
+            self, emitter_class=InotifyEmitter, timeout=timeout
+        )
@@ -55,6 +55,12 @@ class MockExecuter(object):
     def _get_shares_list(self):
         RawBoxCmdTest.called = True
 
+    def _get_usage(self):
+        RawBoxCmdTest.called = True
+
+    def _get_scan_progress(self):
+        RawBoxCmdTest.called = True
+
 
 class RawBoxCmdTest(unittest.TestCase):
 
@@ -79,6 +85,14 @@ class RawBoxCmdTest(unittest.TestCase):
         self.rawbox_cmd.onecmd('get_shares_list')
         self.assertTrue(RawBoxCmdTest.called)
 
+    def test_do_usage(self):
+        self.rawbox_cmd.onecmd('usage')
+        self.assertTrue(RawBoxCmdTest.called)
+
+    def test_do_scan(self):
+        self.rawbox_cmd.onecmd('scan')
+        self.assertTrue(RawBoxCmdTest.called)
+
 
 class TestRawBoxExecuter(unittest.TestCase):
 
@@ -5,6 +5,7 @@ from client_daemon import FileSystemOperator
 from client_daemon import CommandExecuter
 from client_daemon import get_abspath
 from client_daemon import get_relpath
+from transfers import TransferPool
 
 #Watchdog event import for event_handler test
 from watchdog.events import FileDeletedEvent
@@ -19,6 +20,7 @@ import ConfigParser
 import client_daemon
 import httpretty
 import requests
+import threading
 import unittest
 import logging
 import hashlib
@@ -26,6 +28,7 @@ import base64
 import shutil
 import copy
 import json
+import time
 import os
 
 
@@ -89,6 +92,10 @@ class ServerCommunicatorTest(unittest.TestCase):
                 self.server_snapshot = server_snapshot
                 return ['command']
 
+            def changes_dispatcher(self, changes):
+                self.changes = changes
+                return ['change command']
+
             def save_snapshot(self, timestamp):
                 self.timestamp = timestamp
 
@@ -114,6 +121,10 @@ class ServerCommunicatorTest(unittest.TestCase):
             def update_snapshot_copy(self, body):
                 self.copy = body
 
+            def file_snapMd5(self, file_path):
+                with open(client_daemon.get_abspath(file_path), 'rb') as f:
+                    return hashlib.md5(f.read()).hexdigest()
+
         class _try_request(object):
             status_code = 200
             text = 'timestamp'
@@ -147,6 +158,15 @@ class ServerCommunicatorTest(unittest.TestCase):
         httpretty.register_uri(
             httpretty.GET,
             'http://127.0.0.1:5000/API/v1/shares/')
+        httpretty.register_uri(
+            httpretty.GET,
+            'http://127.0.0.1:5000/API/v1/usage/',
+            responses=[
+                httpretty.Response(
+                    body='{"bytes": 11, "files": 1, "quota": 2000000000}',
+                    status=200),
+                httpretty.Response(body='{}', status=401)
+            ])
         httpretty.register_uri(
             httpretty.POST,
             'http://127.0.0.1:5000/API/v1/Users/usernameFarlocco',
@@ -269,6 +289,124 @@ class ServerCommunicatorTest(unittest.TestCase):
             self.server_comm.auth)
         self.assertEqual(result.status_code, 401)
 
+    def test_login(self):
+        httpretty.register_uri(
+            httpretty.POST,
+            'http://127.0.0.1:5000/API/v1/tokens/',
+            responses=[
+                httpretty.Response(
+                    body='{"token": "a_session_token", "ttl": 3600}',
+                    status=201),
+                httpretty.Response(body='"not found"', status=404),
+            ])
+
+        #Case: the server gives a token
+        self.assertTrue(self.server_comm.login())
+        self.assertEqual(self.server_comm.token, "a_session_token")
+        self.server_comm.delete_file(self.file_path)
+        encoded = httpretty.last_request().headers['authorization'].split()[1]
+        self.assertEqual(
+            base64.decodestring(encoded),
+            ":".join([self.username, "a_session_token"]))
+
+        #Case: the server doesn't support tokens, use basic authentication
+        self.assertFalse(self.server_comm.login())
+        self.assertIsNone(self.server_comm.token)
+        self.assertEqual(self.server_comm.auth.password, self.password)
+
+    def test_try_request_with_expired_token(self):
+        httpretty.register_uri(
+            httpretty.POST,
+            'http://127.0.0.1:5000/API/v1/tokens/',
+            body='{"token": "new_token", "ttl": 3600}',
+            status=201)
+
+        class Callback(object):
+            def __init__(self, auth, *args, **kwargs):
+                self.auth = auth
+                if auth.password == "expired_token":
+                    self.status_code = 401
+                else:
+                    self.status_code = 200
+
+        self.server_comm._set_token({"token": "expired_token", "ttl": 3600})
+        result = self.server_comm._try_request(Callback)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.auth.password, "new_token")
+
+    def test_token_always_refused(self):
+        logins = []
+
+        def login():
+            logins.append(True)
+            self.server_comm._set_token({"token": "new_token", "ttl": 3600})
+            return True
+        self.server_comm.login = login
+
+        class Callback(object):
+            def __init__(self, auth, *args, **kwargs):
+                self.auth = auth
+                self.status_code = 401
+
+        self.server_comm._set_token({"token": "revoked_token", "ttl": 3600})
+        result = self.server_comm._try_request(Callback)
+        self.assertEqual(result.status_code, 401)
+        self.assertEqual(logins, [True])
+
+    def test_relogin_once(self):
+        # the transfers refused at once login only once
+        logins = []
+
+        def login():
+            logins.append(True)
+            time.sleep(0.05)
+            self.server_comm._set_token({"token": "new_token", "ttl": 3600})
+            return True
+        self.server_comm.login = login
+
+        class Callback(object):
+            def __init__(self, auth, *args, **kwargs):
+                self.auth = auth
+                time.sleep(0.01)
+                if auth.password == "expired_token":
+                    self.status_code = 401
+                else:
+                    self.status_code = 200
+
+        self.server_comm._set_token({"token": "expired_token", "ttl": 3600})
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    self.server_comm._try_request(Callback)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(logins, [True])
+        self.assertEqual(
+            [result.status_code for result in results], [200] * 4)
+
+    def test_save_upload_sessions_at_once(self):
+        client_daemon.UPLOAD_SESSIONS_FILE = os.path.join(
+            self.dir, 'upload_sessions.json')
+
+        def save(n):
+            for i in range(10):
+                self.server_comm._save_upload_session(
+                    'file_{}_{}'.format(n, i), {'id': i})
+        threads = [threading.Thread(target=save, args=(n,)) for n in range(4)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(self.server_comm._load_upload_sessions()), 40)
+        finally:
+            os.remove(client_daemon.UPLOAD_SESSIONS_FILE)
+            client_daemon.UPLOAD_SESSIONS_FILE = 'upload_sessions.json'
+
     def test_setexecuter(self):
         executer = "executer"
         self.server_comm.setExecuter(executer)
@@ -388,7 +526,9 @@ class ServerCommunicatorTest(unittest.TestCase):
         #check if methods are equal
         self.assertEqual(method, 'GET')
         #check response's body
-        self.assertEqual(response[1], u'[{"title": "Test"}]')
+        with open(response[1]) as f:
+            self.assertEqual(f.read(), '[{"title": "Test"}]')
+        os.remove(response[1])
 
         #Case: server bad request
         def _try_request(self, *args, **kwargs):
@@ -402,6 +542,105 @@ class ServerCommunicatorTest(unittest.TestCase):
         response = self.server_comm.download_file(self.file_path)
         self.assertEqual(response, (False, False))
 
+    def test_download_resume(self):
+        content = 'the content of the file'
+        requests_headers = []
+
+        class Response(object):
+            def __init__(self, status_code, body, headers):
+                self.status_code = status_code
+                self.body = body
+                self.headers = headers
+
+            def iter_content(self, chunk_size):
+                # the connection drops after 5 bytes
+                yield self.body[:5]
+                if len(self.body) > 5 and len(requests_headers) == 1:
+                    raise requests.exceptions.ConnectionError()
+                yield self.body[5:]
+
+        def _try_request(callback, success, error, url, headers, stream):
+            requests_headers.append(headers)
+            if 'Range' not in headers:
+                return Response(200, content, {
+                    'ETag': '"etag"', 'Content-Length': str(len(content))})
+            start = int(headers['Range'][len('bytes='):-1])
+            return Response(206, content[start:], {
+                'ETag': '"etag"', 'Content-Length': str(len(content) - start)})
+
+        self.server_comm._try_request = _try_request
+        local_path, downloaded = self.server_comm.download_file(self.file_path)
+        with open(downloaded) as f:
+            self.assertEqual(f.read(), content)
+        os.remove(downloaded)
+        self.assertEqual(
+            requests_headers,
+            [{}, {'Range': 'bytes=5-', 'If-Range': '"etag"'}])
+
+    def test_upload_in_chunks(self):
+        content = open(self.file_path, 'rb').read()
+        chunk_size = 4
+        chunks = -(-len(content) // chunk_size)
+        received = []
+        requests_made = []
+        dropped = []
+
+        class Response(object):
+            def __init__(self, status_code, body=None, text=''):
+                self.status_code = status_code
+                self.body = body
+                self.text = text
+
+            def json(self):
+                return self.body
+
+        def _try_request(callback, success, error, url, data=None, files=None):
+            requests_made.append((callback, url))
+            if url.endswith('/uploads/'):
+                return Response(201, {
+                    'id': 'abc', 'chunk_size': chunk_size, 'chunks': chunks})
+            if url.endswith('/uploads/abc') and callback == requests.get:
+                return Response(200, {
+                    'id': 'abc', 'chunk_size': chunk_size, 'chunks': chunks,
+                    'received': list(received)})
+            if url.endswith('/uploads/abc'):
+                if len(received) < chunks:
+                    return Response(409, {'missing': []})
+                return Response(201, text='timestamp')
+            index = int(url.rsplit('/', 1)[1])
+            # the connection drops at the second chunk, the first time
+            if index == 1 and not dropped:
+                dropped.append(index)
+                return Response(500)
+            self.assertEqual(
+                data['chunk_md5'],
+                hashlib.md5(files['file_content']).hexdigest())
+            received.append(index)
+            return Response(201)
+
+        client_daemon.UPLOAD_SESSIONS_FILE = os.path.join(
+            self.dir, 'upload_sessions.json')
+        client_daemon.CHUNKED_UPLOAD_THRESHOLD = chunk_size
+        self.server_comm._try_request = _try_request
+        try:
+            self.assertFalse(self.server_comm.upload_file(self.file_path))
+            self.assertEqual(received, [0])
+
+            # the session is resumed: only the missing chunks are sent
+            del requests_made[:]
+            self.server_comm.resume_uploads()
+            self.assertEqual(sorted(received), range(chunks))
+            self.assertEqual(requests_made[0][0], requests.get)
+            self.assertEqual(len(requests_made), chunks + 1)
+            self.assertEqual(
+                self.server_comm.snapshot_manager.upload,
+                {"src_path": self.file_path})
+            self.assertEqual(self.server_comm._load_upload_sessions(), {})
+        finally:
+            client_daemon.CHUNKED_UPLOAD_THRESHOLD = 4 * 2 ** 20
+            os.remove(client_daemon.UPLOAD_SESSIONS_FILE)
+            client_daemon.UPLOAD_SESSIONS_FILE = 'upload_sessions.json'
+
     def test_delete_file(self):
         mock_auth_user = ":".join([self.username, self.password])
         self.server_comm.delete_file(self.file_path)
@@ -554,6 +793,7 @@ class ServerCommunicatorTest(unittest.TestCase):
                     'snapshot': u'1234uh34h5bhj124b',
                 }
                 status_code = 'boh'
+                headers = {}
 
                 def json(self):
                     return self.text
@@ -573,11 +813,159 @@ class ServerCommunicatorTest(unittest.TestCase):
         self.server_comm.synchronize("mock")
         self.assertEqual(executer.status, True)
 
+    def test_synchronize_not_modified(self):
+        sent_headers = []
+
+        def my_try_request(callback, success, error, url, headers=None):
+            sent_headers.append(headers)
+            status = 304 if headers else 200
+
+            class obj(object):
+                status_code = status
+                text = {'timestamp': 123123, 'snapshot': {}}
+                headers = {'ETag': '"snapshot_etag"'}
+
+                def json(self):
+                    return self.text
+            return obj()
+
+        class Executer(object):
+
+            def __init__(self):
+                self.status = 0
+
+            def syncronize_executer(self, command_list):
+                self.status += 1
+
+        executer = Executer()
+        self.server_comm.executer = executer
+        self.server_comm._try_request = my_try_request
+        self.server_comm.synchronize("mock")
+        self.assertEqual(self.server_comm.snapshot_etag, '"snapshot_etag"')
+        self.assertEqual(executer.status, 1)
+
+        # the snapshot is the same: no dispatch
+        self.server_comm.synchronize("mock")
+        self.assertEqual(sent_headers[1], {'If-None-Match': '"snapshot_etag"'})
+        self.assertEqual(executer.status, 1)
+
+    def test_synchronize_changes(self):
+        responses = {}
+
+        def my_try_request(callback, success, error, url, **kwargs):
+            class obj(object):
+                status_code, text = responses[url.split('/')[-1]]
+                headers = {}
+
+                def json(self):
+                    return self.text
+            return obj()
+
+        class Executer(object):
+
+            def __init__(self):
+                self.command_list = False
+
+            def syncronize_executer(self, command_list):
+                self.command_list = command_list
+
+        executer = Executer()
+        self.server_comm.executer = executer
+        self.server_comm._try_request = my_try_request
+
+        # the first synchronization gets the full snapshot and the cursor
+        responses[''] = (200, {
+            'timestamp': 123123,
+            'snapshot': {},
+            'cursor': 10,
+        })
+        self.server_comm.synchronize("mock")
+        self.assertEqual(executer.command_list, ['command'])
+        self.assertEqual(self.server_comm.cursor, 10)
+
+        # then only the changes after the cursor
+        executer.command_list = False
+        change = {'op': 'add', 'path': 'new_file.txt', 'md5': 'abc'}
+        responses['changes'] = (200, {
+            'timestamp': 123124,
+            'changes': [change],
+            'cursor': 11,
+        })
+        self.server_comm.synchronize("mock")
+        self.assertEqual(executer.command_list, ['change command'])
+        self.assertEqual(self.server_comm.snapshot_manager.changes, [change])
+        self.assertEqual(self.server_comm.snapshot_manager.server_timestamp, 123124)
+        self.assertEqual(self.server_comm.cursor, 11)
+
+        # nothing changed: nothing to do
+        executer.command_list = False
+        responses['changes'] = (200, {
+            'timestamp': 123124,
+            'changes': [],
+            'cursor': 12,
+        })
+        self.server_comm.synchronize("mock")
+        self.assertFalse(executer.command_list)
+        self.assertEqual(self.server_comm.cursor, 12)
+
+        # the server lost the changes: full synchronization
+        responses['changes'] = (410, 'Changes not available')
+        self.server_comm.synchronize("mock")
+        self.assertEqual(executer.command_list, ['command'])
+        self.assertEqual(self.server_comm.cursor, 10)
+
+    def test_wait_for_changes(self):
+        sent = []
+        responses = []
+
+        def my_try_request(callback, success, error, url, **kwargs):
+            sent.append(kwargs)
+
+            class obj(object):
+                status_code, text = responses.pop(0)
+
+                def json(self):
+                    return self.text
+            return obj()
+
+        self.server_comm._try_request = my_try_request
+        self.server_comm.cursor = 10
+        self.addCleanup(
+            setattr, client_daemon, "LONG_POLL_RETRY_DELAY",
+            client_daemon.LONG_POLL_RETRY_DELAY)
+        client_daemon.LONG_POLL_RETRY_DELAY = 0
+
+        # nothing changed before the timeout
+        responses.append((200, {'changes': [], 'cursor': 11}))
+        self.assertFalse(self.server_comm.wait_for_changes())
+        self.assertEqual(
+            sent[0]['params'],
+            {'since': 10, 'wait': client_daemon.LONG_POLL_TIMEOUT})
+        self.assertGreater(
+            sent[0]['timeout'], client_daemon.LONG_POLL_TIMEOUT)
+
+        # something to synchronize
+        responses.append((200, {'changes': [{'op': 'add'}], 'cursor': 12}))
+        self.assertTrue(self.server_comm.wait_for_changes())
+        responses.append((410, 'Changes not available'))
+        self.assertTrue(self.server_comm.wait_for_changes())
+        responses.append((500, 'Internal server error'))
+        self.assertTrue(self.server_comm.wait_for_changes())
+
     def test_get_shares_list(self):
         msg1 = self.server_comm.get_shares_list()
         self.assertEqual(msg1["result"], 200)
         self.assertIn(msg1["details"][0], ["Shares not found", "Shares list downloaded"])
 
+    def test_get_usage(self):
+        msg1 = self.server_comm.get_usage()
+        self.assertEqual(msg1["result"], 200)
+        self.assertEqual(
+            msg1["details"][0], {"bytes": 11, "files": 1, "quota": 2000000000})
+        msg2 = self.server_comm.get_usage()
+        self.assertEqual(msg2["result"], 401)
+        self.assertEqual(msg2["details"][0], "Unauthorized access")
+
 
 
 class FileSystemOperatorTest(unittest.TestCase):
@@ -1051,6 +1439,43 @@ class DirSnapshotManagerTest(unittest.TestCase):
             server_snapshot=unsinked_server_snap)
         self.cmdListAsserEqual(result, expected_result)
 
+    def test_changes_dispatcher(self):
+        md5_file_1 = 'fea80f2db003d4ebc4536023814aa885'
+        md5_file_2 = '81bcb26fd4acfaa5d0acc7eef1d3013a'
+        changes = [
+            # made by this client: nothing to do
+            {'op': 'add', 'path': 'sub_dir_2/test_file_2.txt', 'md5': md5_file_2},
+            {'op': 'update', 'path': 'sub_dir_1/test_file_1.txt', 'md5': 'new_md5'},
+            {'op': 'add', 'path': 'sub_dir_3/copy_of_2.txt', 'md5': md5_file_2},
+            {'op': 'delete', 'path': 'sub_dir_2/test_file_3.txt', 'md5': 'md5_3'},
+            {'op': 'delete', 'path': 'not_here.txt', 'md5': 'md5'},
+        ]
+        self.assertEqual(
+            self.snapshot_manager.changes_dispatcher(changes),
+            [
+                {'local_download': ['sub_dir_1/test_file_1.txt']},
+                {'local_copy': ['sub_dir_2/test_file_2.txt', 'sub_dir_3/copy_of_2.txt']},
+                {'local_delete': ['sub_dir_2/test_file_3.txt']},
+            ])
+
+        changes = [
+            {
+                'op': 'move', 'path': 'moved.txt', 'md5': md5_file_1,
+                'src': 'sub_dir_1/test_file_1.txt'
+            },
+            # the source isn't here anymore
+            {
+                'op': 'move', 'path': 'moved_2.txt', 'md5': md5_file_1,
+                'src': 'sub_dir_1/test_file_1.txt'
+            },
+        ]
+        self.assertEqual(
+            self.snapshot_manager.changes_dispatcher(changes),
+            [
+                {'local_move': ['sub_dir_1/test_file_1.txt', 'moved.txt']},
+                {'local_download': ['moved_2.txt']},
+            ])
+
     def test_local_check(self):
         #Case: regular check
         self.assertTrue(self.snapshot_manager.local_check())
@@ -1085,6 +1510,89 @@ class DirSnapshotManagerTest(unittest.TestCase):
         #Case: directory
         self.assertFalse(self.snapshot_manager.file_snapMd5(self.test_folder_1))
 
+    def test_file_index(self):
+        rel_path = 'sub_dir_1/test_file_1.txt'
+        indexed = self.snapshot_manager.file_index[rel_path]
+        self.assertEqual(indexed[3], 'fea80f2db003d4ebc4536023814aa885')
+        self.assertEqual(
+            sorted(json.load(open(self.snapshot_manager.index_file_path))),
+            sorted(client_daemon.get_relpath(path) for path in [
+                self.test_file_1, self.test_file_2, self.test_file_3]))
+
+        # at the restart the files not changed aren't read
+        fake_index = json.load(open(self.snapshot_manager.index_file_path))
+        fake_index[rel_path][3] = 'not hashed'
+        fake_index['removed.txt'] = [0, 0, 0, 'removed']
+        with open(self.snapshot_manager.index_file_path, 'w') as f:
+            json.dump(fake_index, f)
+        snapshot_manager = DirSnapshotManager(self.conf_snap_path)
+        self.assertEqual(snapshot_manager.file_snapMd5(self.test_file_1), 'not hashed')
+        self.assertNotIn('removed.txt', snapshot_manager.file_index)
+
+        # a changed file is hashed again
+        with open(self.test_file_1, 'w') as f:
+            f.write('changed')
+        self.assertEqual(
+            snapshot_manager.file_snapMd5(self.test_file_1),
+            hashlib.md5('changed').hexdigest())
+        snapshot_manager.update_snapshot_update({'src_path': self.test_file_1})
+
+        # a moved file keeps its md5
+        moved = os.path.join(self.test_folder_2, 'moved.txt')
+        os.rename(self.test_file_1, moved)
+        snapshot_manager.update_snapshot_move(
+            {'src_path': self.test_file_1, 'dst_path': moved})
+        self.assertEqual(
+            snapshot_manager.file_index[client_daemon.get_relpath(moved)][3],
+            hashlib.md5('changed').hexdigest())
+        self.assertNotIn(rel_path, snapshot_manager.file_index)
+
+    def test_save_index(self):
+        index_path = self.snapshot_manager.index_file_path
+        index_dir = os.path.dirname(index_path)
+        self.assertFalse(self.snapshot_manager.index_changed)
+        # not changed: not written again
+        os.remove(index_path)
+        self.snapshot_manager.save_index()
+        self.assertFalse(os.path.exists(index_path))
+
+        # saved after a batch of server changes
+        with open(self.test_file_1, 'w') as f:
+            f.write('changed')
+        self.snapshot_manager.update_snapshot_update({'src_path': self.test_file_1})
+        self.assertTrue(self.snapshot_manager.index_changed)
+        self.snapshot_manager.save_timestamp(self.unsinked_timestamp)
+        self.assertFalse(self.snapshot_manager.index_changed)
+        self.assertEqual(
+            json.load(open(index_path))['sub_dir_1/test_file_1.txt'][3],
+            hashlib.md5('changed').hexdigest())
+        self.assertEqual(
+            [name for name in os.listdir(index_dir) if name.endswith('.tmp')], [])
+
+    def test_local_snapshot_locked(self):
+        # read holding the lock: the transfers change it meanwhile
+        held = threading.Event()
+        release = threading.Event()
+
+        def transfer():
+            with self.snapshot_manager.snapshot_lock:
+                held.set()
+                release.wait(5)
+                self.snapshot_manager.local_full_snapshot['new_md5'] = ['new.txt']
+        thread = threading.Thread(target=transfer)
+        thread.start()
+        held.wait(5)
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual(self.snapshot_manager.local_path_of('new_md5'), 'new.txt')
+        thread.join()
+
+        # the dispatchers work on a copy
+        local_snapshot = self.snapshot_manager._local_snapshot()
+        self.assertEqual(local_snapshot, self.snapshot_manager.local_full_snapshot)
+        local_snapshot['new_md5'].append('other.txt')
+        self.assertEqual(
+            self.snapshot_manager.local_full_snapshot['new_md5'], ['new.txt'])
+
     def test_global_md5(self):
         self.assertEqual(self.snapshot_manager.global_md5(), self.md5_snapshot)
 
@@ -1098,7 +1606,7 @@ class DirSnapshotManagerTest(unittest.TestCase):
         self.snapshotAsserEqual(instant_snapshot, self.true_snapshot)
 
     def test_save_snapshot(self):
-        test_timestamp = '1234'
+        test_timestamp = '123124'
         self.snapshot_manager.save_snapshot(test_timestamp)
 
         self.assertEqual(self.snapshot_manager.last_status['timestamp'], test_timestamp)
@@ -1109,6 +1617,11 @@ class DirSnapshotManagerTest(unittest.TestCase):
 
         self.assertEqual(expected_conf, new_conf)
 
+        #Case: the answer of an older request arrives later
+        self.snapshot_manager.save_snapshot('123123.5')
+        self.assertEqual(self.snapshot_manager.last_status['timestamp'], test_timestamp)
+        self.assertEqual(json.load(open(self.conf_snap_path)), expected_conf)
+
     def test_update_snapshot_upload(self):
         original_snapshot = copy.deepcopy(self.snapshot_manager.local_full_snapshot)
         del self.snapshot_manager.local_full_snapshot['fea80f2db003d4ebc4536023814aa885']
@@ -1294,6 +1807,15 @@ class DirectoryEventHandlerTest(unittest.TestCase):
             def file_snapMd5(self, *args, **kwargs):
                 return 'MD5'
 
+            def find_file_md5(self, snapshot, path, is_server=True):
+                for md5, paths in snapshot.items():
+                    if path in paths:
+                        return md5
+
+            def local_path_of(self, md5):
+                paths = self.local_full_snapshot.get(md5)
+                return paths[0] if paths else None
+
         #Generate test folder tree
         self.test_src = '/test/subdir1/file'
         self.test_dst = '/test/subdir2/file'
@@ -1329,6 +1851,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
 
         #Case: move file event
         self.event_handler.on_moved(move_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertTrue(self.server_comm.cmd["move"])
 
         #reset initial condition
@@ -1338,12 +1861,14 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         self.event_handler.paths_ignored.append(self.test_src)
         self.event_handler.paths_ignored.append(self.test_dst)
         self.event_handler.on_moved(move_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["move"])
         self.assertFalse(self.test_src in self.event_handler.paths_ignored)
         self.assertFalse(self.test_dst in self.event_handler.paths_ignored)
 
         #Case: directory move event
         self.event_handler.on_moved(move_dir_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["move"])
 
     def test_on_created(self):
@@ -1353,6 +1878,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
 
         #Case: create file event
         self.event_handler.on_created(create_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertEqual(
             self.server_comm.cmd["upload"],
             {'path': True, 'put': False})
@@ -1363,6 +1889,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
 
         #Case: dir create event
         self.event_handler.on_created(create_dir_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["upload"])
         self.assertFalse(self.server_comm.cmd["copy"])
 
@@ -1373,6 +1900,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         #Case: create file event for copy action
         self.snapshot_manager.local_full_snapshot = {'MD5': ['path']}
         self.event_handler.on_created(copy_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["upload"])
         self.assertTrue(self.server_comm.cmd["copy"])
 
@@ -1383,6 +1911,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         #Case: create file in ignored directory
         self.event_handler.paths_ignored.append(self.test_src)
         self.event_handler.on_created(create_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["upload"])
         self.assertFalse(self.test_src in self.event_handler.paths_ignored)
 
@@ -1393,6 +1922,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
         self.snapshot_manager.local_full_snapshot = {'MD5': ['path']}
         self.event_handler.paths_ignored.append(self.test_src)
         self.event_handler.on_created(copy_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["upload"])
         self.assertFalse(self.test_src in self.event_handler.paths_ignored)
         self.assertFalse(self.test_dst in self.event_handler.paths_ignored)
@@ -1403,6 +1933,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
 
         #Case: delete file event
         self.event_handler.on_deleted(delete_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertTrue(self.server_comm.cmd["delete"])
 
         #reset initial condition
@@ -1410,11 +1941,13 @@ class DirectoryEventHandlerTest(unittest.TestCase):
 
         #Case: delete dir event
         self.event_handler.on_deleted(delete_dir_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["delete"])
 
         #Case: delete file in ignored directory
         self.event_handler.paths_ignored.append(self.test_src)
         self.event_handler.on_deleted(delete_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["delete"])
         self.assertFalse(self.test_src in self.event_handler.paths_ignored)
 
@@ -1424,6 +1957,7 @@ class DirectoryEventHandlerTest(unittest.TestCase):
 
         #Case: modify file event
         self.event_handler.on_modified(modify_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertEqual(
             self.server_comm.cmd["upload"],
             {'path': True, 'put': True})
@@ -1433,14 +1967,66 @@ class DirectoryEventHandlerTest(unittest.TestCase):
 
         #Case: modify dir event
         self.event_handler.on_modified(modify_dir_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["upload"])
 
         #Case: modify file in ignored directory
         self.event_handler.paths_ignored.append(self.test_src)
         self.event_handler.on_modified(modify_file_event)
+        self.event_handler.dispatch(flush=True)
         self.assertFalse(self.server_comm.cmd["upload"])
         self.assertFalse(self.test_src in self.event_handler.paths_ignored)
 
+    def test_dispatch(self):
+        #Case: created and deleted: nothing is sent
+        self.event_handler.on_created(FileCreatedEvent(self.test_src))
+        self.event_handler.on_modified(FileModifiedEvent(self.test_src))
+        self.event_handler.on_deleted(FileDeletedEvent(self.test_src))
+        self.event_handler.dispatch(flush=True)
+        self.assertEqual(set(self.server_comm.cmd.values()), set([False]))
+
+        #Case: deleted and created elsewhere with the same content: moved
+        self.snapshot_manager.local_full_snapshot = {'MD5': [client_daemon.get_relpath(self.test_src)]}
+        self.event_handler.on_deleted(FileDeletedEvent(self.test_src))
+        self.event_handler.on_created(FileCreatedEvent(self.test_dst))
+        self.event_handler.dispatch(flush=True)
+        self.assertTrue(self.server_comm.cmd["move"])
+        self.assertFalse(self.server_comm.cmd["upload"])
+        self.assertFalse(self.server_comm.cmd["delete"])
+
+        #Case: nothing is sent before the quiet period
+        self.event_handler.changes.quiet_period = 60
+        self.event_handler.on_deleted(FileDeletedEvent(self.test_dst))
+        self.event_handler.dispatch()
+        self.assertFalse(self.server_comm.cmd["delete"])
+        self.event_handler.dispatch(flush=True)
+        self.assertTrue(self.server_comm.cmd["delete"])
+
+        #Case: atomic save over a synced file: updated
+        self.snapshot_manager.local_full_snapshot = {'MD5': [client_daemon.get_relpath(self.test_src)]}
+        tmp_path = '{}.tmp'.format(self.test_src)
+        self.event_handler.on_created(FileCreatedEvent(tmp_path))
+        self.event_handler.on_modified(FileModifiedEvent(tmp_path))
+        self.event_handler.on_moved(FileMovedEvent(tmp_path, self.test_src))
+        self.event_handler.dispatch(flush=True)
+        self.assertEqual(self.server_comm.cmd["upload"], {'path': True, 'put': True})
+
+    def test_dispatch_changes_save_index(self):
+        stopped = threading.Event()
+        saved = []
+
+        def save_index():
+            saved.append(True)
+            stopped.set()
+        self.snapshot_manager.save_index = save_index
+        interval = client_daemon.FILE_INDEX_SAVE_INTERVAL
+        client_daemon.FILE_INDEX_SAVE_INTERVAL = 0
+        try:
+            self.event_handler.dispatch_changes(stopped)
+        finally:
+            client_daemon.FILE_INDEX_SAVE_INTERVAL = interval
+        self.assertEqual(saved, [True])
+
 
 class CommandExecuterTest(unittest.TestCase):
 
@@ -1448,12 +2034,16 @@ class CommandExecuterTest(unittest.TestCase):
         class FileSystemOperator(object):
             def __init__(self):
                 self.copy = False
+                self.move = False
                 self.write = False
                 self.delete = False
 
             def copy_a_file(self, origin_path, dst_path):
                 self.copy = [origin_path, dst_path]
 
+            def move_a_file(self, origin_path, dst_path):
+                self.move = [origin_path, dst_path]
+
             def write_a_file(self, path):
                 self.write = path
 
@@ -1500,6 +2090,9 @@ class CommandExecuterTest(unittest.TestCase):
             {'local_copy': [
                 'src/copy/test/path',
                 'src/copy/test/path']},
+            {'local_move': [
+                'src/move/test/path',
+                'dst/move/test/path']},
             {'local_delete': ['delete/test/path']},
             {'remote_delete': ['delete/test/path']},
             {'remote_upload': ['upload/test/path']},
@@ -1510,6 +2103,9 @@ class CommandExecuterTest(unittest.TestCase):
         self.assertEqual(
             self.file_system_op.copy,
             ['src/copy/test/path', 'src/copy/test/path'])
+        self.assertEqual(
+            self.file_system_op.move,
+            ['src/move/test/path', 'dst/move/test/path'])
         self.assertEqual(
             self.file_system_op.write,
             'download/test/path')
@@ -1523,6 +2119,30 @@ class CommandExecuterTest(unittest.TestCase):
             self.server_comm.delete,
             'delete/test/path')
 
+    def test_syncronize_executer_pool(self):
+        applied = []
+
+        def write_a_file(path):
+            time.sleep(0.1)
+            applied.append(('download', path))
+
+        def move_a_file(origin_path, dst_path):
+            applied.append(('move', origin_path, dst_path))
+        self.file_system_op.write_a_file = write_a_file
+        self.file_system_op.move_a_file = move_a_file
+        self.executer.transfers = TransferPool()
+
+        self.executer.syncronize_executer([
+            {'local_download': ['a.txt']},
+            {'local_move': ['a.txt', 'b.txt']},
+            {'local_download': ['c.txt']},
+        ])
+        # the commands on a path in order, all of them applied at the return
+        self.assertEqual(len(applied), 3)
+        self.assertLess(
+            applied.index(('download', 'a.txt')),
+            applied.index(('move', 'a.txt', 'b.txt')))
+
 
 class FunctionTest(unittest.TestCase):
 
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import tempfile
+import unittest
+import shutil
+import time
+import os
+
+from coalescing import CoalescingQueue
+from coalescing import CREATED, MODIFIED, DELETED, MOVED
+
+
+class TestCoalescingQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.a = os.path.join(self.dir, "a.txt")
+        self.b = os.path.join(self.dir, "b.txt")
+        self.c = os.path.join(self.dir, "c.txt")
+        self.queue = CoalescingQueue(quiet_period=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, content="content"):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def changes(self):
+        return dict(
+            (path, (change["action"], change["src"]))
+            for path, change in self.queue.ready(flush=True)
+        )
+
+    def test_created(self):
+        self.queue.created(self.a)
+        self.queue.modified(self.a)
+        self.queue.modified(self.a)
+        self.assertEqual(self.changes(), {self.a: (CREATED, None)})
+
+        self.queue.created(self.a)
+        self.queue.deleted(self.a)
+        self.assertEqual(self.changes(), {})
+
+        # renamed before it was sent
+        self.queue.created(self.a)
+        self.queue.moved(self.a, self.b)
+        self.assertEqual(self.changes(), {self.b: (CREATED, None)})
+
+    def test_modified(self):
+        self.queue.modified(self.a)
+        self.queue.modified(self.a)
+        self.assertEqual(self.changes(), {self.a: (MODIFIED, None)})
+
+        self.queue.modified(self.a)
+        self.queue.deleted(self.a)
+        self.assertEqual(self.changes(), {self.a: (DELETED, None)})
+
+        # replaced
+        self.queue.deleted(self.a)
+        self.queue.created(self.a)
+        self.assertEqual(self.changes(), {self.a: (MODIFIED, None)})
+
+    def test_moved(self):
+        self.queue.moved(self.a, self.b)
+        self.queue.moved(self.b, self.c)
+        self.assertEqual(self.changes(), {self.c: (MOVED, self.a)})
+
+        # moved back
+        self.queue.moved(self.a, self.b)
+        self.queue.moved(self.b, self.a)
+        self.assertEqual(self.changes(), {})
+
+        self.queue.moved(self.a, self.b)
+        self.queue.deleted(self.b)
+        self.assertEqual(self.changes(), {self.a: (DELETED, None)})
+
+        # the server can't move what it doesn't have
+        self.queue.moved(self.a, self.b)
+        self.queue.modified(self.b)
+        self.assertEqual(
+            self.changes(), {self.b: (CREATED, None), self.a: (DELETED, None)})
+
+        # onto a file deleted
+        self.queue.deleted(self.b)
+        self.queue.moved(self.a, self.b)
+        self.assertEqual(
+            self.changes(), {self.b: (MODIFIED, None), self.a: (DELETED, None)})
+
+    def test_atomic_save(self):
+        # a temporary file written and renamed over a file of the server
+        tmp = os.path.join(self.dir, "a.txt.tmp")
+        queue = CoalescingQueue(
+            quiet_period=0, synced=lambda path: path in (self.a, self.b))
+        queue.created(tmp)
+        queue.modified(tmp)
+        queue.moved(tmp, self.a)
+        self.assertEqual(
+            [(path, change["action"]) for path, change in queue.ready(flush=True)],
+            [(self.a, MODIFIED)])
+
+        # a file of the server renamed over another one
+        queue.moved(self.b, self.a)
+        self.assertEqual(
+            dict((path, change["action"]) for path, change in queue.ready(flush=True)),
+            {self.a: MODIFIED, self.b: DELETED})
+
+    def test_swapped(self):
+        self.queue.moved(self.a, self.c)
+        self.queue.moved(self.b, self.a)
+        self.queue.moved(self.c, self.b)
+        self.assertEqual(
+            self.changes(), {self.a: (MODIFIED, None), self.b: (MODIFIED, None)})
+
+    def test_quiet_period(self):
+        self.queue.quiet_period = 0.2
+        self.write(self.a)
+        self.queue.created(self.a)
+        self.queue.deleted(self.b)
+        self.assertEqual(self.queue.ready(), [])
+        time.sleep(0.3)
+        # still written: the quiet period starts again
+        self.write(self.a, "more content")
+        self.assertEqual(self.queue.ready(), [])
+        start = time.time()
+        self.queue.wait(5)
+        self.assertGreater(time.time() - start, 0.1)
+        ready = self.queue.ready()
+        self.assertEqual(
+            sorted((path, change["action"]) for path, change in ready),
+            sorted([(self.a, CREATED), (self.b, DELETED)]))
+
+    def test_deletions_wait_for_creations(self):
+        self.queue.quiet_period = 0.2
+        self.queue.deleted(self.b)
+        time.sleep(0.3)
+        # the deletion is quiet, but the creation could be its new path
+        self.queue.created(self.a)
+        self.assertEqual(self.queue.ready(), [])
+        time.sleep(0.3)
+        self.assertEqual(len(self.queue.ready()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import tempfile
+import unittest
+import hashlib
+import shutil
+import time
+import os
+
+import hashing
+from hashing import HashingEngine
+
+
+class TestHashingEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = []
+        for n in range(50):
+            path = os.path.join(self.dir, "file_{}.txt".format(n))
+            with open(path, "w") as f:
+                f.write("content {}".format(n) * n)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_hash_files(self):
+        engine = HashingEngine(workers=4)
+        hashed = dict(engine.hash_files(iter(self.paths)))
+        self.assertEqual(hashed, dict(
+            (path, hashlib.md5(open(path).read()).hexdigest())
+            for path in self.paths))
+        self.assertEqual(
+            engine.get_progress()["details"],
+            [{"scanning": False, "found": 50, "hashed": 50}])
+
+    def test_file_md5(self):
+        path = self.paths[-1]
+        self.assertEqual(
+            hashing.file_md5(path, block_size=7),
+            hashlib.md5(open(path).read()).hexdigest())
+
+    def test_vanished_file(self):
+        os.remove(self.paths[0])
+        hashed = dict(HashingEngine(workers=2).hash_files(self.paths))
+        self.assertIsNone(hashed[self.paths[0]])
+        self.assertEqual(len(hashed), 50)
+
+    def test_error(self):
+        def hash_file(path):
+            if path == self.paths[10]:
+                raise ValueError(path)
+            return "md5"
+        with self.assertRaises(ValueError):
+            list(HashingEngine(workers=2).hash_files(self.paths, hash_file))
+
+        def walk():
+            yield self.paths[0]
+            raise RuntimeError()
+        with self.assertRaises(RuntimeError):
+            list(HashingEngine(workers=2).hash_files(walk()))
+
+    def test_bounded_queue(self):
+        # the walk waits for the hashing
+        walked = []
+        hashing_started = threading.Event()
+
+        def walk():
+            for path in self.paths:
+                walked.append(path)
+                yield path
+
+        def hash_file(path):
+            hashing_started.wait()
+            return "md5"
+
+        engine = HashingEngine(workers=2, queue_length=5)
+        results = engine.hash_files(walk(), hash_file)
+        thread = threading.Thread(target=list, args=(results,))
+        thread.start()
+        time.sleep(0.2)
+        # the queue, the paths taken by the workers and the one waiting
+        self.assertLessEqual(len(walked), 5 + 2 + 1)
+        hashing_started.set()
+        thread.join()
+        self.assertEqual(len(walked), 50)
+
+    def test_progress(self):
+        progress = []
+
+        def hash_file(path):
+            time.sleep(0.05)
+            return "md5"
+        engine = HashingEngine(workers=1)
+        list(engine.hash_files(self.paths[:20], hash_file, progress.append))
+        self.assertTrue(progress)
+        self.assertTrue(progress[0]["scanning"])
+        self.assertLess(progress[0]["hashed"], 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
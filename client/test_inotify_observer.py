@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import tempfile
+import unittest
+import shutil
+import errno
+import time
+import os
+
+from watchdog.events import FileSystemEventHandler
+
+import inotify_observer
+from inotify_observer import InotifyObserver
+
+
+class EventCollector(FileSystemEventHandler):
+    """ The events of the files, as (type, path[, dest path]) """
+    def __init__(self):
+        self.events = []
+        self.changed = threading.Condition()
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        with self.changed:
+            if hasattr(event, "dest_path"):
+                self.events.append(
+                    (event.event_type, event.src_path, event.dest_path)
+                )
+            else:
+                self.events.append((event.event_type, event.src_path))
+            self.changed.notify_all()
+
+    def wait_for(self, *expected):
+        """ Wait until every expected event is received """
+        deadline = time.time() + 5
+        with self.changed:
+            while not set(expected) <= set(self.events):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise AssertionError(
+                        "{} not in {}".format(expected, self.events)
+                    )
+                self.changed.wait(remaining)
+
+
+class TestInotifyObserver(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # the synchronized directory and a trash out of it
+        self.dir = os.path.join(self.root, "RawBox")
+        self.trash = os.path.join(self.root, "Trash")
+        os.makedirs(os.path.join(self.dir, "old", "sub"))
+        os.makedirs(self.trash)
+        self.old_files = [
+            os.path.join(self.dir, "old", "a.txt"),
+            os.path.join(self.dir, "old", "sub", "b.txt")
+        ]
+        for path in self.old_files:
+            self.write(path)
+        self.handler = EventCollector()
+        self.observer = None
+
+    def tearDown(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+        shutil.rmtree(self.root)
+
+    def start(self):
+        self.observer = InotifyObserver(timeout=0.1)
+        self.watch = self.observer.schedule(
+            self.handler, self.dir, recursive=True
+        )
+        self.observer.start()
+
+    def emitter(self):
+        return self.observer._emitter_for_watch[self.watch]
+
+    def write(self, path, content="content"):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_events(self):
+        self.start()
+        self.assertFalse(self.emitter().polling)
+        path = os.path.join(self.dir, "new.txt")
+        self.write(path)
+        self.handler.wait_for(("created", path))
+        self.write(path, "changed")
+        self.handler.wait_for(("modified", path))
+        renamed = os.path.join(self.dir, "renamed.txt")
+        os.rename(path, renamed)
+        self.handler.wait_for(("moved", path, renamed))
+        os.remove(renamed)
+        self.handler.wait_for(("deleted", renamed))
+
+        # created with its directories
+        nested = os.path.join(self.dir, "new", "dir", "c.txt")
+        os.makedirs(os.path.dirname(nested))
+        self.write(nested)
+        self.handler.wait_for(("created", nested))
+
+    def test_moved_to_trash(self):
+        self.start()
+        path = self.old_files[0]
+        os.rename(path, os.path.join(self.trash, "a.txt"))
+        self.handler.wait_for(("deleted", path))
+
+        # a directory: every file in it is deleted
+        moved = os.path.join(self.dir, "moved")
+        os.rename(os.path.join(self.dir, "old"), moved)
+        os.rename(moved, os.path.join(self.trash, "moved"))
+        self.handler.wait_for(
+            ("deleted", os.path.join(moved, "sub", "b.txt"))
+        )
+        # not watched anymore
+        self.write(os.path.join(self.trash, "moved", "sub", "c.txt"))
+        self.write(os.path.join(self.dir, "after.txt"))
+        self.handler.wait_for(
+            ("created", os.path.join(self.dir, "after.txt"))
+        )
+        self.assertEqual(
+            [e for e in self.handler.events if self.trash in e[1]], []
+        )
+        self.assertNotIn(
+            ("created", os.path.join(moved, "sub", "c.txt")),
+            self.handler.events
+        )
+
+    def test_moved_from_outside(self):
+        self.start()
+        os.makedirs(os.path.join(self.trash, "restored", "sub"))
+        self.write(os.path.join(self.trash, "restored", "sub", "d.txt"))
+        os.rename(
+            os.path.join(self.trash, "restored"),
+            os.path.join(self.dir, "restored")
+        )
+        restored = os.path.join(self.dir, "restored", "sub", "d.txt")
+        self.handler.wait_for(("created", restored))
+        # watched
+        self.write(restored, "changed")
+        self.handler.wait_for(("modified", restored))
+
+    def test_polling_without_watches(self):
+        def exhausted(inotify, path, mask):
+            raise OSError(os.strerror(errno.ENOSPC))
+        original = inotify_observer.Inotify._add_watch
+        inotify_observer.Inotify._add_watch = exhausted
+        self.addCleanup(
+            setattr, inotify_observer.Inotify, "_add_watch", original
+        )
+        self.start()
+        self.assertTrue(self.emitter().polling)
+        path = self.old_files[0]
+        os.rename(path, os.path.join(self.trash, "a.txt"))
+        self.handler.wait_for(("deleted", path))
+
+    def test_polling_when_watches_run_out(self):
+        self.start()
+        original = inotify_observer.Inotify._add_watch
+
+        def exhausted(inotify, path, mask):
+            raise OSError(os.strerror(errno.ENOSPC))
+        inotify_observer.Inotify._add_watch = exhausted
+        self.addCleanup(
+            setattr, inotify_observer.Inotify, "_add_watch", original
+        )
+        # a new directory can't be watched
+        os.makedirs(os.path.join(self.dir, "new"))
+        path = os.path.join(self.dir, "new", "e.txt")
+        deadline = time.time() + 5
+        while not self.emitter().polling and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(self.emitter().polling)
+        self.write(path)
+        self.handler.wait_for(("created", path))
+
+    def test_watches_exhausted(self):
+        self.assertTrue(inotify_observer.watches_exhausted(
+            OSError(os.strerror(errno.ENOSPC))
+        ))
+        self.assertTrue(inotify_observer.watches_exhausted(
+            OSError(errno.EMFILE, os.strerror(errno.EMFILE))
+        ))
+        self.assertFalse(inotify_observer.watches_exhausted(
+            OSError("Path is not a directory")
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
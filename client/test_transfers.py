@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import unittest
+import logging
+import time
+
+from transfers import TransferPool
+
+
+class TestTransferPool(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.done = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def transfer(self, name, delay=0):
+        time.sleep(delay)
+        with self.lock:
+            self.done.append(name)
+
+    def test_concurrent(self):
+        pool = TransferPool({"upload": 10})
+        start = time.time()
+        for n in range(10):
+            pool.submit("upload", ["file_{}".format(n)], self.transfer, n, 0.2)
+        pool.join()
+        self.assertEqual(sorted(self.done), range(10))
+        self.assertLess(time.time() - start, 1)
+
+    def test_path_order(self):
+        pool = TransferPool({"download": 4, "move": 4, "delete": 4})
+        pool.submit("download", ["a"], self.transfer, "download a", 0.2)
+        pool.submit("move", ["a", "b"], self.transfer, "move a b", 0.1)
+        pool.submit("delete", ["b"], self.transfer, "delete b")
+        pool.submit("delete", ["c"], self.transfer, "delete c")
+        done = pool.submit("download", ["a"], self.transfer, "download a")
+        done.wait()
+        pool.join()
+        self.assertEqual(len(self.done), 5)
+        self.assertIn("delete c", self.done)
+        # in order on every path; the other paths run meanwhile
+        first, second = [
+            n for n, name in enumerate(self.done) if name == "download a"]
+        move = self.done.index("move a b")
+        self.assertLess(first, move)
+        self.assertLess(move, second)
+        self.assertLess(move, self.done.index("delete b"))
+        self.assertEqual(pool.last, {})
+
+    def test_workers_per_kind(self):
+        pool = TransferPool({"upload": 1, "delete": 1})
+        start = time.time()
+        for n in range(3):
+            pool.submit("upload", [str(n)], self.transfer, n, 0.1)
+        pool.submit("delete", ["other"], self.transfer, "delete")
+        pool.join()
+        self.assertEqual(self.done[0], "delete")
+        self.assertEqual(self.done[1:], [0, 1, 2])
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+    def test_error(self):
+        def fail():
+            raise ValueError()
+        pool = TransferPool({"upload": 1})
+        pool.submit("upload", ["a"], fail)
+        pool.submit("upload", ["a"], self.transfer, "after")
+        pool.join()
+        self.assertEqual(self.done, ["after"])
+
+
+if __name__ == "__main__":
+    unittest.main()
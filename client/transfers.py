@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import logging
+import Queue
+
+"""
+Pool of threads running the transfers of the daemon (the requests to the
+server and the local operations applying the server changes), so many
+small files are transferred at once instead of one request at a time.
+Every kind of transfer has its own workers. The transfers of a path run in
+the order they're submitted: a transfer waits for the ones submitted before
+on any of its paths.
+"""
+
+# transfers of every kind running at once
+TRANSFER_WORKERS = {
+    "upload": 4,
+    "download": 4,
+    "delete": 4,
+    "move": 2,
+    "copy": 2,
+}
+
+logger = logging.getLogger('RawBox')
+
+
+class TransferPool(object):
+
+    def __init__(self, workers=TRANSFER_WORKERS):
+        self.lock = threading.Condition()
+        # { path: the transfer submitted last on the path, not done yet }
+        self.last = {}
+        self.running = 0
+        self.queues = {}
+        for kind, count in workers.items():
+            self.queues[kind] = Queue.Queue()
+            for _ in range(count):
+                worker = threading.Thread(
+                    target=self._work, args=(self.queues[kind],))
+                worker.daemon = True
+                worker.start()
+
+    def submit(self, kind, paths, function, *args):
+        """
+        Run function(*args) in a worker of kind, after the transfers submitted
+        before on paths. Return an Event set when it's done
+        """
+        done = threading.Event()
+        with self.lock:
+            after = [self.last[path] for path in paths if path in self.last]
+            for path in paths:
+                self.last[path] = done
+            self.running += 1
+        self.queues[kind].put((paths, after, done, function, args))
+        return done
+
+    def _work(self, queue):
+        while True:
+            paths, after, done, function, args = queue.get()
+            # submitted earlier: they never wait for this one
+            for event in after:
+                event.wait()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("transfer failed: {}".format(paths))
+            done.set()
+            with self.lock:
+                for path in paths:
+                    if self.last.get(path) is done:
+                        del self.last[path]
+                self.running -= 1
+                self.lock.notify_all()
+
+    def join(self):
+        """ Wait for all the transfers submitted """
+        with self.lock:
+            while self.running:
+                self.lock.wait()
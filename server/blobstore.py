@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import hashlib
+import shutil
+import errno
+import fcntl
+import os
+
+"""
+Content-addressable store of the files content.
+
+Every different content is stored once, in a blob named after its sha256:
+    <root>/<first two hex digits>/<sha256>
+The files of the users are hard links to the blobs, so the link count of a
+blob is its reference count: two users uploading the same content, or a
+copy, share the same blob, and removing or overwriting a file just drops a
+reference. A blob with a link count of 1 is referenced only by the store:
+the garbage collector removes it.
+Blobs are never modified in place: a file is overwritten by renaming a new
+link over it. The root has to be on the same filesystem of the users
+directories, otherwise the content is cloned (on filesystems with shared
+extents, as btrfs and xfs) or copied, and not counted as a reference.
+"""
+
+# size of the blocks read while hashing and writing the content
+BLOCK_SIZE = 2 ** 20
+# directory of the store with the uploads being received (named as the
+# shards, but it has only temporary files, skipped by the collector)
+SPOOL_DIRECTORY = "spool"
+# ioctl making a file a copy-on-write clone of another (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def _new_tmp_path(path):
+    return "{}.{}.tmp".format(path, os.urandom(8).encode("hex"))
+
+
+def _reflink(src, dest):
+    """
+    Make dest a clone of src sharing its extents, without copying the
+    content. Raise IOError if the filesystem can't (dest is left empty).
+    """
+    with open(src, "rb") as s:
+        with open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class SpooledBlob(object):
+    """
+    A temporary file of the store, hashed while it's written: the content
+    of an upload is written once, and moved in place by save_spooled.
+    Closed before it's saved, the file is removed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "w+b")
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5()
+        # bytes written
+        self.size = 0
+
+    def write(self, data):
+        self._sha256.update(data)
+        self._md5.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def read(self, *args):
+        return self._file.read(*args)
+
+    def readline(self, *args):
+        return self._file.readline(*args)
+
+    def seek(self, *args):
+        return self._file.seek(*args)
+
+    def tell(self):
+        return self._file.tell()
+
+    def digest(self):
+        """ The sha256 (the key of the blob) and the md5 of the content """
+        return self._sha256.hexdigest(), self._md5.hexdigest()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class BlobStore(object):
+    def __init__(self, root):
+        self.root = root
+
+    def _blob_path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    @staticmethod
+    def digest(file_object):
+        """
+        Return the sha256 (the key of the blob) and the md5 of the content
+        of file_object, reading it once. The file is rewound.
+        """
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        for chunk in iter(lambda: file_object.read(BLOCK_SIZE), b""):
+            sha256.update(chunk)
+            md5.update(chunk)
+        file_object.seek(0)
+        return sha256.hexdigest(), md5.hexdigest()
+
+    @staticmethod
+    def _link(src, dest):
+        """
+        Hard link src to dest. On another filesystem (or with too many
+        links), clone it if the filesystem can, or copy it.
+        """
+        try:
+            os.link(src, dest)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            try:
+                _reflink(src, dest)
+            except (IOError, OSError):
+                shutil.copyfile(src, dest)
+
+    def _new_tmp_blob(self, key):
+        blob = self._blob_path(key)
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return _new_tmp_path(blob)
+
+    def _add_blob(self, key, tmp_blob, tmp_dest):
+        try:
+            # linked to the destination before it's visible as a blob, so
+            # the garbage collector never sees it unreferenced
+            self._link(tmp_blob, tmp_dest)
+            os.rename(tmp_blob, self._blob_path(key))
+        except (IOError, OSError):
+            if os.path.exists(tmp_blob):
+                os.remove(tmp_blob)
+            raise
+
+    def _write_blob(self, key, file_object, tmp_dest):
+        tmp_blob = self._new_tmp_blob(key)
+        with open(tmp_blob, "wb") as f:
+            shutil.copyfileobj(file_object, f, BLOCK_SIZE)
+        self._add_blob(key, tmp_blob, tmp_dest)
+
+    def save(self, key, file_object, dest):
+        """
+        Make dest a reference to the blob key, which has the content of
+        file_object. The content is written only if the blob is not stored
+        yet.
+        """
+        tmp_dest = _new_tmp_path(dest)
+        try:
+            self._link(self._blob_path(key), tmp_dest)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._write_blob(key, file_object, tmp_dest)
+        os.rename(tmp_dest, dest)
+
+    def save_file(self, key, path, dest):
+        """
+        Like save, with the content in the file at path: the file is moved
+        into the store, or removed if the content is already stored.
+        """
+        tmp_dest = _new_tmp_path(dest)
+        try:
+            self._link(self._blob_path(key), tmp_dest)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            tmp_blob = self._new_tmp_blob(key)
+            shutil.move(path, tmp_blob)
+            self._add_blob(key, tmp_blob, tmp_dest)
+        else:
+            os.remove(path)
+        os.rename(tmp_dest, dest)
+
+    def spool(self):
+        """ Return a new SpooledBlob, to write the content of an upload """
+        spool_dir = os.path.join(self.root, SPOOL_DIRECTORY)
+        try:
+            os.makedirs(spool_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return SpooledBlob(_new_tmp_path(os.path.join(spool_dir, "upload")))
+
+    def save_spooled(self, spooled, dest):
+        """ Like save_file, with the content written in spooled """
+        spooled._file.close()
+        key, md5 = spooled.digest()
+        try:
+            self.save_file(key, spooled.path, dest)
+        finally:
+            if os.path.exists(spooled.path):
+                os.remove(spooled.path)
+
+    def copy(self, src, dest):
+        """
+        Copy a file without copying its content: dest is one more
+        reference to the same blob. Errors are the same of shutil.copy.
+        """
+        if os.path.abspath(src) == os.path.abspath(dest):
+            raise shutil.Error(
+                "`{}` and `{}` are the same file".format(src, dest)
+            )
+        tmp_dest = _new_tmp_path(dest)
+        try:
+            self._link(src, tmp_dest)
+        except OSError as e:
+            raise IOError(e.errno, e.strerror, src)
+        os.rename(tmp_dest, dest)
+
+    def collect(self):
+        """
+        Remove the blobs without references. Return how many were removed.
+        """
+        removed = 0
+        try:
+            shards = os.listdir(self.root)
+        except OSError:
+            # nothing stored yet
+            return 0
+        for shard in shards:
+            shard_path = os.path.join(self.root, shard)
+            for name in os.listdir(shard_path):
+                if name.endswith(".tmp"):
+                    # a blob being written
+                    continue
+                blob = os.path.join(shard_path, name)
+                if os.stat(blob).st_nlink == 1:
+                    # if a new link is made meanwhile, the content is safe
+                    # in the linked file: only the deduplication is lost
+                    os.remove(blob)
+                    removed += 1
+        return removed
+
+    def start_collector(self, interval):
+        """
+        Run the garbage collection every interval seconds, in background.
+        """
+        stop = threading.Event()
+
+        def collector():
+            while not stop.wait(interval):
+                self.collect()
+
+        thread = threading.Thread(target=collector)
+        thread.daemon = True
+        thread.start()
+        return stop
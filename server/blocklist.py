@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import tempfile
+import argparse
+import hashlib
+import heapq
+import mmap
+import os
+
+"""
+Blocklist of the passwords not accepted, compiled once from a list of
+words (separated by white spaces, as in password_not_accepted.txt) in a
+sorted file of fixed size records: the first RECORD_SIZE bytes of the md5
+of every word.
+The compiled file is memory mapped and searched by bisection: a lookup
+reads O(log n) records, and the list is never loaded in memory (the pages
+read are cached by the system). To compile a list:
+    python blocklist.py breached_passwords.txt password_not_accepted.bin
+"""
+
+# bytes of the md5 of a word kept in a record: a false positive (an
+# unusual password refused) is unlikely up to billions of words
+RECORD_SIZE = 12
+# words sorted in memory at once while the list is compiled
+BUILD_BATCH = 10 ** 6
+
+
+def _record(word):
+    if isinstance(word, unicode):
+        word = word.encode("utf-8")
+    return hashlib.md5(word).digest()[:RECORD_SIZE]
+
+
+def _write_run(records, directory):
+    run = tempfile.TemporaryFile(dir=directory)
+    for record in sorted(records):
+        run.write(record)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    return iter(lambda: run.read(RECORD_SIZE), b"")
+
+
+def build(source, dest, batch=BUILD_BATCH):
+    """
+    Compile the list of words in the file source in the blocklist dest.
+    Every batch of words is sorted in a temporary file, then the sorted
+    files are merged: the memory used doesn't depend on the length of the
+    list. Return the number of records.
+    """
+    directory = os.path.dirname(os.path.abspath(dest))
+    tmp_dest = "{}.{}.tmp".format(dest, os.getpid())
+    runs = []
+    try:
+        with open(source) as f:
+            records = []
+            for line in f:
+                records.extend(_record(word) for word in line.split())
+                if len(records) >= batch:
+                    runs.append(_write_run(records, directory))
+                    records = []
+            runs.append(_write_run(records, directory))
+
+        count = 0
+        last = None
+        with open(tmp_dest, "wb") as out:
+            for record in heapq.merge(*[_read_run(run) for run in runs]):
+                if record != last:
+                    out.write(record)
+                    count += 1
+                    last = record
+        # the blocklist in use is replaced at once
+        os.rename(tmp_dest, dest)
+    finally:
+        for run in runs:
+            run.close()
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+    return count
+
+
+class Blocklist(object):
+    """ The compiled blocklist at path, read-only: `word in blocklist` """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size % RECORD_SIZE:
+                raise ValueError("{} is not a blocklist".format(path))
+            self.count = size // RECORD_SIZE
+            # an empty file can't be mapped
+            self.records = mmap.mmap(
+                f.fileno(), 0, access=mmap.ACCESS_READ
+            ) if size else b""
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, word):
+        record = _record(word)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * RECORD_SIZE
+            current = self.records[start:start + RECORD_SIZE]
+            if current < record:
+                low = middle + 1
+            elif current > record:
+                high = middle
+            else:
+                return True
+        return False
+
+    def close(self):
+        if self.count:
+            self.records.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compile a list of passwords in a RawBox blocklist"
+    )
+    parser.add_argument("source", help="words separated by white spaces")
+    parser.add_argument("dest", help="the compiled blocklist")
+    args = parser.parse_args()
+    print "{} passwords in {}".format(build(args.source, args.dest), args.dest)
+
+
+if __name__ == "__main__":
+    main()
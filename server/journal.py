@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import json
+import os
+
+"""
+Append-only journal of the metadata mutations.
+
+The journal is a text file with a JSON record on each line. The first line is
+a header with the epoch of the journal: the checkpoint saved with the same
+epoch says which is the last record already included in it, so at restart
+only the records after that one have to be replayed.
+    {"epoch": <epoch>}
+    {"seq": 1, "op": ...}
+    {"seq": 2, "op": ...}
+"""
+
+
+def new_epoch():
+    return os.urandom(8).encode("hex")
+
+
+def _fsync_dir(path):
+    """ Make a rename in the directory of path durable """
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class Journal(object):
+    """
+    Records are appended in memory by append() and written to disk by
+    commit(). When several threads commit at the same time, the first one
+    writes the records of every thread with a single fsync (group commit),
+    while the others wait for it.
+    """
+    def __init__(self, path, epoch, last_seq=0):
+        self.path = path
+        self.epoch = epoch
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        self.pending = []
+        self.last_seq = last_seq
+        self.durable_seq = last_seq
+        self.flushing = False
+        # number of records written since the last checkpoint
+        self.records = 0
+        self.compacting = False
+        self.f = open(path, "ab")
+        if self.f.tell() == 0:
+            self._write_header(self.f)
+
+    def _write_header(self, f):
+        f.write(json.dumps({"epoch": self.epoch}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    @classmethod
+    def open(cls, path, epoch, after_seq, apply_record):
+        """
+        Replay (through apply_record) every record of the journal of this
+        epoch written after after_seq, then return the journal ready to
+        append new records. A journal of another epoch is stale: it's
+        replaced by an empty one. A record broken by a crash, at the end of
+        the file, is discarded.
+        """
+        last_seq = after_seq
+        good_offset = 0
+        try:
+            with open(path, "rb") as f:
+                header = f.readline()
+                if json.loads(header).get("epoch") == epoch:
+                    good_offset = f.tell()
+                    for line in iter(f.readline, b""):
+                        if not line.endswith("\n"):
+                            break
+                        record = json.loads(line)
+                        if record["seq"] > after_seq:
+                            apply_record(record)
+                            last_seq = record["seq"]
+                        good_offset = f.tell()
+        except IOError:
+            # there isn't a journal yet
+            pass
+        except ValueError:
+            # broken header or broken record: keep what was read until here
+            pass
+
+        if good_offset == 0:
+            open(path, "wb").close()
+        else:
+            with open(path, "r+b") as f:
+                f.truncate(good_offset)
+        return cls(path, epoch, last_seq)
+
+    def append(self, record):
+        """ Add a record to the journal. Return its sequence number. """
+        record = dict(record)
+        with self.lock:
+            self.last_seq += 1
+            record["seq"] = self.last_seq
+            self.pending.append(json.dumps(record))
+            return self.last_seq
+
+    def _write_pending(self, batch):
+        self.f.write("".join(line + "\n" for line in batch))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def commit(self, seq=None):
+        """
+        Wait until every record until seq (default: every record appended
+        until now) is on disk.
+        """
+        with self.lock:
+            if seq is None:
+                seq = self.last_seq
+            while self.durable_seq < seq:
+                if self.flushing:
+                    # another thread is writing: maybe our records too
+                    self.flushed.wait()
+                    continue
+                batch, self.pending = self.pending, []
+                batch_seq = self.last_seq
+                self.flushing = True
+                written = False
+                self.lock.release()
+                try:
+                    self._write_pending(batch)
+                    written = True
+                finally:
+                    self.lock.acquire()
+                    self.flushing = False
+                    self.flushed.notify_all()
+                    if not written:
+                        # give the records back to the next writer
+                        self.pending[0:0] = batch
+                self.durable_seq = batch_seq
+                self.records += len(batch)
+
+    def start_compaction(self):
+        """
+        Write every pending record and return the sequence number and the
+        offset of the last one: a checkpoint of the state at this point
+        makes useless the journal until here. Return None if a compaction
+        is already running.
+        """
+        with self.lock:
+            if self.compacting:
+                return None
+            while self.flushing:
+                self.flushed.wait()
+            self._write_pending(self.pending)
+            self.records += len(self.pending)
+            self.pending = []
+            self.durable_seq = self.last_seq
+            self.compacting = True
+            return self.last_seq, self.f.tell()
+
+    def end_compaction(self, offset):
+        """
+        The checkpoint is on disk: rewrite the journal keeping only the
+        records written after offset.
+        """
+        with self.lock:
+            while self.flushing:
+                self.flushed.wait()
+            with open(self.path, "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                self._write_header(f)
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+            _fsync_dir(self.path)
+            self.f.close()
+            self.f = open(self.path, "ab")
+            self.records = tail.count("\n")
+            self.compacting = False
+
+    def abort_compaction(self):
+        with self.lock:
+            self.compacting = False
+
+    def close(self):
+        self.commit()
+        with self.lock:
+            self.f.close()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import contextlib
+import threading
+import hashlib
+import fcntl
+import os
+
+"""
+Locks of the server state.
+
+UserLocks serializes the requests changing the same users, among the
+threads of a process and among the worker processes of the host, and lets
+the requests of different users run in parallel. SharedExclusiveLock lets
+many writers change the metadata in memory at the same time, but not while
+a snapshot of it is being taken.
+"""
+
+# number of locks the users are hashed on (two users on the same slot
+# just wait for each other)
+LOCK_SLOTS = 4096
+
+
+class UserLocks(object):
+    """
+    A lock for each slot: an RLock among the threads of the process and,
+    with a path, a POSIX lock on the byte number slot of that file among
+    the processes. The locks of a request are always taken in the order of
+    their slots, so two requests never wait for each other in a cycle.
+    The file is opened again after a fork: a process doesn't hold the locks
+    of its parent.
+    """
+    def __init__(self, path=None, slots=LOCK_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._open()
+
+    def _open(self):
+        self.guard = threading.Lock()
+        self.locks = {}
+        self.depth = {}
+        self.fd = None
+        if self.path:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.pid = os.getpid()
+
+    def slot(self, key):
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return int(hashlib.md5(key).hexdigest()[:8], 16) % self.slots
+
+    def _acquire(self, slot, blocking):
+        with self.guard:
+            lock = self.locks.get(slot)
+            if lock is None:
+                lock = self.locks[slot] = threading.RLock()
+        if not lock.acquire(blocking):
+            return False
+        if self.fd is not None and not self.depth.get(slot):
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.lockf(self.fd, flags, 1, slot)
+            except IOError:
+                lock.release()
+                return False
+        self.depth[slot] = self.depth.get(slot, 0) + 1
+        return True
+
+    def _release(self, slot):
+        self.depth[slot] -= 1
+        if self.fd is not None and not self.depth[slot]:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, slot)
+        self.locks[slot].release()
+
+    def acquire(self, keys, blocking=True):
+        """
+        Take the locks of every key. Return the slots taken (to release),
+        or None if blocking is False and a lock is held by someone else.
+        """
+        if self.pid != os.getpid():
+            # forked: the locks held by the parent are not held here
+            if self.fd is not None:
+                os.close(self.fd)
+            self._open()
+        taken = []
+        for slot in sorted(set(self.slot(key) for key in keys)):
+            if not self._acquire(slot, blocking):
+                self.release(taken)
+                return None
+            taken.append(slot)
+        return taken
+
+    def release(self, slots):
+        for slot in reversed(slots):
+            self._release(slot)
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        slots = self.acquire(keys)
+        try:
+            yield
+        finally:
+            self.release(slots)
+
+
+class SharedExclusiveLock(object):
+    """
+    Held by any number of threads in shared mode, or by one in exclusive
+    mode. A thread waiting for the exclusive mode is served before the new
+    shared ones, so a snapshot is never delayed forever.
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.shared_holders = 0
+        self.exclusive_holder = False
+        self.exclusive_waiting = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self.condition:
+            while self.exclusive_holder or self.exclusive_waiting:
+                self.condition.wait()
+            self.shared_holders += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.shared_holders -= 1
+                if not self.shared_holders:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self.condition:
+            self.exclusive_waiting += 1
+            while self.exclusive_holder or self.shared_holders:
+                self.condition.wait()
+            self.exclusive_waiting -= 1
+            self.exclusive_holder = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.exclusive_holder = False
+                self.condition.notify_all()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import smtplib
+import socket
+import Queue
+import time
+
+"""
+Delivery of the mails in background.
+
+A request sending a mail only puts it in a bounded queue: a thread sends
+the queued messages through one SMTP connection, opened at the first
+message and kept open while the messages keep coming (it's closed after
+MAIL_IDLE_TIMEOUT seconds without messages). A message which can't be
+sent is retried MAIL_RETRIES times, on a new connection, waiting twice as
+long every time.
+"""
+
+# messages waiting to be sent, at most
+MAIL_QUEUE_SIZE = 1000
+# seconds a request waits for room in a full queue
+MAIL_QUEUE_TIMEOUT = 1
+# attempts to send a message after the first one
+MAIL_RETRIES = 3
+# seconds before the first retry (doubled at every retry)
+MAIL_RETRY_DELAY = 2
+# seconds without messages after which the connection is closed
+MAIL_IDLE_TIMEOUT = 30
+
+# errors of a connection to the SMTP server: it's opened again
+SMTP_ERRORS = (smtplib.SMTPException, socket.error)
+
+
+class MailQueueFull(Exception):
+    pass
+
+
+class MailQueue(object):
+    """
+    Messages of Flask-Mail sent by a daemon thread, with the mail settings
+    of the Flask application app (given by Mail(app)).
+    """
+    def __init__(self, mail, app, size=MAIL_QUEUE_SIZE,
+                 retries=MAIL_RETRIES, retry_delay=MAIL_RETRY_DELAY,
+                 idle_timeout=MAIL_IDLE_TIMEOUT):
+        self.mail = mail
+        self.app = app
+        self.queue = Queue.Queue(size)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.connection = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._deliver)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, message, timeout=MAIL_QUEUE_TIMEOUT):
+        """
+        Queue a message to be sent. Raise MailQueueFull if it's still full
+        after timeout seconds.
+        """
+        try:
+            self.queue.put(message, timeout=timeout)
+        except Queue.Full:
+            raise MailQueueFull()
+
+    def join(self):
+        """ Wait until every message queued is sent (or dropped) """
+        self.queue.join()
+
+    def stop(self):
+        """ Send the messages queued, then stop the thread """
+        self.queue.put(None)
+        self.thread.join()
+
+    def _connect(self):
+        if self.connection is None:
+            connection = self.mail.connect()
+            # kept only if it's open: a refused one has nothing to close
+            connection.__enter__()
+            self.connection = connection
+        return self.connection
+
+    def _disconnect(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except SMTP_ERRORS:
+                # already closed by the server
+                pass
+
+    def _send(self, message):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                self._connect().send(message)
+                return True
+            except SMTP_ERRORS as e:
+                # the connection is not reliable anymore
+                self._disconnect()
+                error = e
+        self.app.logger.error(
+            "mail to %s not sent: %s", ", ".join(message.recipients), error
+        )
+        return False
+
+    def _deliver(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    message = self.queue.get(timeout=self.idle_timeout)
+                except Queue.Empty:
+                    self._disconnect()
+                    continue
+                try:
+                    if message is None:
+                        self._disconnect()
+                        return
+                    self._send(message)
+                except Exception:
+                    # a malformed message: the others are sent anyway
+                    self.app.logger.exception("mail not sent")
+                finally:
+                    self.queue.task_done()
@@ -0,0 +1,885 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import threading
+import bisect
+import sqlite3
+import json
+import os
+
+from journal import Journal, new_epoch
+from locks import SharedExclusiveLock
+
+"""
+Metadata stores of the server: users, paths and shares.
+
+Every store gives the same interface to User:
+    · load() returns { username : {"psw", "timestamp", "paths"} }
+      where paths is a mapping
+      { client_path : [server_path, md5, timestamp, size] }
+      (the size of the paths saved by the older versions may be missing)
+    · shares is a mapping { server_path : [owner, ben1, ben2, ...] }
+    · usage(username, directory) is the (bytes, files) stored by the user in
+      a directory, kept up to date at every change of a path
+    · the changes are done by the store methods and made durable by commit()
+
+DictStore keeps everything in dictionaries, saved in a JSON checkpoint and a
+journal. SQLiteStore keeps everything in indexed tables of a SQLite database.
+"""
+
+# records in the journal after which the checkpoint is rewritten
+JOURNAL_COMPACTION_RECORDS = 10000
+
+
+def _is_under(path, directory):
+    """ True if path is the directory itself or something inside it """
+    return directory == "" or path == directory or \
+        path.startswith(directory + "/")
+
+
+def _ancestors(path):
+    """ Generate path and its parent directories, from the nearest one """
+    while path:
+        yield path
+        path = os.path.dirname(path)
+
+
+def _directories_of(client_path):
+    """ The directories containing client_path, up to the user's root "" """
+    return list(_ancestors(os.path.dirname(client_path))) + [""]
+
+
+def _counted(file_meta):
+    """
+    The (bytes, files) a path adds to the usage of its directories: only
+    the files of known size are counted.
+    """
+    if file_meta is None or file_meta[1] is None or len(file_meta) < 4 \
+            or file_meta[3] is None:
+        return 0, 0
+    return file_meta[3], 1
+
+
+class DictStore(object):
+    """
+    The whole metadata in memory. users_data is a checkpoint: every later
+    change is appended to the journal, which is replayed at restart.
+    The same indexes of SQLiteStore are kept in memory: the shares of every
+    owner and beneficiary, the sorted paths of the users (built at the
+    first range lookup of the user) and the usage of their directories.
+    """
+    def __init__(self, users_data, journal_path):
+        self.users_data = users_data
+        self.journal_path = journal_path
+        self.users = {}
+        self.shares = {}
+        # { owner : set(server_path) }, { beneficiary : set(server_path) }
+        self.owned = {}
+        self.granted = {}
+        # { username : sorted list of its client paths }
+        self.sorted_paths = {}
+        # { username : { directory : [bytes, files] } }
+        self.usages = {}
+        # a path is added to the dictionary and to the indexes at once
+        self.index_lock = threading.Lock()
+        self.journal = None
+        # the changes are made in shared mode, the snapshots of the whole
+        # metadata in exclusive mode: a snapshot is never taken while a
+        # change is in the dictionaries but not in the journal yet
+        self.lock = SharedExclusiveLock()
+
+    def load(self):
+        try:
+            ud = open(self.users_data, "r")
+            saved = json.load(ud)
+            ud.close()
+        except IOError:
+            # The json file is not present. It will be created a new structure
+            # from scratch.
+            saved = {"users": {}}
+        # If the json file is corrupted, it will be raised a ValueError here.
+        # In that case, please remove the corrupted file.
+        self.users = saved["users"]
+        self.shares = saved.get("shares", {})
+
+        checkpoint = saved.get("journal")
+        if not checkpoint:
+            # there isn't a journal for this data: start a new one
+            checkpoint = {"epoch": new_epoch(), "seq": 0}
+            self.save(checkpoint=checkpoint)
+        self.journal = Journal.open(
+            self.journal_path,
+            checkpoint["epoch"],
+            checkpoint["seq"],
+            self._apply_record
+        )
+        self._index_shares()
+        self.sorted_paths = {}
+        self.usages = {}
+        for username, data in self.users.iteritems():
+            usage = self.usages[username] = {}
+            for client_path, file_meta in data["paths"].iteritems():
+                self._count(usage, client_path, file_meta, 1)
+        return self.users
+
+    def _index_shares(self):
+        self.owned = {}
+        self.granted = {}
+        for server_path, bens in self.shares.iteritems():
+            self.owned.setdefault(bens[0], set()).add(server_path)
+            for ben in bens[1:]:
+                self.granted.setdefault(ben, set()).add(server_path)
+
+    def _apply_record(self, record):
+        """
+        Redo a change read from the journal.
+        """
+        op = record["op"]
+        if op == "user":
+            self.users[record["user"]] = record["data"]
+        elif op == "del_user":
+            self.users.pop(record["user"], None)
+        elif op == "path":
+            self.users[record["user"]]["paths"][record["path"]] = \
+                record["meta"]
+        elif op == "rm_path":
+            self.users[record["user"]]["paths"].pop(record["path"], None)
+        elif op == "timestamp":
+            self.users[record["user"]]["timestamp"] = record["timestamp"]
+        elif op == "add_ben":
+            bens = self.shares.setdefault(record["path"], [record["owner"]])
+            if record["ben"] not in bens[1:]:
+                bens.append(record["ben"])
+        elif op == "rm_ben":
+            self.shares[record["path"]].remove(record["ben"])
+        elif op == "rm_share":
+            self.shares.pop(record["path"], None)
+
+    @staticmethod
+    def _write(filename, to_save):
+        # write a new file and then replace the old one, so a crash never
+        # leaves a broken checkpoint
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(to_save, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_filename, filename)
+
+    def save(self, filename=None, checkpoint=None):
+        """ Write the whole metadata in filename (default: users_data) """
+        to_save = {
+            "users": self.users,
+            "shares": self.shares
+        }
+        if checkpoint:
+            to_save["journal"] = checkpoint
+        with self.lock.exclusive():
+            self._write(filename or self.users_data, to_save)
+
+    def log(self, **record):
+        """
+        Append a change to the journal. It will be on disk after commit().
+        """
+        if self.journal:
+            self.journal.append(record)
+
+    def commit(self):
+        """
+        Make the logged changes durable. Concurrent commits share the same
+        fsync; when the journal is long enough it's compacted in background.
+        """
+        if not self.journal:
+            self.save()
+            return
+        self.journal.commit()
+        if self.journal.records >= JOURNAL_COMPACTION_RECORDS:
+            self.compact()
+
+    def compact(self):
+        """
+        Start the background compaction of the journal into the checkpoint.
+        Return the thread doing it, or None if a compaction is running yet.
+        """
+        journal = self.journal
+        with self.lock.exclusive():
+            started = journal.start_compaction()
+            if not started:
+                return None
+            seq, offset = started
+
+            # copy the structure now (the paths values are never changed in
+            # place), the serialization and the writes are done in background
+            users = {}
+            for u, v in self.users.iteritems():
+                users[u] = dict(v, paths=dict(v["paths"]))
+            shares = dict(
+                (path, list(bens)) for path, bens in self.shares.iteritems()
+            )
+        to_save = {
+            "users": users,
+            "shares": shares,
+            "journal": {"epoch": journal.epoch, "seq": seq}
+        }
+
+        def checkpoint(filename):
+            try:
+                self._write(filename, to_save)
+            except (IOError, OSError):
+                journal.abort_compaction()
+                raise
+            journal.end_compaction(offset)
+
+        thread = threading.Thread(target=checkpoint, args=(self.users_data,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def end(self):
+        """ The changes are made at once: no transaction is left open """
+        pass
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    # USERS
+    def add_user(self, username, psw, timestamp):
+        """ Create a new user. Return its paths mapping. """
+        data = {"psw": psw, "timestamp": timestamp, "paths": {}}
+        with self.lock.shared():
+            self.users[username] = data
+            self.sorted_paths.pop(username, None)
+            self.usages[username] = {}
+            self.log(op="user", user=username, data=data)
+        return data["paths"]
+
+    def del_user(self, username):
+        with self.lock.shared():
+            del self.users[username]
+            self.sorted_paths.pop(username, None)
+            self.usages.pop(username, None)
+            self.log(op="del_user", user=username)
+
+    def set_timestamp(self, username, timestamp):
+        with self.lock.shared():
+            self.users[username]["timestamp"] = timestamp
+            self.log(op="timestamp", user=username, timestamp=timestamp)
+
+    # PATHS
+    @staticmethod
+    def _count(usage, client_path, file_meta, sign):
+        size, files = _counted(file_meta)
+        if not files:
+            return
+        for directory in _directories_of(client_path):
+            counters = usage.setdefault(directory, [0, 0])
+            counters[0] += sign * size
+            counters[1] += sign * files
+
+    def set_path(self, username, client_path, file_meta):
+        with self.lock.shared():
+            paths = self.users[username]["paths"]
+            with self.index_lock:
+                ordered = self.sorted_paths.get(username)
+                if ordered is not None and client_path not in paths:
+                    bisect.insort(ordered, client_path)
+                usage = self.usages[username]
+                self._count(usage, client_path, paths.get(client_path), -1)
+                self._count(usage, client_path, file_meta, 1)
+                paths[client_path] = file_meta
+            self.log(
+                op="path", user=username, path=client_path, meta=file_meta
+            )
+
+    def del_path(self, username, client_path):
+        with self.lock.shared():
+            with self.index_lock:
+                file_meta = self.users[username]["paths"].pop(client_path)
+                self._count(
+                    self.usages[username], client_path, file_meta, -1
+                )
+                ordered = self.sorted_paths.get(username)
+                if ordered is not None:
+                    del ordered[bisect.bisect_left(ordered, client_path)]
+            self.log(op="rm_path", user=username, path=client_path)
+
+    def drop_shared_copies(self):
+        """
+        Remove the paths of the users outside their own directories: the
+        copies of the resources shared with them, kept before the shares
+        were mounted. Return how many paths were removed.
+        """
+        removed = 0
+        for username, data in self.users.iteritems():
+            for client_path, file_meta in data["paths"].items():
+                if not _is_under(file_meta[0], username):
+                    self.del_path(username, client_path)
+                    removed += 1
+        return removed
+
+    def unsized_files(self):
+        """
+        Return [(username, client_path, file_meta)] of the files saved
+        without their size.
+        """
+        return [
+            (username, client_path, file_meta)
+            for username, data in self.users.iteritems()
+            for client_path, file_meta in data["paths"].iteritems()
+            if file_meta[1] is not None and
+            (len(file_meta) < 4 or file_meta[3] is None)
+        ]
+
+    def usage(self, username, directory=""):
+        """ Return (bytes, files) stored by the user in directory """
+        with self.index_lock:
+            return tuple(self.usages[username].get(directory, (0, 0)))
+
+    def files(self, username):
+        """ Generate (client_path, md5, timestamp) of every user's file """
+        for p, v in self.users[username]["paths"].iteritems():
+            if v[1] is not None:
+                yield p, v[1], v[2]
+
+    def paths_under(self, username, client_path):
+        """
+        Return [(path, file_meta)] of client_path and its content: a range
+        of the sorted paths of the user, as in SQLiteStore.
+        """
+        paths = self.users[username]["paths"]
+        if client_path == "":
+            return paths.items()
+        with self.index_lock:
+            ordered = self.sorted_paths.get(username)
+            if ordered is None:
+                ordered = self.sorted_paths[username] = sorted(paths)
+            # "0" is the character after "/"
+            start = bisect.bisect_left(ordered, client_path + "/")
+            end = bisect.bisect_left(ordered, client_path + "0", start)
+            under = [(p, paths[p]) for p in ordered[start:end]]
+            if client_path in paths:
+                under.insert(0, (client_path, paths[client_path]))
+        return under
+
+    # SHARES
+    def add_beneficiary(self, server_path, owner, beneficiary):
+        """ Sharing again with a beneficiary changes nothing """
+        with self.lock.shared():
+            bens = self.shares.setdefault(server_path, [owner])
+            if beneficiary in bens[1:]:
+                return
+            bens.append(beneficiary)
+            self.owned.setdefault(owner, set()).add(server_path)
+            self.granted.setdefault(beneficiary, set()).add(server_path)
+            self.log(
+                op="add_ben", path=server_path, owner=owner, ben=beneficiary
+            )
+
+    def remove_beneficiary(self, server_path, beneficiary):
+        """
+        Raise KeyError if the resource is not shared, ValueError if it's not
+        shared with the beneficiary. The share without beneficiaries is
+        removed.
+        """
+        with self.lock.shared():
+            bens = self.shares[server_path]
+            bens.remove(beneficiary)
+            self.granted[beneficiary].discard(server_path)
+            self.log(op="rm_ben", path=server_path, ben=beneficiary)
+            if len(bens) == 1:
+                # the first user in the list is the owner
+                self._del_share(server_path)
+
+    def del_share(self, server_path):
+        with self.lock.shared():
+            self._del_share(server_path)
+
+    def _del_share(self, server_path):
+        bens = self.shares.pop(server_path)
+        self.owned[bens[0]].discard(server_path)
+        for ben in bens[1:]:
+            self.granted[ben].discard(server_path)
+        self.log(op="rm_share", path=server_path)
+
+    def share_of(self, server_path):
+        """
+        Return the nearest shared resource containing server_path (or the
+        resource itself), None if it's not shared. Only the parents of
+        server_path are looked up, not every share.
+        """
+        for path in _ancestors(server_path):
+            if path in self.shares:
+                return path
+        return None
+
+    def shares_of(self, username):
+        """
+        Return the server paths shared by the user and the list of
+        (owner, server_path) shared with the user. Only the shares of the
+        user are read, by the indexes.
+        """
+        # the sets are copied at once: they can change meanwhile
+        owned = list(self.owned.get(username, ()))
+        granted = []
+        for path in list(self.granted.get(username, ())):
+            bens = self.shares.get(path)
+            if bens:
+                granted.append((bens[0], path))
+        return owned, granted
+
+
+class _SQLitePaths(collections.Mapping):
+    """ Read-only view of a user's paths in the database """
+    def __init__(self, store, username):
+        self.store = store
+        self.username = username
+
+    def __getitem__(self, client_path):
+        row = self.store.query_one(
+            "SELECT server_path, md5, timestamp, size FROM paths "
+            "WHERE username = ? AND client_path = ?",
+            (self.username, client_path)
+        )
+        if row is None:
+            raise KeyError(client_path)
+        return list(row)
+
+    def __contains__(self, client_path):
+        return self.store.query_one(
+            "SELECT 1 FROM paths WHERE username = ? AND client_path = ?",
+            (self.username, client_path)
+        ) is not None
+
+    def __iter__(self):
+        rows = self.store.query(
+            "SELECT client_path FROM paths WHERE username = ?",
+            (self.username,)
+        )
+        return (row[0] for row in rows)
+
+    def __len__(self):
+        return self.store.query_one(
+            "SELECT COUNT(*) FROM paths WHERE username = ?", (self.username,)
+        )[0]
+
+
+class _SQLiteShares(collections.Mapping):
+    """ Read-only view of the shares in the database """
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, server_path):
+        row = self.store.query_one(
+            "SELECT owner FROM shares WHERE server_path = ?", (server_path,)
+        )
+        if row is None:
+            raise KeyError(server_path)
+        bens = self.store.query(
+            "SELECT beneficiary FROM grants WHERE server_path = ? "
+            "ORDER BY rowid",
+            (server_path,)
+        )
+        return [row[0]] + [ben[0] for ben in bens]
+
+    def __iter__(self):
+        rows = self.store.query("SELECT server_path FROM shares")
+        return (row[0] for row in rows)
+
+    def __len__(self):
+        return self.store.query_one("SELECT COUNT(*) FROM shares")[0]
+
+
+class SQLiteStore(object):
+    """
+    The metadata in a SQLite database, with an index for every lookup done
+    by the server: no request has to read every path of a user or every
+    share of the server.
+    Every thread has its own connection, so the changes of a request are
+    committed (or lost) only with it, and they're never read by the others
+    before. A thread holds the lock from its first change to its commit:
+    the transactions of the threads never wait for each other in SQLite.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            psw TEXT NOT NULL,
+            timestamp REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS paths (
+            username TEXT NOT NULL,
+            client_path TEXT NOT NULL,
+            server_path TEXT NOT NULL,
+            md5 TEXT,
+            timestamp REAL NOT NULL,
+            size INTEGER,
+            PRIMARY KEY (username, client_path)
+        );
+        CREATE INDEX IF NOT EXISTS paths_by_md5 ON paths (username, md5);
+        CREATE TABLE IF NOT EXISTS usage (
+            username TEXT NOT NULL,
+            directory TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            files INTEGER NOT NULL,
+            PRIMARY KEY (username, directory)
+        );
+        CREATE TABLE IF NOT EXISTS shares (
+            server_path TEXT PRIMARY KEY,
+            owner TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS shares_by_owner ON shares (owner);
+        CREATE TABLE IF NOT EXISTS grants (
+            server_path TEXT NOT NULL,
+            beneficiary TEXT NOT NULL,
+            PRIMARY KEY (server_path, beneficiary)
+        );
+        CREATE INDEX IF NOT EXISTS grants_by_beneficiary
+            ON grants (beneficiary);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        # [(thread, its connection)]
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        # the connection watching the commits of the others (see changed)
+        self.watcher = self._connect()
+        self.watcher.execute("PRAGMA journal_mode=WAL")
+        with self.lock:
+            self.watcher.executescript(self.SCHEMA)
+        columns = [
+            row[1] for row in self.watcher.execute("PRAGMA table_info(paths)")
+        ]
+        if "size" not in columns:
+            # a database of an older version: the sizes are added later
+            # (see unsized_files)
+            self.watcher.execute("ALTER TABLE paths ADD COLUMN size INTEGER")
+            self.watcher.commit()
+        self.shares = _SQLiteShares(self)
+        self.data_version = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def conn(self):
+        """ The connection of the thread """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+            with self.connections_lock:
+                # the connections of the threads ended are closed
+                for thread, other in self.connections:
+                    if not thread.is_alive():
+                        other.close()
+                self.connections = [
+                    (thread, other) for thread, other in self.connections
+                    if thread.is_alive()
+                ]
+                self.connections.append((threading.current_thread(), conn))
+        return conn
+
+    def _begin(self):
+        """ The thread is going to change something: the lock is held """
+        if not getattr(self.local, "writing", False):
+            self.lock.acquire()
+            self.local.writing = True
+
+    @contextlib.contextmanager
+    def reading(self):
+        """ The queries made meanwhile read the same version of the data """
+        if getattr(self.local, "writing", False):
+            # in the transaction of the thread, holding the lock
+            yield
+            return
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        finally:
+            self.conn.rollback()
+
+    def query(self, sql, args=()):
+        return self.conn.execute(sql, args).fetchall()
+
+    def query_one(self, sql, args=()):
+        return self.conn.execute(sql, args).fetchone()
+
+    def execute(self, sql, args=()):
+        self._begin()
+        return self.conn.execute(sql, args).rowcount
+
+    def insert(self, sql, args=()):
+        """ Execute an INSERT, return the rowid of the new row """
+        self._begin()
+        return self.conn.execute(sql, args).lastrowid
+
+    def add_schema(self, schema):
+        """ Create the tables of another component sharing the database """
+        with self.lock:
+            self.watcher.executescript(schema)
+
+    def changed(self):
+        """
+        True if another connection (e.g. another worker process, or another
+        thread) committed a change since the last call: what was read
+        before may be old.
+        """
+        with self.connections_lock:
+            version = self.watcher.execute(
+                "PRAGMA data_version"
+            ).fetchone()[0]
+            changed = version != self.data_version
+            self.data_version = version
+            return changed
+
+    def load(self):
+        users = {}
+        for username, psw, timestamp in self.query(
+                "SELECT username, psw, timestamp FROM users"):
+            users[username] = {
+                "psw": psw,
+                "timestamp": timestamp,
+                "paths": _SQLitePaths(self, username)
+            }
+        return users
+
+    def import_metadata(self, users, shares):
+        """
+        Copy into the database users loaded by another store and its
+        shares (e.g. the first time the server starts with SQLite).
+        """
+        with self.lock:
+            for username, data in users.iteritems():
+                self.add_user(username, data["psw"], data["timestamp"])
+                for client_path, file_meta in data["paths"].iteritems():
+                    self.set_path(username, client_path, file_meta)
+            for server_path, bens in shares.iteritems():
+                for ben in bens[1:]:
+                    self.add_beneficiary(server_path, bens[0], ben)
+            self.commit()
+
+    def after_commit(self, callback, *args):
+        """ Call callback(*args) once the changes of the thread are saved """
+        if not getattr(self.local, "writing", False):
+            callback(*args)
+            return
+        if not hasattr(self.local, "committed"):
+            self.local.committed = []
+        self.local.committed.append((callback, args))
+
+    def commit(self):
+        self.conn.commit()
+        if getattr(self.local, "writing", False):
+            self.local.writing = False
+            self.lock.release()
+        # out of the lock: a callback can wait for the other writers
+        committed, self.local.committed = \
+            getattr(self.local, "committed", []), []
+        for callback, args in committed:
+            callback(*args)
+
+    def end(self):
+        """ Commit the changes left by the thread (e.g. a request failed) """
+        if getattr(self.local, "writing", False):
+            self.commit()
+
+    def close(self):
+        self.end()
+        with self.connections_lock:
+            for thread, conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.watcher.close()
+        self.local = threading.local()
+
+    # USERS
+    def add_user(self, username, psw, timestamp):
+        self.execute(
+            "INSERT INTO users (username, psw, timestamp) VALUES (?, ?, ?)",
+            (username, psw, timestamp)
+        )
+        return _SQLitePaths(self, username)
+
+    def del_user(self, username):
+        with self.lock:
+            self.execute("DELETE FROM paths WHERE username = ?", (username,))
+            self.execute("DELETE FROM usage WHERE username = ?", (username,))
+            self.execute("DELETE FROM users WHERE username = ?", (username,))
+
+    def set_timestamp(self, username, timestamp):
+        self.execute(
+            "UPDATE users SET timestamp = ? WHERE username = ?",
+            (timestamp, username)
+        )
+
+    # PATHS
+    def _old_meta(self, username, client_path):
+        row = self.query_one(
+            "SELECT server_path, md5, timestamp, size FROM paths "
+            "WHERE username = ? AND client_path = ?",
+            (username, client_path)
+        )
+        return row and list(row)
+
+    def _count(self, username, client_path, file_meta, sign):
+        size, files = _counted(file_meta)
+        if not files:
+            return
+        for directory in _directories_of(client_path):
+            self.execute(
+                "INSERT OR IGNORE INTO usage (username, directory, bytes, "
+                "files) VALUES (?, ?, 0, 0)",
+                (username, directory)
+            )
+            self.execute(
+                "UPDATE usage SET bytes = bytes + ?, files = files + ? "
+                "WHERE username = ? AND directory = ?",
+                (sign * size, sign * files, username, directory)
+            )
+
+    def set_path(self, username, client_path, file_meta):
+        server_path, md5, timestamp = file_meta[:3]
+        size = file_meta[3] if len(file_meta) > 3 else None
+        with self.lock:
+            self._count(
+                username, client_path, self._old_meta(username, client_path),
+                -1
+            )
+            self._count(username, client_path, file_meta, 1)
+            self.execute(
+                "INSERT OR REPLACE INTO paths "
+                "(username, client_path, server_path, md5, timestamp, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (username, client_path, server_path, md5, timestamp, size)
+            )
+
+    def del_path(self, username, client_path):
+        with self.lock:
+            file_meta = self._old_meta(username, client_path)
+            if file_meta is None:
+                raise KeyError(client_path)
+            self._count(username, client_path, file_meta, -1)
+            self.execute(
+                "DELETE FROM paths WHERE username = ? AND client_path = ?",
+                (username, client_path)
+            )
+
+    def drop_shared_copies(self):
+        return self.execute(
+            "DELETE FROM paths WHERE server_path != username "
+            "AND substr(server_path, 1, length(username) + 1) "
+            "!= username || '/'"
+        )
+
+    def unsized_files(self):
+        return [
+            (row[0], row[1], list(row[2:]) + [None]) for row in self.query(
+                "SELECT username, client_path, server_path, md5, timestamp "
+                "FROM paths WHERE md5 IS NOT NULL AND size IS NULL"
+            )
+        ]
+
+    def usage(self, username, directory=""):
+        row = self.query_one(
+            "SELECT bytes, files FROM usage "
+            "WHERE username = ? AND directory = ?",
+            (username, directory)
+        )
+        return tuple(row) if row else (0, 0)
+
+    def files(self, username):
+        return self.query(
+            "SELECT client_path, md5, timestamp FROM paths "
+            "WHERE username = ? AND md5 IS NOT NULL",
+            (username,)
+        )
+
+    def paths_under(self, username, client_path):
+        if client_path == "":
+            rows = self.query(
+                "SELECT client_path, server_path, md5, timestamp, size "
+                "FROM paths WHERE username = ?",
+                (username,)
+            )
+        else:
+            # "0" is the character after "/": a range scan of the index
+            rows = self.query(
+                "SELECT client_path, server_path, md5, timestamp, size "
+                "FROM paths WHERE username = ? AND (client_path = ? "
+                "OR (client_path >= ? AND client_path < ?))",
+                (username, client_path, client_path + "/", client_path + "0")
+            )
+        return [(row[0], list(row[1:])) for row in rows]
+
+    # SHARES
+    def add_beneficiary(self, server_path, owner, beneficiary):
+        """ Sharing again with a beneficiary changes nothing """
+        with self.lock:
+            self.execute(
+                "INSERT OR IGNORE INTO shares (server_path, owner) "
+                "VALUES (?, ?)",
+                (server_path, owner)
+            )
+            self.execute(
+                "INSERT OR IGNORE INTO grants (server_path, beneficiary) "
+                "VALUES (?, ?)",
+                (server_path, beneficiary)
+            )
+
+    def remove_beneficiary(self, server_path, beneficiary):
+        with self.lock:
+            if server_path not in self.shares:
+                raise KeyError(server_path)
+            if not self.execute(
+                    "DELETE FROM grants "
+                    "WHERE server_path = ? AND beneficiary = ?",
+                    (server_path, beneficiary)):
+                raise ValueError(beneficiary)
+            if self.query_one(
+                    "SELECT 1 FROM grants WHERE server_path = ?",
+                    (server_path,)) is None:
+                self.del_share(server_path)
+
+    def del_share(self, server_path):
+        with self.lock:
+            if not self.execute(
+                    "DELETE FROM shares WHERE server_path = ?",
+                    (server_path,)):
+                raise KeyError(server_path)
+            self.execute(
+                "DELETE FROM grants WHERE server_path = ?", (server_path,)
+            )
+
+    def share_of(self, server_path):
+        parents = list(_ancestors(server_path))
+        if not parents:
+            return None
+        row = self.query_one(
+            "SELECT server_path FROM shares WHERE server_path IN ({}) "
+            "ORDER BY length(server_path) DESC LIMIT 1".format(
+                ", ".join("?" * len(parents))
+            ),
+            parents
+        )
+        return row[0] if row else None
+
+    def shares_of(self, username):
+        owned = [
+            row[0] for row in self.query(
+                "SELECT server_path FROM shares WHERE owner = ?", (username,)
+            )
+        ]
+        granted = self.query(
+            "SELECT shares.owner, shares.server_path FROM grants "
+            "JOIN shares ON shares.server_path = grants.server_path "
+            "WHERE grants.beneficiary = ?",
+            (username,)
+        )
+        return owned, [tuple(row) for row in granted]
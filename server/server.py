@@ -5,25 +5,59 @@ from flask.ext.restful import reqparse, abort, Api, Resource
 from flask.ext.mail import Mail, Message
 from passlib.hash import sha256_crypt
 from flask.ext.httpauth import HTTPBasicAuth
-from flask import Flask, request
+from flask import Flask, Request, Response, request, g
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date
 import passwordmeter
 import ConfigParser
+import collections
+import contextlib
+import functools
+import threading
 import hashlib
 import shutil
 import time
 import json
 import os
 
+from metadata import DictStore, SQLiteStore
+from blobstore import BlobStore
+from uploads import UploadSessions
+from locks import UserLocks
+from mailer import MailQueue, MailQueueFull
+import blocklist
+
 
 HTTP_OK = 200
 HTTP_CREATED = 201
+HTTP_PARTIAL_CONTENT = 206
 HTTP_BAD_REQUEST = 400
 HTTP_FORBIDDEN = 403
 HTTP_NOT_FOUND = 404
 HTTP_NOT_ACCEPTABLE = 406
 HTTP_CONFLICT = 409
+HTTP_GONE = 410
+HTTP_REQUEST_ENTITY_TOO_LARGE = 413
+HTTP_RANGE_NOT_SATISFIABLE = 416
+HTTP_SERVICE_UNAVAILABLE = 503
+
+
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        """ A file sent to Files is written straight in the blob store and
+        hashed while it's received: the upload is read and written once """
+        if self.endpoint == "files":
+            return blobs.spool()
+        return Request._get_file_stream(
+            self, total_content_length, content_type, filename,
+            content_length
+        )
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 api = Api(app)
 auth = HTTPBasicAuth()
 _API_PREFIX = "/API/v1/"
@@ -31,11 +65,45 @@ _API_PREFIX = "/API/v1/"
 SERVER_ROOT = os.path.dirname(__file__)
 USERS_DIRECTORIES = os.path.join(SERVER_ROOT, "user_dirs/")
 USERS_DATA = os.path.join(SERVER_ROOT, "user_data.json")
+USERS_JOURNAL = os.path.join(SERVER_ROOT, "user_data.journal")
+USERS_DB = os.path.join(SERVER_ROOT, "user_data.db")
+# content of the files, shared by every user (same filesystem of
+# USERS_DIRECTORIES: the users' files are hard links to the blobs)
+BLOBS_DIRECTORY = os.path.join(SERVER_ROOT, "blobs/")
+# chunks of the upload sessions not committed yet
+UPLOADS_DIRECTORY = os.path.join(SERVER_ROOT, "uploads/")
+# lock file of the users, shared by the worker processes
+STATE_LOCK = os.path.join(SERVER_ROOT, ".state.lock")
 
 PENDING_USERS = os.path.join(SERVER_ROOT, ".pending.tmp")
 CORRUPTED_DATA = os.path.join(SERVER_ROOT, "corrupted_data.json")
 EMAIL_SETTINGS_INI = os.path.join(SERVER_ROOT, "email_settings.ini")
 PASSWORD_NOT_ACCEPTED_DATA = os.path.join(SERVER_ROOT, "password_not_accepted.txt")
+# PASSWORD_NOT_ACCEPTED_DATA compiled by blocklist.py (again when the list
+# is newer)
+PASSWORD_BLOCKLIST = os.path.join(SERVER_ROOT, "password_not_accepted.bin")
+
+# lifetime (in seconds) of a session token and max number of live tokens
+TOKEN_TTL = 60 * 60
+TOKEN_CACHE_SIZE = 10000
+
+# changes of the files kept in memory for every user by the change feed
+CHANGES_PER_USER = 1000
+# max seconds a GET changes waits for a change (long poll)
+LONG_POLL_TIMEOUT = 60
+# seconds between two checks of the shared change feed by a long poll (the
+# changes made by the other worker processes don't wake it up)
+LONG_POLL_INTERVAL = 1
+
+# seconds between two garbage collections of the unreferenced blobs
+BLOBS_GC_INTERVAL = 60 * 60
+
+# size of the blocks sent for a range of a file
+DOWNLOAD_BLOCK_SIZE = 2 ** 16
+
+# bytes every user can store (None: no limit). The resources shared with a
+# user count only for the owner
+USER_QUOTA = 2 * 10 ** 9
 
 parser = reqparse.RequestParser()
 parser.add_argument("task", type=str)
@@ -60,6 +128,21 @@ def to_md5(full_path=None, block_size=2 ** 20, file_object=False):
     return m.hexdigest()
 
 
+def file_range(f, start, stop, block_size=DOWNLOAD_BLOCK_SIZE):
+    """ Generate the bytes of the file f from start to stop, then close it """
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        f.close()
+
+
 def can_write(username, server_path):
     """
     This sharing system is in read-only mode.
@@ -68,20 +151,36 @@ def can_write(username, server_path):
     """
     return server_path.split('/')[0] == username
 
+password_blocklist = None
+password_blocklist_lock = threading.Lock()
+
+
+def load_password_blocklist():
+    """ Open PASSWORD_BLOCKLIST, compiling it first if it's out of date """
+    global password_blocklist
+    with password_blocklist_lock:
+        if password_blocklist is None:
+            try:
+                outdated = os.path.getmtime(PASSWORD_BLOCKLIST) < \
+                    os.path.getmtime(PASSWORD_NOT_ACCEPTED_DATA)
+            except OSError:
+                # not compiled yet (or compiled from a list not shipped)
+                outdated = not os.path.exists(PASSWORD_BLOCKLIST)
+            if outdated:
+                blocklist.build(PASSWORD_NOT_ACCEPTED_DATA, PASSWORD_BLOCKLIST)
+            password_blocklist = blocklist.Blocklist(PASSWORD_BLOCKLIST)
+    return password_blocklist
+
+
 def PasswordChecker(clear_password):
     #if the password is too short
     if len(clear_password) <= 5:
         return "This password is too short, the password " + \
             "must be at least 6 characters", HTTP_NOT_ACCEPTABLE
     #if the password is too common
-    f = open(PASSWORD_NOT_ACCEPTED_DATA)
-    lines = f.readlines()
-    f.close()
-    for line in lines:
-        for word in line.split():
-            if clear_password == word:
-                return "This password is too common, the password " + \
-                    "must be something unusual", HTTP_NOT_ACCEPTABLE
+    if clear_password in (password_blocklist or load_password_blocklist()):
+        return "This password is too common, the password " + \
+            "must be something unusual", HTTP_NOT_ACCEPTABLE
     #if the password is too easy
     strength, _ = passwordmeter.test(clear_password)
     if strength < 0.5:
@@ -91,57 +190,677 @@ def PasswordChecker(clear_password):
     return clear_password
 
 
+class TokenCache(object):
+    """
+    Session tokens, so that the (slow on purpose) sha256_crypt check is paid
+    only once per session and not on every request.
+        · tokens = { sha256(token) : [username, expiry] }
+    The tokens are looked up by their hash, so the lookup time doesn't depend
+    on how many characters of a guessed token are right.
+    The dictionary is ordered by expiry: the expired tokens are purged from
+    the head, and the oldest ones are evicted when the cache is full.
+    """
+    def __init__(self, ttl=TOKEN_TTL, max_size=TOKEN_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.tokens = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token).hexdigest()
+
+    def _purge(self, now):
+        """
+        Remove the expired tokens and, if the cache is still full, the oldest
+        ones. It must be called holding the lock.
+        """
+        while self.tokens:
+            key, (_, expiry) = next(self.tokens.iteritems())
+            if expiry > now and len(self.tokens) < self.max_size:
+                break
+            del self.tokens[key]
+
+    def issue(self, username):
+        """
+        Create a new token for the user. Return the token and its lifetime.
+        """
+        token = os.urandom(24).encode("hex")
+        now = time.time()
+        with self.lock:
+            self._purge(now)
+            self.tokens[self._key(token)] = [username, now + self.ttl]
+        return token, self.ttl
+
+    def verify(self, username, token):
+        if not token:
+            return False
+        key = self._key(token)
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None:
+                return False
+            if entry[1] <= time.time():
+                del self.tokens[key]
+                return False
+        return entry[0] == username
+
+    def refresh(self, username, token):
+        """
+        Extend the lifetime of a valid token. Return the new lifetime, or
+        False if the token is not valid.
+        """
+        if not self.verify(username, token):
+            return False
+        key = self._key(token)
+        with self.lock:
+            # move the token to the tail, keeping the expiry order
+            self.tokens.pop(key, None)
+            self.tokens[key] = [username, time.time() + self.ttl]
+        return self.ttl
+
+    def revoke(self, token):
+        with self.lock:
+            return self.tokens.pop(self._key(token), None) is not None
+
+    def revoke_user(self, username):
+        """
+        Revoke every token of the user (e.g. when the user is deleted).
+        """
+        with self.lock:
+            for key, (owner, _) in self.tokens.items():
+                if owner == username:
+                    del self.tokens[key]
+
+
+tokens = TokenCache()
+
+
+class ChangeFeed(object):
+    """
+    The last changes of the files of every user, so that a client which is
+    already synchronized downloads only what happened after its cursor
+    instead of the whole snapshot.
+        · changes = { username : deque([{cursor, op, path, md5, timestamp}]) }
+    op is "add", "update" or "delete" (directories are not sent).
+    The cursors grow monotonically and start from the time of the reset in
+    microseconds, so a cursor given by a previous run of the server is older
+    than every change kept. When the changes after a cursor aren't in memory
+    anymore, since() returns None: the client needs the full snapshot.
+    """
+    # seconds between two checks of a wait (None: woken up by record)
+    poll_interval = None
+
+    def __init__(self, max_changes=CHANGES_PER_USER):
+        self.max_changes = max_changes
+        self.lock = threading.Lock()
+        # a condition of the lock for every user waited for
+        self.waiting = {}
+        self.cursor = 0
+        self.reset()
+
+    def reset(self):
+        """ Forget every change (e.g. when the users are loaded again) """
+        with self.lock:
+            self.cursor = max(int(time.time() * 1000000), self.cursor + 1)
+            self.start = self.cursor
+            self.changes = {}
+            # the oldest cursor each user can still ask the changes from
+            self.floors = {}
+            # every cursor waited for is too old now
+            for condition in self.waiting.itervalues():
+                condition.notify_all()
+
+    def _notify(self, username):
+        condition = self.waiting.get(username)
+        if condition is not None:
+            condition.notify_all()
+
+    def current(self):
+        return self.cursor
+
+    def record(self, username, op, path, md5=None, timestamp=None):
+        with self.lock:
+            self.cursor += 1
+            user_changes = self.changes.get(username)
+            if user_changes is None:
+                user_changes = collections.deque()
+                self.changes[username] = user_changes
+            if len(user_changes) == self.max_changes:
+                self.floors[username] = user_changes.popleft()["cursor"]
+            user_changes.append({
+                "cursor": self.cursor,
+                "op": op,
+                "path": path,
+                "md5": md5,
+                "timestamp": timestamp
+            })
+            self._notify(username)
+            return self.cursor
+
+    def forget(self, username):
+        with self.lock:
+            self.changes.pop(username, None)
+            self.floors.pop(username, None)
+            self._notify(username)
+
+    def invalidate(self, username):
+        """
+        The changes of the user can't tell what happened (e.g. a share was
+        mounted): every cursor given before is out of date, and a client
+        gets the full snapshot.
+        """
+        with self.lock:
+            self.changes.pop(username, None)
+            self.cursor += 1
+            self.floors[username] = self.cursor
+            self._notify(username)
+
+    def _pending(self, username, cursor):
+        """ The user has changes after the cursor, or it's out of date """
+        if not self.floors.get(username, self.start) <= cursor <= self.cursor:
+            return True
+        user_changes = self.changes.get(username)
+        return bool(user_changes) and user_changes[-1]["cursor"] > cursor
+
+    def wait(self, username, cursor, timeout):
+        """
+        Block until the user has changes after the cursor (or since() would
+        return None), at most for timeout seconds. Return True if there are
+        changes to get.
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            condition = self.waiting.get(username)
+            if condition is None:
+                condition = self.waiting[username] = \
+                    threading.Condition(self.lock)
+            while not self._pending(username, cursor):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                if self.poll_interval is not None:
+                    remaining = min(remaining, self.poll_interval)
+                condition.wait(remaining)
+            return True
+
+    def since(self, username, cursor):
+        """
+        Return the changes of the user after the cursor: only the last one
+        for each path, and a "move" (with the "src" path) instead of a file
+        deleted and added with the same md5 somewhere else.
+        """
+        with self.lock:
+            if not self.floors.get(username, self.start) <= cursor \
+                    <= self.cursor:
+                return None
+            user_changes = [
+                change for change in self.changes.get(username, ())
+                if change["cursor"] > cursor
+            ]
+        return self._coalesce(user_changes)
+
+    @staticmethod
+    def _coalesce(user_changes):
+        latest = collections.OrderedDict()
+        for change in user_changes:
+            latest.pop(change["path"], None)
+            latest[change["path"]] = change
+
+        deleted = {}
+        for change in latest.itervalues():
+            if change["op"] == "delete":
+                deleted.setdefault(change["md5"], []).append(change["path"])
+        moved_from = {}
+        for change in latest.itervalues():
+            if change["op"] == "add" and deleted.get(change["md5"]):
+                moved_from[change["path"]] = deleted[change["md5"]].pop(0)
+        moved = set(moved_from.itervalues())
+
+        result = []
+        for path, change in latest.iteritems():
+            if path in moved:
+                continue
+            change = dict(change)
+            change.pop("cursor", None)
+            if path in moved_from:
+                change["op"] = "move"
+                change["src"] = moved_from[path]
+            result.append(change)
+        return result
+
+
+changes = ChangeFeed()
+
+
+class SharedTokens(TokenCache):
+    """
+    The session tokens in the SQLite store, so that a token issued by a
+    worker process is valid in every other one.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tokens (
+            key TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            expiry REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tokens_by_expiry ON tokens (expiry);
+    """
+
+    def __init__(self, store, ttl=TOKEN_TTL, max_size=TOKEN_CACHE_SIZE):
+        TokenCache.__init__(self, ttl, max_size)
+        self.store = store
+        store.add_schema(self.SCHEMA)
+
+    def issue(self, username):
+        token = os.urandom(24).encode("hex")
+        now = time.time()
+        with self.store.lock:
+            self.store.execute("DELETE FROM tokens WHERE expiry <= ?", (now,))
+            # the oldest tokens are evicted when the table is full
+            self.store.execute(
+                "DELETE FROM tokens WHERE key IN (SELECT key FROM tokens "
+                "ORDER BY expiry DESC LIMIT -1 OFFSET ?)",
+                (self.max_size - 1,)
+            )
+            self.store.execute(
+                "INSERT INTO tokens (key, username, expiry) VALUES (?, ?, ?)",
+                (self._key(token), username, now + self.ttl)
+            )
+            self.store.commit()
+        return token, self.ttl
+
+    def verify(self, username, token):
+        if not token:
+            return False
+        row = self.store.query_one(
+            "SELECT username FROM tokens WHERE key = ? AND expiry > ?",
+            (self._key(token), time.time())
+        )
+        return row is not None and row[0] == username
+
+    def refresh(self, username, token):
+        with self.store.lock:
+            if not self.store.execute(
+                    "UPDATE tokens SET expiry = ? "
+                    "WHERE key = ? AND username = ? AND expiry > ?",
+                    (time.time() + self.ttl, self._key(token), username,
+                     time.time())):
+                return False
+            self.store.commit()
+        return self.ttl
+
+    def revoke(self, token):
+        with self.store.lock:
+            revoked = self.store.execute(
+                "DELETE FROM tokens WHERE key = ?", (self._key(token),)
+            )
+            self.store.commit()
+        return revoked > 0
+
+    def revoke_user(self, username):
+        with self.store.lock:
+            self.store.execute(
+                "DELETE FROM tokens WHERE username = ?", (username,)
+            )
+            self.store.commit()
+
+
+class SharedChangeFeed(ChangeFeed):
+    """
+    The change feed in the SQLite store, written with the metadata of the
+    files, so that a client gets the same changes from every worker
+    process. The cursor is the rowid of the change: it keeps growing across
+    restarts, so the changes kept survive them too.
+    A wait checks the store every LONG_POLL_INTERVAL seconds, as the changes
+    of the other processes don't wake it up.
+    """
+    poll_interval = LONG_POLL_INTERVAL
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS changes (
+            cursor INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            op TEXT NOT NULL,
+            path TEXT NOT NULL,
+            md5 TEXT,
+            timestamp REAL
+        );
+        CREATE INDEX IF NOT EXISTS changes_by_user
+            ON changes (username, cursor);
+        CREATE TABLE IF NOT EXISTS change_floors (
+            username TEXT PRIMARY KEY,
+            cursor INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, store, max_changes=CHANGES_PER_USER):
+        self.store = store
+        store.add_schema(self.SCHEMA)
+        ChangeFeed.__init__(self, max_changes)
+
+    def reset(self):
+        """ The changes are kept in the store: nothing to forget """
+        pass
+
+    def current(self):
+        row = self.store.query_one(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'changes'"
+        )
+        return row[0] if row else 0
+
+    def record(self, username, op, path, md5=None, timestamp=None):
+        with self.store.lock:
+            cursor = self.store.insert(
+                "INSERT INTO changes (username, op, path, md5, timestamp) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (username, op, path, md5, timestamp)
+            )
+            oldest = self.store.query_one(
+                "SELECT cursor FROM changes WHERE username = ? "
+                "ORDER BY cursor DESC LIMIT 1 OFFSET ?",
+                (username, self.max_changes)
+            )
+            if oldest:
+                self.store.execute(
+                    "DELETE FROM changes WHERE username = ? AND cursor <= ?",
+                    (username, oldest[0])
+                )
+                self.store.execute(
+                    "INSERT OR REPLACE INTO change_floors (username, cursor) "
+                    "VALUES (?, ?)",
+                    (username, oldest[0])
+                )
+        # the waits read the change once it's committed
+        self.store.after_commit(self._notify_committed, username)
+        return cursor
+
+    def forget(self, username):
+        with self.store.lock:
+            self.store.execute(
+                "DELETE FROM changes WHERE username = ?", (username,)
+            )
+            self.store.execute(
+                "DELETE FROM change_floors WHERE username = ?", (username,)
+            )
+        self.store.after_commit(self._notify_committed, username)
+
+    def invalidate(self, username):
+        with self.store.lock:
+            self.store.execute(
+                "DELETE FROM changes WHERE username = ?", (username,)
+            )
+            # a new cursor, without a change
+            if not self.store.execute(
+                    "UPDATE sqlite_sequence SET seq = seq + 1 "
+                    "WHERE name = 'changes'"):
+                self.store.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) "
+                    "VALUES ('changes', 1)"
+                )
+            self.store.execute(
+                "INSERT OR REPLACE INTO change_floors (username, cursor) "
+                "VALUES (?, ?)",
+                (username, self.current())
+            )
+        self.store.after_commit(self._notify_committed, username)
+
+    def _notify_committed(self, username):
+        with self.lock:
+            self._notify(username)
+
+    def _pending(self, username, cursor):
+        # without the store lock: a wait holds self.lock, it never waits for
+        # the transactions of the writers
+        with self.store.reading():
+            floor = self.store.query_one(
+                "SELECT cursor FROM change_floors WHERE username = ?",
+                (username,)
+            )
+            if not (floor[0] if floor else 0) <= cursor <= self.current():
+                return True
+            return self.store.query_one(
+                "SELECT 1 FROM changes WHERE username = ? AND cursor > ? "
+                "LIMIT 1",
+                (username, cursor)
+            ) is not None
+
+    def since(self, username, cursor):
+        with self.store.reading():
+            floor = self.store.query_one(
+                "SELECT cursor FROM change_floors WHERE username = ?",
+                (username,)
+            )
+            if not (floor[0] if floor else 0) <= cursor <= self.current():
+                return None
+            rows = self.store.query(
+                "SELECT op, path, md5, timestamp FROM changes "
+                "WHERE username = ? AND cursor > ? ORDER BY cursor",
+                (username, cursor)
+            )
+        return self._coalesce([
+            {"op": op, "path": path, "md5": md5, "timestamp": timestamp}
+            for op, path, md5, timestamp in rows
+        ])
+
+
+blobs = BlobStore(BLOBS_DIRECTORY)
+uploads = UploadSessions(UPLOADS_DIRECTORY)
+# the mails are sent in background (see start_mail_queue)
+mail_queue = None
+mail_queue_lock = threading.Lock()
+
+
+# an immutable version of the namespace of a user: files is a tuple of
+# (client_path, md5, timestamp), shares is (owned, granted) as given by
+# the store, cursor is the change feed cursor it's up to date with
+Namespace = collections.namedtuple(
+    "Namespace", ["files", "shares", "timestamp", "cursor"]
+)
+
+
+class MountedPaths(collections.Mapping):
+    """
+    The paths of a user: its own ones (own, kept by the metadata store) and
+    the resources shared with it, mounted in shares/<owner>/<name>. A
+    mounted path is resolved in the paths of the owner at every lookup:
+    sharing copies nothing, and the changes of the owner are seen at once.
+    """
+    def __init__(self, username, own):
+        self.username = username
+        self.own = own
+
+    def mounts(self):
+        """
+        Generate (mount point, owner, owner's client path) of every resource
+        shared with the user.
+        """
+        for owner_name, server_path in User.store.shares_of(self.username)[1]:
+            owner = User.users.get(owner_name)
+            if owner is not None:
+                yield owner._get_shared_root(server_path), owner, \
+                    owner._client_path_of(server_path)
+
+    def _resolve(self, client_path):
+        """
+        Return (owner, owner's client path) of a mounted path, None if the
+        path is not mounted.
+        """
+        if not client_path.startswith("shares/"):
+            return None
+        for mount, owner, owner_path in self.mounts():
+            if client_path == mount or client_path.startswith(mount + "/"):
+                rest = client_path[len(mount) + 1:]
+                return owner, \
+                    "/".join(part for part in (owner_path, rest) if part)
+        return None
+
+    def _mounted(self, mount, owner, owner_path):
+        """ Generate (mounted path, file_meta) of the owner's owner_path """
+        for path, file_meta in User.store.paths_under(
+                owner.username, owner_path):
+            rest = path[len(owner_path):].lstrip("/")
+            yield "{}/{}".format(mount, rest) if rest else mount, file_meta
+
+    def __getitem__(self, client_path):
+        mounted = self._resolve(client_path)
+        if mounted is None:
+            return self.own[client_path]
+        owner, owner_path = mounted
+        return owner.paths.own[owner_path]
+
+    def __iter__(self):
+        for client_path in self.own:
+            yield client_path
+        for mount in self.mounts():
+            for client_path, _ in self._mounted(*mount):
+                yield client_path
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def files(self):
+        """ Generate (client_path, md5, timestamp) of every file """
+        for file_info in User.store.files(self.username):
+            yield file_info
+        for mount in self.mounts():
+            for client_path, file_meta in self._mounted(*mount):
+                if file_meta[1] is not None:
+                    yield client_path, file_meta[1], file_meta[2]
+
+
 class User(object):
     """
     Maintaining two dictionaries:
-        · paths = { client_path : [server_path, md5/None, timestamp] }
-    None instead of the md5 means that the path is a directory.
+        · paths = { client_path : [server_path, md5/None, timestamp, size] }
+    None instead of the md5 (and the size) means that the path is a
+    directory. The
+    resources shared with the user are not copied in it: they are mounted
+    (see MountedPaths).
         · shared_resources: { server_path : [owner, ben1, ben2, ...] }
     The full path to access to the file is a join between USERS_DIRECTORIES and
     the server_path.
+    Both are kept by the metadata store: every change has to go through it.
     """
     users = {}
     shared_resources = {}
+    store = None
+    # locks of the users changed by a request
+    locks = UserLocks()
+    # held replacing a namespace (see publish)
+    publish_lock = threading.Lock()
+    # True if other worker processes share the store
+    shared = False
 
     # CLASS AND STATIC METHODS
     @staticmethod
-    def user_class_init():
-        try:
-            ud = open(USERS_DATA, "r")
-            saved = json.load(ud)
-            ud.close()
-        except IOError:
-
-            # The json file is not present. It will be created a new structure
-            # from scratch.
-            pass
-        # If the json file is corrupted, it will be raised a ValueError here.
-        # In that case, please remove the corrupted file.
-        else:
-            for u, v in saved["users"].iteritems():
-                User(u, None, from_dict=v)
+    def user_class_init(store=None):
+        """
+        Load the users from the metadata store (default: the dictionaries
+        saved in USERS_DATA and USERS_JOURNAL).
+        """
+        if User.store:
+            User.store.close()
+            User.store = None
+        if store is None:
+            store = DictStore(USERS_DATA, USERS_JOURNAL)
+        User.users = {}
+        users = store.load()
+        store.drop_shared_copies()
+        # the files saved by the older versions, without their size
+        for username, client_path, file_meta in store.unsized_files():
+            full_path = os.path.join(USERS_DIRECTORIES, file_meta[0])
+            if os.path.isfile(full_path):
+                store.set_path(
+                    username, client_path,
+                    file_meta[:3] + [os.path.getsize(full_path)]
+                )
+        store.commit()
+        for u, v in users.iteritems():
+            User(u, None, from_dict=v)
+        User.shared_resources = store.shares
+        User.store = store
+        changes.reset()
 
-    @classmethod
-    def save_users(cls, filename=None):
-        if not filename:
-            filename = USERS_DATA
+    @staticmethod
+    def _sharing_users(username):
+        """ The owners of what is shared with the user and the
+        beneficiaries of what the user shares """
+        owned, granted = User.store.shares_of(username)
+        users = set(owner for owner, _ in granted)
+        for server_path in owned:
+            users.update(User.shared_resources.get(server_path, ())[1:])
+        return users
 
-        to_save = {
-            "users": {}
-        }
-        for u, v in cls.users.iteritems():
-            to_save["users"][u] = v.to_dict()
+    @staticmethod
+    @contextlib.contextmanager
+    def locked(username, *others):
+        """
+        Hold the locks of the user, of the users sharing something with it
+        (a change of the user can reach them) and of the others. The shares
+        of the user change only holding its lock: they are read again once
+        the locks are held, and if they changed the locks are taken again.
+        """
+        keys = set([username])
+        keys.update(other for other in others if other)
+        while True:
+            keys.update(User._sharing_users(username))
+            slots = User.locks.acquire(keys)
+            if User._sharing_users(username) <= keys:
+                break
+            User.locks.release(slots)
+        # the readers publishing meanwhile drop what they built (see
+        # publish): the changed users are published by their next reader
+        writing = [User.users[key] for key in keys if key in User.users]
+        for u in writing:
+            u.writers += 1
+            u.generation += 1
+        try:
+            yield
+        finally:
+            for u in writing:
+                u.writers -= 1
+            User.locks.release(slots)
 
-        with open(filename, "w") as f:
-            json.dump(to_save, f)
+    @staticmethod
+    def refresh():
+        """
+        Reload the users if another worker process changed the store. The
+        paths and the shares are read from the store every time: only the
+        users and their timestamps are kept in memory.
+        """
+        if not User.shared or not User.store.changed():
+            return
+        loaded = User.store.load()
+        for username in set(User.users) - set(loaded):
+            del User.users[username]
+        for username, data in loaded.iteritems():
+            u = User.users.get(username)
+            if u is None:
+                User(username, None, from_dict=data)
+            elif u.timestamp != data["timestamp"]:
+                u.timestamp = data["timestamp"]
+                u._namespace_changed()
 
     # DYNAMIC METHODS
     def __init__(self, username, password, from_dict=None):
+        # the namespace read by the requests which don't change anything,
+        # published by the first of them after a change (see publish)
+        self.namespace = None
+        self.unpublished = True
+        # the requests of this process changing the user now, and how many
+        # started so far: the generation the namespace was built at
+        self.writers = 0
+        self.generation = 0
+        self.namespace_generation = -1
+        # the last snapshot sent by GET files/: (namespace, etag, json)
+        self.snapshot_cache = None
+
         # if restoring the server:
         if from_dict:
             self.username = username
             self.psw = from_dict["psw"]
-            self.paths = from_dict["paths"]
+            self.paths = MountedPaths(username, from_dict["paths"])
             self.timestamp = from_dict["timestamp"]
             User.users[username] = self
             return
@@ -157,24 +876,104 @@ class User(object):
         self.username = username
         self.psw = password
 
-        # path of each file and each directory of the user:
-        # { client_path : [server_path, md5, timestamp] }
-        self.paths = {}
-
         # timestamp of the last change in the user's files
         self.timestamp = time.time()
 
+        # path of each file and each directory of the user:
+        # { client_path : [server_path, md5, timestamp, size] }
+        self.paths = MountedPaths(
+            username, User.store.add_user(username, password, self.timestamp)
+        )
+
         # update users, file
-        self.push_path("", username, update_user_data=False)
         User.users[username] = self
-        User.save_users()
+        self.push_path("", username, update_user_data=False)
+        User.store.commit()
+
+    def _namespace_changed(self):
+        """ The published namespace is not the last one anymore """
+        self.unpublished = True
+
+    def _build_namespace(self):
+        return Namespace(
+            files=tuple(self.paths.files()),
+            shares=User.store.shares_of(self.username),
+            timestamp=self.timestamp,
+            cursor=changes.current()
+        )
+
+    def _replace_namespace(self, namespace, generation):
+        with User.publish_lock:
+            # a reader which started later could have published already
+            if generation >= self.namespace_generation:
+                self.namespace = namespace
+                self.namespace_generation = generation
+
+    def publish(self):
+        """
+        Replace the namespace read by the readers with a new immutable
+        version, at once: they never see a change half done, and they
+        never wait for the writers. It's built by the first reader after a
+        change, without the user's lock: if a writer of the user ran
+        meanwhile (see User.locked) it's dropped, and the next reader
+        publishes. Return False if it's dropped.
+        """
+        generation = self.generation
+        if self.writers:
+            return False
+        self.unpublished = False
+        try:
+            namespace = self._build_namespace()
+        except RuntimeError:
+            # a dictionary of the store changed while it was read
+            namespace = None
+        if namespace is None or self.writers or \
+                self.generation != generation:
+            self.unpublished = True
+            return False
+        self._replace_namespace(namespace, generation)
+        return True
 
-    def to_dict(self):
-        return {
-            "psw": self.psw,
-            "paths": self.paths,
-            "timestamp": self.timestamp
-        }
+    def current_namespace(self):
+        """
+        Return the last namespace published. The changes made since are
+        published here, once for all of them, unless a writer is changing
+        the user: the namespace published before it is returned, and the
+        next reader publishes.
+        """
+        if self.unpublished:
+            self.publish()
+        if self.namespace is None:
+            # never published: wait for the writer (or it's this request)
+            with User.locks.hold([self.username]):
+                if self.namespace is None:
+                    self.unpublished = False
+                    self._replace_namespace(
+                        self._build_namespace(), self.generation)
+        return self.namespace
+
+    def _set_path(self, client_path, file_meta):
+        """ Add or update a path of the user. Return the change made. """
+        op = "update" if client_path in self.paths else "add"
+        User.store.set_path(self.username, client_path, file_meta)
+        self._namespace_changed()
+        if file_meta[1] is not None:
+            changes.record(
+                self.username, op, client_path, file_meta[1], file_meta[2]
+            )
+        return op
+
+    def _del_path(self, client_path):
+        md5 = self.paths[client_path][1]
+        User.store.del_path(self.username, client_path)
+        self._namespace_changed()
+        if md5 is not None:
+            changes.record(self.username, "delete", client_path, md5)
+
+    def _set_timestamp(self, timestamp):
+        self.timestamp = timestamp
+        User.store.set_timestamp(self.username, timestamp)
+        self._namespace_changed()
 
     def create_server_path(self, client_path):
         # the client_path do not have to contain "../"
@@ -230,44 +1029,75 @@ class User(object):
         resource_name = path_parts.pop()
         return os.path.join("shares", self.username, resource_name)
 
+    def usage(self, client_path=""):
+        """ Return (bytes, files) stored by the user in a directory """
+        return User.store.usage(self.username, client_path)
+
+    def size_of(self, client_path):
+        """ The bytes of a file of the user, 0 if it's not present """
+        file_meta = self.paths.get(client_path)
+        if file_meta is None or len(file_meta) < 4:
+            return 0
+        return file_meta[3] or 0
+
+    def check_quota(self, added):
+        """ Abort the request if the user can't store added bytes more """
+        if USER_QUOTA is not None and added > 0 and \
+                self.usage()[0] + added > USER_QUOTA:
+            abort(HTTP_REQUEST_ENTITY_TOO_LARGE)
+
+    def _client_path_of(self, server_path):
+        """ The client path of a server path in the user's directory """
+        if server_path == self.username:
+            return ""
+        return server_path[len(self.username) + 1:]
+
     def _get_ben_path(self, server_path):
         """
         Search a shared father for the resource. If it exists, return the
         shared resource name and the ben_path, else return False.
         """
-        for shared_server_path, beneficiaries in \
-                User.shared_resources.iteritems():
-            if server_path.startswith(shared_server_path):
-                ben_path = server_path.replace(
-                    shared_server_path,
-                    self._get_shared_root(shared_server_path),
-                    1
-                )
-                return shared_server_path, ben_path
-        return False
-
-    def push_path(
-            self, client_path, server_path, update_user_data=True,
-            only_modify=False):
-        md5 = to_md5(os.path.join(USERS_DIRECTORIES, server_path))
+        shared_server_path = User.store.share_of(server_path)
+        if shared_server_path is None:
+            return False
+        ben_path = server_path.replace(
+            shared_server_path,
+            self._get_shared_root(shared_server_path),
+            1
+        )
+        return shared_server_path, ben_path
+
+    def push_path(self, client_path, server_path, update_user_data=True,
+                  md5=None):
+        """ Add or update the path. If the md5 is not known, the file is
+        read to compute it """
+        full_path = os.path.join(USERS_DIRECTORIES, server_path)
+        if md5 is None:
+            md5 = to_md5(full_path)
+        # the size of a file is counted in the usage of the user
+        size = os.path.getsize(full_path) if md5 is not None else None
         now = time.time()
-        file_meta = [server_path, md5, now]
-        self.paths[client_path] = file_meta
-
-        is_shared = self._get_ben_path(server_path)
-        if is_shared:
-            share, ben_path = is_shared
-
-            # upgrade every beneficiaries
-            for ben_name in User.shared_resources[share][1:]:
-                ben_user = User.users[ben_name]
-                if not only_modify:
-                    ben_user.paths[ben_path] = file_meta
-                ben_user.timestamp = now
+        file_meta = [server_path, md5, now, size]
+        op = self._set_path(client_path, file_meta)
+        self._changed_in_share(server_path, op, md5, now)
 
         if update_user_data:
-            self.timestamp = now
-            User.save_users()
+            self._set_timestamp(now)
+            User.store.commit()
+
+    def _changed_in_share(self, server_path, op, md5, now):
+        """
+        The beneficiaries see the path changed in their mounts: only their
+        change feeds (for a file) and their timestamps are updated.
+        """
+        is_shared = self._get_ben_path(server_path)
+        if not is_shared:
+            return
+        share, ben_path = is_shared
+        for ben_name in User.shared_resources[share][1:]:
+            if md5 is not None:
+                changes.record(ben_name, op, ben_path, md5, now)
+            User.users[ben_name]._set_timestamp(now)
 
     def rm_path(self, client_path):
         """
@@ -275,7 +1105,7 @@ Remove the path from the paths dictionary. If there are empty
 directories, remove them from the filesystem.
 """
         now = time.time()
-        self.timestamp = now
+        self._set_timestamp(now)
 
         # remove empty directories
         directory_path, filename = os.path.split(client_path)
@@ -292,40 +1122,33 @@ directories, remove them from the filesystem.
                     # the directory is not empty
                     break
                 else:
-                    # step 2: remove from shared beneficiary's paths
-                    is_shared = self._get_ben_path(server_subdir)
-                    if is_shared:
-                        shared_server_path, ben_path = is_shared
-                        for ben_name in \
-                                User.shared_resources[shared_server_path][1:]:
-                            ben_user = User.users[ben_name]
-                            del ben_user.paths[ben_path]
-                    # step 3: remove from paths
-                    del self.paths[client_subdir]
+                    # step 2: remove from paths (and from the mounts of
+                    # the beneficiaries with it)
+                    self._del_path(client_subdir)
                     dir_list.pop()
 
-        # remove from shared beneficiary's paths
-        is_shared = self._get_ben_path(self.paths[client_path][0])
-        if is_shared:
-            shared_server_path, ben_path = is_shared
-            for ben_name in User.shared_resources[shared_server_path][1:]:
-                ben_user = User.users[ben_name]
-                del ben_user.paths[ben_path]
-                ben_user.timestamp = now
-            # if the shared resource is a removed file or an empty directory
-            # remove it from shared_resources
-            if not os.path.exists(shared_server_path):
-                del User.shared_resources[shared_server_path]
+        # remove from shared beneficiary's mounts
+        server_path, md5 = self.paths[client_path][:2]
+        self._changed_in_share(server_path, "delete", md5, now)
+        shared_server_path = User.store.share_of(server_path)
+        # if the shared resource is a removed file or an empty directory
+        # remove it from shared_resources
+        if shared_server_path is not None and not os.path.exists(
+                os.path.join(USERS_DIRECTORIES, shared_server_path)):
+            User.store.del_share(shared_server_path)
 
         # remove the argument client_path and save
-        del self.paths[client_path]
-        User.save_users()
+        self._del_path(client_path)
+        User.store.commit()
 
     def delete_user(self, username):
         user_root = self.paths[""][0]
         del User.users[username]
+        tokens.revoke_user(username)
+        changes.forget(username)
         shutil.rmtree(user_root)
-        User.save_users()
+        User.store.del_user(username)
+        User.store.commit()
 
     def add_share(self, client_path, beneficiary):
         try:
@@ -334,33 +1157,57 @@ directories, remove them from the filesystem.
         except KeyError:
             # invalid client_path or the beneficiary is not an user
             return False
+        if beneficiary in User.shared_resources.get(server_path, ())[1:]:
+            # already shared with the beneficiary
+            return False
 
-        if server_path not in User.shared_resources:
-            User.shared_resources[server_path] = [self.username, beneficiary]
-        else:
-            User.shared_resources[server_path].append(beneficiary)
-
-        new_client_path = self._get_shared_root(server_path)
+        User.store.add_beneficiary(server_path, self.username, beneficiary)
+        # the shares listed to the owner
+        self._namespace_changed()
 
-        # The item referenced in ben.paths and in the owner's paths is the
-        # same. If modified, the both are update.
-        ben.paths[new_client_path] = self.paths[client_path]
+        # the resource is mounted in the beneficiary's paths (nothing is
+        # copied): its change feed can't tell the paths added, the client
+        # gets the full snapshot
+        changes.invalidate(beneficiary)
+        ben._set_timestamp(time.time())
+        User.store.commit()
+        return True
 
-        if self.paths[client_path][1] is None:
-            # If client_path is a directory, add to the beneficiary's paths
-            # every file and folder in the shared folder
-            for path, value in self.paths.iteritems():
-                if path.startswith(client_path):
-                    to_insert = path.replace(client_path, new_client_path, 1)
-                    ben.paths[to_insert] = value
 
-        ben.timestamp = time.time()
-        User.save_users()
-        return True
+def lock_users(method):
+    """
+    A request changing something holds the locks of the users it can
+    change (see User.locked) until its changes are committed: requests of
+    users not sharing anything run in parallel.
+    The body of the request is received before the locks are taken (the
+    content of an upload is spooled in the blob store and hashed
+    meanwhile): a slow client doesn't block the writes of the users it
+    shares with. Before that, the precheck method of the resource (if any)
+    can refuse the request without receiving it.
+    """
+    @functools.wraps(method)
+    def locked_method(*args, **kwargs):
+        if request.method in ("GET", "HEAD", "OPTIONS"):
+            return method(*args, **kwargs)
+        precheck = getattr(getattr(method, "__self__", None), "precheck", None)
+        if precheck is not None:
+            precheck(*args, **kwargs)
+        # the form is parsed: the whole body is received
+        request.files
+        with User.locked(auth.username(), kwargs.get("beneficiary")):
+            try:
+                return method(*args, **kwargs)
+            finally:
+                if User.shared:
+                    # no transaction is left open, blocking the other
+                    # processes
+                    User.store.commit()
+    return locked_method
 
 
 class Resource_with_auth(Resource):
-    method_decorators = [auth.login_required]
+    # the last decorator is the outer one: authentication first
+    method_decorators = [lock_users, auth.login_required]
 
 
 class UsersApi(Resource):
@@ -385,60 +1232,71 @@ class UsersApi(Resource):
         "timestamp": <timestamp>
         }
         }"""
-        pending = self.load_pending_users()
-        try:
-            psw = request.form["psw"]
-        except KeyError:
-            return "Missing password", HTTP_BAD_REQUEST
-        if username in pending:
-            return "This user have already a pending request", HTTP_CONFLICT
-        elif username in User.users:
-            return "This user already exists", HTTP_CONFLICT
-        if psw is not PasswordChecker(psw):
-            return PasswordChecker(psw)
-        else:
-            psw_hash = sha256_crypt.encrypt(psw)
-            code = os.urandom(16).encode('hex')
-            send_mail(username, "RawBox activation code", code)
-            pending[username] = \
-                {"password": psw_hash,
-                 "code": code,
-                 "timestamp": time.time()}
-
-            with open(PENDING_USERS, "w") as p_u:
-                json.dump(pending, p_u)
-            return "User added to pending users", HTTP_CREATED
+        # the pending users are in one file: it's locked too
+        with User.locks.hold([username, PENDING_USERS]):
+            pending = self.load_pending_users()
+            try:
+                psw = request.form["psw"]
+            except KeyError:
+                return "Missing password", HTTP_BAD_REQUEST
+            if username in pending:
+                return "This user have already a pending request", \
+                    HTTP_CONFLICT
+            elif username in User.users:
+                return "This user already exists", HTTP_CONFLICT
+            checked = PasswordChecker(psw)
+            if psw is not checked:
+                return checked
+            else:
+                psw_hash = sha256_crypt.encrypt(psw)
+                code = os.urandom(16).encode('hex')
+                try:
+                    send_mail(username, "RawBox activation code", code)
+                except MailQueueFull:
+                    return "Too many requests, retry later", \
+                        HTTP_SERVICE_UNAVAILABLE
+                pending[username] = \
+                    {"password": psw_hash,
+                     "code": code,
+                     "timestamp": time.time()}
+
+                with open(PENDING_USERS, "w") as p_u:
+                    json.dump(pending, p_u)
+                return "User added to pending users", HTTP_CREATED
 
     def put(self, username):
         """Activate a pending user
         Expected
         {"code": <activation code>}"""
-        try:
-            code = request.form["code"]
-        except KeyError:
-            return "Missing activation code", HTTP_BAD_REQUEST
-
-        if username in User.users:
-            return "This user is already active", HTTP_CONFLICT
-
-        pending = self.load_pending_users()
-
-        if username in pending:
-            if code == pending[username]["code"]:
-                User(username, pending[username]["password"])
-                del pending[username]
-                if pending:
-                    with open(PENDING_USERS, "w") as p_u:
-                        json.dump(pending, p_u)
+        # the pending users are in one file: it's locked too
+        with User.locks.hold([username, PENDING_USERS]):
+            try:
+                code = request.form["code"]
+            except KeyError:
+                return "Missing activation code", HTTP_BAD_REQUEST
+
+            if username in User.users:
+                return "This user is already active", HTTP_CONFLICT
+
+            pending = self.load_pending_users()
+
+            if username in pending:
+                if code == pending[username]["code"]:
+                    User(username, pending[username]["password"])
+                    del pending[username]
+                    if pending:
+                        with open(PENDING_USERS, "w") as p_u:
+                            json.dump(pending, p_u)
+                    else:
+                        os.remove(PENDING_USERS)
+                    return "User activated", HTTP_CREATED
                 else:
-                    os.remove(PENDING_USERS)
-                return "User activated", HTTP_CREATED
+                    return "Wrong code", HTTP_NOT_FOUND
             else:
-                return "Wrong code", HTTP_NOT_FOUND
-        else:
-            return "User need to be created", HTTP_NOT_FOUND
+                return "User need to be created", HTTP_NOT_FOUND
 
     @auth.login_required
+    @lock_users
     def delete(self, username):
         """Delete the user who is making the request
 """
@@ -451,52 +1309,137 @@ class UsersApi(Resource):
             return "access denied", HTTP_BAD_REQUEST
 
 
+class Tokens(Resource_with_auth):
+    """
+    Session tokens. A token is used as password in the Basic authentication:
+        Authorization: Basic base64(<username>:<token>)
+    """
+    def post(self):
+        """Issue a new token
+        Returns {"token": <token>, "ttl": <seconds>}"""
+        token, ttl = tokens.issue(auth.username())
+        return {"token": token, "ttl": ttl}, HTTP_CREATED
+
+    def put(self):
+        """Refresh the token used to authenticate this request
+        Returns {"token": <token>, "ttl": <seconds>}"""
+        ttl = tokens.refresh(auth.username(), g.auth_token)
+        if not ttl:
+            return "Authenticate with the token to refresh", HTTP_BAD_REQUEST
+        return {"token": g.auth_token, "ttl": ttl}, HTTP_OK
+
+    def delete(self):
+        """Revoke the token used to authenticate this request"""
+        if not g.auth_token or not tokens.revoke(g.auth_token):
+            return "Authenticate with the token to revoke", HTTP_BAD_REQUEST
+        return "Token revoked", HTTP_OK
+
+
 class Files(Resource_with_auth):
     def _diffs(self):
         """ Send a JSON with the timestamp of the last change in user
         directories and an md5 for each file
-        Expected GET method without path """
+        Expected GET method without path
+        The JSON is cached until the user's files change: it has an ETag,
+        and with a matching If-None-Match header the answer is 304 """
         u = User.users[auth.username()]
+        namespace = u.current_namespace()
+        cache = u.snapshot_cache
+        if cache is None or cache[0] is not namespace:
+            cache = self._build_snapshot(namespace)
+            u.snapshot_cache = cache
+        _, etag, snapshot = cache
+        response = Response(snapshot, mimetype="application/json")
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+    def _build_snapshot(self, namespace):
         tree = {}
-        for p, v in u.paths.iteritems():
-            if v[1] is None:
-                # the path p is a directory
-                continue
-
-            if not v[1] in tree:
-                tree[v[1]] = [{
+        # only the files: the directories have not an md5
+        for p, md5, timestamp in namespace.files:
+            if not md5 in tree:
+                tree[md5] = [{
                     "path": p,
-                    "timestamp": v[2]
+                    "timestamp": timestamp
                 }]
             else:
-                tree[v[1]].append({
+                tree[md5].append({
                     "path": p,
-                    "timestamp": v[2]
+                    "timestamp": timestamp
                 })
 
-        snapshot = {
+        snapshot = json.dumps({
             "snapshot": tree,
-            "timestamp": u.timestamp
-        }
+            "timestamp": namespace.timestamp,
+            "cursor": namespace.cursor
+        })
+        return namespace, hashlib.md5(snapshot).hexdigest(), snapshot
 
-        return snapshot, HTTP_OK
-        # return json.dumps(snapshot), HTTP_OK
+    def _requested_range(self, etag, last_modified, size):
+        """
+        Return the (start, stop) of the Range requested, None to send the
+        whole file (no range, more ranges or an If-Range which doesn't
+        match) or False if the range is not satisfiable.
+        """
+        byte_range = request.range
+        if byte_range is None or byte_range.units != "bytes" \
+                or len(byte_range.ranges) != 1:
+            return None
+        if_range = request.if_range
+        if if_range.etag is not None and if_range.etag != etag:
+            return None
+        if if_range.date is not None and \
+                http_date(if_range.date) != http_date(last_modified):
+            return None
+        return byte_range.range_for_length(size) or False
 
     def _download(self, client_path):
         """Download
-        Returns file content as a byte string
-        Expected GET method with path"""
+        Returns file content as a stream, without loading it in memory
+        Expected GET method with path
+        With a Range header (and a matching If-Range, if any) only that
+        part of the file is sent, with the status 206 """
         u = User.users[auth.username()]
         try:
-            full_path = os.path.join(
-                USERS_DIRECTORIES, u.paths[client_path][0]
-            )
+            server_path, md5, timestamp = u.paths[client_path][:3]
         except KeyError:
             return "File unreachable", HTTP_NOT_FOUND
 
-        with open(full_path, "rb") as f:
-            content = f.read()
-        return content
+        f = open(os.path.join(USERS_DIRECTORIES, server_path), "rb")
+        size = os.fstat(f.fileno()).st_size
+        last_modified = int(timestamp)
+        byte_range = self._requested_range(md5, last_modified, size)
+
+        if byte_range is False:
+            f.close()
+            response = Response(status=HTTP_RANGE_NOT_SATISFIABLE)
+            response.headers["Content-Range"] = "bytes */{}".format(size)
+            return response
+
+        if byte_range is None:
+            # the WSGI server can send the whole file with sendfile
+            response = Response(
+                wrap_file(request.environ, f, DOWNLOAD_BLOCK_SIZE),
+                mimetype="application/octet-stream",
+                direct_passthrough=True
+            )
+            response.content_length = size
+        else:
+            start, stop = byte_range
+            response = Response(
+                file_range(f, start, stop),
+                status=HTTP_PARTIAL_CONTENT,
+                mimetype="application/octet-stream",
+                direct_passthrough=True
+            )
+            response.content_length = stop - start
+            response.headers["Content-Range"] = "bytes {}-{}/{}".format(
+                start, stop - 1, size
+            )
+        response.headers["Accept-Ranges"] = "bytes"
+        response.set_etag(md5)
+        response.last_modified = last_modified
+        return response
 
     def get(self, client_path=None):
         if not client_path:
@@ -504,6 +1447,21 @@ class Files(Resource_with_auth):
         else:
             return self._download(client_path)
 
+    def precheck(self, client_path=None):
+        """ Checked before the content is received, without the locks: the
+        handlers check again holding them """
+        u = User.users[auth.username()]
+        if request.method == "POST":
+            if client_path in u.paths:
+                abort(HTTP_CONFLICT)
+            # the encoding of the form makes the request a bit longer than
+            # the file
+            u.check_quota(request.content_length or 0)
+        elif request.method == "PUT":
+            u.check_quota(
+                (request.content_length or 0) - u.size_of(client_path)
+            )
+
     def put(self, client_path):
         """ Update
         Updates an existing file
@@ -518,15 +1476,9 @@ class Files(Resource_with_auth):
         if not can_write(u.username, server_path):
             abort(HTTP_FORBIDDEN)
 
-        f = request.files["file_content"]
-
-        if request.form["file_md5"] != to_md5(file_object=f):
-            abort(HTTP_BAD_REQUEST)
-
-        f.seek(0)
-        f.save(os.path.join(USERS_DIRECTORIES, server_path))
-        u.push_path(client_path, server_path, only_modify=True)
-        return u.timestamp, HTTP_CREATED
+        return self._save_upload(u, client_path, server_path,
+                                 request.files["file_content"].stream,
+                                 u.size_of(client_path))
 
     def post(self, client_path):
         """ Upload
@@ -539,22 +1491,169 @@ class Files(Resource_with_auth):
             # The file is already present. To modify it, use PUT, not POST
             abort(HTTP_CONFLICT)
 
+        # received (see lock_users) before the directories are created
+        spooled = request.files["file_content"].stream
+
         server_path = u.create_server_path(client_path)
         if not server_path:
             # the server_path belongs to another user
             abort(HTTP_FORBIDDEN)
 
-        f = request.files["file_content"]
+        return self._save_upload(u, client_path, server_path, spooled)
+
+
+    @staticmethod
+    def _save_upload(u, client_path, server_path, spooled, replaced=0):
+        # the content was hashed while it was written in the store
+        key, md5 = spooled.digest()
+        if request.form["file_md5"] != md5:
+            abort(HTTP_BAD_REQUEST)
+        # the length of the request may be unknown (chunked encoding)
+        u.check_quota(spooled.size - replaced)
+
+        blobs.save_spooled(
+            spooled, os.path.join(USERS_DIRECTORIES, server_path)
+        )
+        u.push_path(client_path, server_path, md5=md5)
+        return u.timestamp, HTTP_CREATED
+
+
+class Uploads(Resource_with_auth):
+    def _get_session(self, session_id):
+        session = uploads.get(auth.username(), session_id)
+        if session is None:
+            abort(HTTP_NOT_FOUND)
+        return session
+
+    def get(self, session_id):
+        """ Send the session, with the list of the chunks received:
+        { "id", "path", "size", "md5", "chunk_size", "chunks", "received" }
+        """
+        session = self._get_session(session_id)
+        del session["user"]
+        return session, HTTP_OK
+
+    def post(self, session_id=None):
+        """ Without session_id, start an upload session
+        Expected as POST data:
+        { "path" : <path>, "size" : <bytes>, "file_md5" : <md5> }
+        { "id", "chunk_size", "chunks" } is sent back
+        With session_id, commit the session: the file is created or
+        updated with the content of the chunks """
+        if session_id is None:
+            try:
+                client_path = request.form["path"]
+                size = int(request.form["size"])
+                md5 = request.form["file_md5"]
+            except (KeyError, ValueError):
+                abort(HTTP_BAD_REQUEST)
+            if size < 0:
+                abort(HTTP_BAD_REQUEST)
+            u = User.users[auth.username()]
+            # no chunk is received if the file can't be stored
+            u.check_quota(size - u.size_of(client_path))
+            session = uploads.create(auth.username(), client_path, size, md5)
+            return {
+                "id": session["id"],
+                "chunk_size": session["chunk_size"],
+                "chunks": session["chunks"]
+            }, HTTP_CREATED
+        return self._commit(self._get_session(session_id))
+
+    def put(self, session_id, index):
+        """ Upload the chunk number index of the session
+        Expected as POST data:
+        { "file_content" : <chunk>, "chunk_md5" : <md5 of the chunk> } """
+        session = self._get_session(session_id)
+        try:
+            uploads.put_chunk(
+                session, index,
+                request.files["file_content"], request.form["chunk_md5"]
+            )
+        except (KeyError, ValueError):
+            abort(HTTP_BAD_REQUEST)
+        return index, HTTP_CREATED
 
-        if request.form["file_md5"] != to_md5(file_object=f):
+    def delete(self, session_id):
+        uploads.remove(self._get_session(session_id))
+        return "Upload session removed", HTTP_OK
+
+    def _commit(self, session):
+        u = User.users[auth.username()]
+        try:
+            assembled, key, md5 = uploads.assemble(session)
+        except ValueError as e:
+            return {"missing": e.args[0]}, HTTP_CONFLICT
+        if md5 != session["md5"]:
+            uploads.remove(session)
             abort(HTTP_BAD_REQUEST)
 
-        f.seek(0)
-        f.save(os.path.join(USERS_DIRECTORIES, server_path))
-        u.push_path(client_path, server_path)
+        client_path = session["path"]
+        u.check_quota(session["size"] - u.size_of(client_path))
+        if client_path in u.paths:
+            server_path = u.paths[client_path][0]
+            if not can_write(u.username, server_path):
+                abort(HTTP_FORBIDDEN)
+        else:
+            server_path = u.create_server_path(client_path)
+            if not server_path:
+                abort(HTTP_FORBIDDEN)
+
+        blobs.save_file(
+            key, assembled, os.path.join(USERS_DIRECTORIES, server_path)
+        )
+        uploads.remove(session)
+        u.push_path(client_path, server_path, md5=md5)
         return u.timestamp, HTTP_CREATED
 
 
+class Usage(Resource_with_auth):
+    def get(self, client_path=""):
+        """ Send the bytes and the files stored by the user, and its quota
+        (null if there is no limit). With a path, the ones stored in that
+        directory.
+        { "bytes": <bytes>, "files": <files>, "quota": <bytes> }
+        The counters are kept up to date at every change: no file is read """
+        u = User.users[auth.username()]
+        file_meta = u.paths.own.get(client_path)
+        if file_meta is None or file_meta[1] is not None:
+            return "The directory is not present", HTTP_NOT_FOUND
+        size, files = u.usage(client_path)
+        return {"bytes": size, "files": files, "quota": USER_QUOTA}, HTTP_OK
+
+
+class Changes(Resource_with_auth):
+    def get(self):
+        """ Send the changes of the user's files after a cursor
+        Expected GET method with ?since=<cursor>, the cursor given by the
+        last GET files/ or GET changes
+        { "changes": [{"op", "path", "md5", "timestamp"}],
+          "cursor": <cursor>, "timestamp": <timestamp> }
+        A "move" change has the "src" path too. If the changes after the
+        cursor aren't available anymore, the status is 410: the client has
+        to download the full snapshot with GET files/
+        With &wait=<seconds> (long poll), the response waits until there
+        are changes, at most LONG_POLL_TIMEOUT seconds. """
+        u = User.users[auth.username()]
+        since = request.args.get("since", type=int)
+        if since is None:
+            abort(HTTP_BAD_REQUEST)
+        wait = min(request.args.get("wait", 0, type=float), LONG_POLL_TIMEOUT)
+        if wait > 0 and changes.wait(u.username, since, wait):
+            # the timestamp changed by another worker process
+            User.refresh()
+
+        cursor = changes.current()
+        user_changes = changes.since(u.username, since)
+        if user_changes is None:
+            return "Changes not available, get the snapshot", HTTP_GONE
+        return {
+            "changes": user_changes,
+            "cursor": cursor,
+            "timestamp": u.timestamp
+        }, HTTP_OK
+
+
 class Actions(Resource_with_auth):
     def _delete(self):
         """ Expected as POST data:
@@ -592,9 +1691,12 @@ class Actions(Resource_with_auth):
         client_dest = request.form["file_dest"]
 
         try:
-            server_src = u.paths[client_src][0]
+            server_src, md5 = u.paths[client_src][:2]
         except KeyError:
             abort(HTTP_NOT_FOUND)
+        if keep_the_original or not can_write(u.username, server_src):
+            # a new file of the user
+            u.check_quota(u.size_of(client_src) - u.size_of(client_dest))
 
         server_dest = u.create_server_path(client_dest)
         if not server_dest:
@@ -606,17 +1708,21 @@ class Actions(Resource_with_auth):
         full_dest = os.path.join(USERS_DIRECTORIES, server_dest)
         try:
             if keep_the_original:
-                shutil.copy(full_src, full_dest)
+                # only a new reference to the same content
+                blobs.copy(full_src, full_dest)
             else:
                 shutil.move(full_src, full_dest)
         except shutil.Error:
             return abort(HTTP_CONFLICT) # TODO: check.
         else:
             # update the structure
+            # same content: the md5 doesn't change
             if keep_the_original:
-                u.push_path(client_dest, server_dest)
+                u.push_path(client_dest, server_dest, md5=md5)
             else:
-                u.push_path(client_dest, server_dest, update_user_data=False)
+                u.push_path(
+                    client_dest, server_dest, update_user_data=False, md5=md5
+                )
                 u.rm_path(client_src)
             return u.timestamp, HTTP_CREATED
 
@@ -645,28 +1751,24 @@ class Shares(Resource_with_auth):
     def _remove_beneficiary(self, owner, server_path, client_path,
                             beneficiary):
         # remove the beneficiary from the shared resources list
+        # (if the resource isn't shared with anybody anymore, the share is
+        # removed too)
         try:
             ben_user = User.users[beneficiary]
-            User.shared_resources[server_path].remove(beneficiary)
+            User.store.remove_beneficiary(server_path, beneficiary)
         except (KeyError, ValueError):
             # beneficiary is not an user or the resource is not shared
             # or the resource is shared, but not with this beneficiary
             abort(HTTP_BAD_REQUEST)
+        owner._namespace_changed()
 
-        if len(User.shared_resources[server_path]) == 1:
-            # the resource isn't shared with anybody.
-            # (the first user in the list is the owner)
-            del User.shared_resources[server_path]
-
-        # remove every resource which isn't shared anymore
-        ben_path = owner._get_shared_root(server_path)
-        for client_path in ben_user.paths.keys():
-            if client_path.startswith(ben_path):
-                del ben_user.paths[client_path]
+        # the resource is not mounted anymore: the client gets the full
+        # snapshot, without it
+        changes.invalidate(beneficiary)
 
         # update timestamp and save
-        ben_user.timestamp = time.time()
-        User.save_users()
+        ben_user._set_timestamp(time.time())
+        User.store.commit()
         return HTTP_OK
 
     def _remove_share(self, owner, server_path, client_path):
@@ -676,7 +1778,7 @@ class Shares(Resource_with_auth):
         except KeyError:
             abort(HTTP_BAD_REQUEST)
         else:
-            User.save_users()
+            User.store.commit()
             return HTTP_OK
 
     def delete(self, client_path, beneficiary=None):
@@ -696,22 +1798,19 @@ class Shares(Resource_with_auth):
 
     def get(self):
         owner = User.users[auth.username()]
-        usr = owner.username
-        my_shares = []
+        owned, granted = owner.current_namespace().shares
+        # the paths shared by the user
+        my_shares = ["/".join(path.split("/")[1:]) for path in owned]
+        # the paths shared with the user
         other_shares = {}
-        for path, bens in User.shared_resources.iteritems():
-            path =  "/".join((path.split("/")[1:]))
-            if usr in bens:
-                if bens[0] == usr:
-                    # the user shares the path
-                    my_shares.append(path)
-                else:
-                    #the user is a beneficiary
-                    path = "shares/{}/{}".format(bens[0], path)
-                    if bens[0] not in other_shares:
-                        other_shares[bens[0]] = [path]
-                    else:
-                        other_shares[bens[0]].append(path)
+        for ben_owner, path in granted:
+            path = "shares/{}/{}".format(
+                ben_owner, "/".join(path.split("/")[1:])
+            )
+            if ben_owner not in other_shares:
+                other_shares[ben_owner] = [path]
+            else:
+                other_shares[ben_owner].append(path)
         shares = {
             "my_shares": my_shares,
             "other_shares": other_shares
@@ -733,35 +1832,105 @@ def mail_config_init():
     return mail
 
 
+def start_mail_queue():
+    """ Read the mail settings and start sending the mails in background """
+    global mail_queue
+    with mail_queue_lock:
+        if mail_queue is None:
+            queue = MailQueue(mail_config_init(), app)
+            queue.start()
+            mail_queue = queue
+    return mail_queue
+
+
 def send_mail(receiver, obj, content):
-    """ Send an email to the 'receiver', with the
-specified object ('obj') and the specified 'content' """
-    mail = mail_config_init()
+    """ Queue an email to the 'receiver', with the
+specified object ('obj') and the specified 'content'. The mail queue is
+started by the first mail, if it's not running yet. """
     msg = Message(
         obj,
         sender="RawBoxTeam",
         recipients=[receiver])
     msg.body = content
-    with app.app_context():
-        mail.send(msg)
+    (mail_queue or start_mail_queue()).put(msg)
 
 
 @auth.verify_password
 def verify_password(username, password):
+    g.auth_token = None
     if username not in User.users:
         return False
-    else:
-        return sha256_crypt.verify(password, User.users[username].psw)
+    if tokens.verify(username, password):
+        g.auth_token = password
+        return True
+    return sha256_crypt.verify(password, User.users[username].psw)
 
 
-def main():
+@app.before_request
+def sync_shared_state():
+    """ With more worker processes, every request sees the changes of the
+    others """
+    User.refresh()
+
+
+@app.teardown_request
+def end_transaction(exception=None):
+    """ A request never leaves its changes uncommitted, holding the store """
+    if User.store is not None:
+        User.store.end()
+
+
+def open_store():
+    """
+    Open the SQLite store in USERS_DB. The first time, the metadata saved
+    in USERS_DATA and USERS_JOURNAL are imported.
+    """
     if not os.path.isdir(USERS_DIRECTORIES):
         os.makedirs(USERS_DIRECTORIES)
-    User.user_class_init()
-    app.run(host="0.0.0.0", debug=True) # TODO: remove debug=True
+    store = SQLiteStore(USERS_DB)
+    if not store.load() and os.path.exists(USERS_DATA):
+        # first start with the database: import the old metadata
+        old_store = DictStore(USERS_DATA, USERS_JOURNAL)
+        store.import_metadata(old_store.load(), old_store.shares)
+        old_store.close()
+    return store
+
+
+def use_shared_state(store):
+    """
+    Share the state of the server with the other worker processes of the
+    host: the users, the change feed and the session tokens are read from
+    the SQLite store, and the locks of the users are in STATE_LOCK.
+    """
+    global tokens, changes
+    tokens = SharedTokens(store)
+    changes = SharedChangeFeed(store)
+    User.locks = UserLocks(STATE_LOCK)
+    User.shared = True
+    User.user_class_init(store)
+
+
+def main():
+    User.user_class_init(open_store())
+    load_password_blocklist()
+    start_mail_queue()
+    blobs.start_collector(BLOBS_GC_INTERVAL)
+    app.run(host="0.0.0.0", debug=True, threaded=True) # TODO: remove debug=True
 
 api.add_resource(UsersApi, "{}Users/<string:username>".format(_API_PREFIX))
 api.add_resource(Actions, "{}actions/<string:cmd>".format(_API_PREFIX))
+api.add_resource(Tokens, "{}tokens/".format(_API_PREFIX))
+api.add_resource(Changes, "{}changes".format(_API_PREFIX))
+api.add_resource(
+    Usage,
+    "{}usage/".format(_API_PREFIX),
+    "{}usage/<path:client_path>".format(_API_PREFIX)
+)
+api.add_resource(
+    Uploads,
+    "{}uploads/".format(_API_PREFIX),
+    "{}uploads/<string:session_id>".format(_API_PREFIX),
+    "{}uploads/<string:session_id>/<int:index>".format(_API_PREFIX))
 api.add_resource(
     Files,
     "{}files/<path:client_path>".format(_API_PREFIX),
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import tempfile
+import unittest
+import hashlib
+import shutil
+import errno
+import os
+
+from StringIO import StringIO
+
+import blobstore
+from blobstore import BlobStore
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blobs = BlobStore(os.path.join(self.directory, "blobs"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def save(self, content, name):
+        f = StringIO(content)
+        key, md5 = self.blobs.digest(f)
+        self.blobs.save(key, f, self.path(name))
+        return key
+
+    def test_digest(self):
+        f = StringIO("some content")
+        key, md5 = self.blobs.digest(f)
+        self.assertEqual(key, hashlib.sha256("some content").hexdigest())
+        self.assertEqual(md5, hashlib.md5("some content").hexdigest())
+        # rewound, ready to be saved
+        self.assertEqual(f.read(), "some content")
+
+    def test_same_content_stored_once(self):
+        key = self.save("same content", "first")
+        written = []
+        real_write_blob = self.blobs._write_blob
+
+        def write_blob(*args):
+            written.append(args[0])
+            real_write_blob(*args)
+
+        self.blobs._write_blob = write_blob
+        self.assertEqual(self.save("same content", "second"), key)
+        # the second upload doesn't write anything
+        self.assertEqual(written, [])
+
+        first = os.stat(self.path("first"))
+        self.assertEqual(first.st_ino, os.stat(self.path("second")).st_ino)
+        # two files and the blob
+        self.assertEqual(first.st_nlink, 3)
+
+    def test_spooled(self):
+        spooled = self.blobs.spool()
+        spooled.write("spooled ")
+        spooled.write("content")
+        key, md5 = spooled.digest()
+        self.assertEqual(key, hashlib.sha256("spooled content").hexdigest())
+        self.assertEqual(md5, hashlib.md5("spooled content").hexdigest())
+        self.blobs.save_spooled(spooled, self.path("spooled"))
+        spooled.close()
+        self.assertEqual(
+            os.stat(self.path("spooled")).st_ino,
+            os.stat(self.blobs._blob_path(key)).st_ino
+        )
+        self.assertFalse(os.path.exists(spooled.path))
+
+        # closed before it's saved, it's thrown away
+        spooled = self.blobs.spool()
+        spooled.write("rejected")
+        spooled.close()
+        self.assertFalse(os.path.exists(spooled.path))
+
+    def test_overwrite_and_copy(self):
+        self.save("old content", "first")
+        self.blobs.copy(self.path("first"), self.path("copy"))
+        self.assertEqual(
+            os.stat(self.path("first")).st_ino,
+            os.stat(self.path("copy")).st_ino
+        )
+        with self.assertRaises(shutil.Error):
+            self.blobs.copy(self.path("first"), self.path("first"))
+        with self.assertRaises(IOError):
+            self.blobs.copy(self.path("missing"), self.path("copy"))
+
+        # the copy doesn't change with the original
+        self.save("new content", "first")
+        with open(self.path("copy")) as f:
+            self.assertEqual(f.read(), "old content")
+        with open(self.path("first")) as f:
+            self.assertEqual(f.read(), "new content")
+
+    def test_copy_without_hard_links(self):
+        self.save("content", "first")
+        clones = []
+
+        def no_link(src, dest):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+        def reflink(src, dest):
+            clones.append((src, dest))
+            raise IOError(errno.EOPNOTSUPP, "Operation not supported")
+
+        link = os.link
+        os.link = no_link
+        self.addCleanup(setattr, os, "link", link)
+        self.addCleanup(setattr, blobstore, "_reflink", blobstore._reflink)
+        blobstore._reflink = reflink
+
+        # a clone is tried first, then the content is copied
+        self.blobs.copy(self.path("first"), self.path("copy"))
+        self.assertEqual(len(clones), 1)
+        self.assertNotEqual(
+            os.stat(self.path("first")).st_ino,
+            os.stat(self.path("copy")).st_ino
+        )
+        with open(self.path("copy")) as f:
+            self.assertEqual(f.read(), "content")
+
+    def test_collect(self):
+        self.assertEqual(self.blobs.collect(), 0)
+        kept = self.save("kept", "kept_file")
+        removed = self.save("removed", "removed_file")
+        os.remove(self.path("removed_file"))
+        # a blob being written is not touched
+        tmp_blob = blobstore._new_tmp_path(self.blobs._blob_path(removed))
+        open(tmp_blob, "w").close()
+
+        self.assertEqual(self.blobs.collect(), 1)
+        self.assertTrue(os.path.exists(self.blobs._blob_path(kept)))
+        self.assertFalse(os.path.exists(self.blobs._blob_path(removed)))
+        self.assertTrue(os.path.exists(tmp_blob))
+
+        # the content is written again when it's needed
+        self.save("removed", "removed_file")
+        self.assertTrue(os.path.exists(self.blobs._blob_path(removed)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import tempfile
+import unittest
+import shutil
+import os
+
+import blocklist
+from blocklist import Blocklist
+
+
+class TestBlocklist(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, "passwords.txt")
+        self.dest = os.path.join(self.directory, "passwords.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compile(self, content, batch=blocklist.BUILD_BATCH):
+        with open(self.source, "w") as f:
+            f.write(content)
+        return blocklist.build(self.source, self.dest, batch)
+
+    def test_lookup(self):
+        words = ["password{}".format(n) for n in range(1000)]
+        # more words on a line, and duplicates
+        content = "\n".join(
+            " ".join(words[n:n + 3]) for n in range(0, len(words), 3)
+        ) + "\n123456\n123456\n"
+        # merged from more sorted runs
+        self.assertEqual(self.compile(content, batch=100), 1001)
+        self.assertEqual(
+            os.path.getsize(self.dest), 1001 * blocklist.RECORD_SIZE
+        )
+
+        passwords = Blocklist(self.dest)
+        self.assertEqual(len(passwords), 1001)
+        for word in words + ["123456"]:
+            self.assertIn(word, passwords)
+        for word in ["password1000", "Password1", "", u"pàssword"]:
+            self.assertNotIn(word, passwords)
+        passwords.close()
+        # no temporary file left
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ["passwords.bin", "passwords.txt"]
+        )
+
+    def test_empty(self):
+        self.assertEqual(self.compile(""), 0)
+        passwords = Blocklist(self.dest)
+        self.assertNotIn("123456", passwords)
+        passwords.close()
+
+    def test_not_a_blocklist(self):
+        with open(self.dest, "w") as f:
+            f.write("123456\n")
+        with self.assertRaises(ValueError):
+            Blocklist(self.dest)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import tempfile
+import unittest
+import shutil
+import json
+import os
+
+import journal
+from journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.journal")
+        self.replayed = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_journal(self, epoch="epoch", after_seq=0):
+        self.replayed = []
+        return Journal.open(self.path, epoch, after_seq, self.replayed.append)
+
+    def test_append_and_replay(self):
+        j = self.open_journal()
+        for i in range(5):
+            j.append({"op": "path", "value": i})
+        # nothing is on disk before the commit
+        j.close()
+
+        self.open_journal()
+        self.assertEqual([r["value"] for r in self.replayed], range(5))
+        self.assertEqual([r["seq"] for r in self.replayed], range(1, 6))
+
+        # the records already in the checkpoint are skipped
+        j = self.open_journal(after_seq=3)
+        self.assertEqual([r["seq"] for r in self.replayed], [4, 5])
+        # and the sequence goes on
+        self.assertEqual(j.append({"op": "path"}), 6)
+        j.close()
+
+    def test_stale_epoch(self):
+        j = self.open_journal("old_epoch")
+        j.append({"op": "path"})
+        j.close()
+
+        j = self.open_journal("new_epoch")
+        self.assertEqual(self.replayed, [])
+        j.close()
+        with open(self.path) as f:
+            self.assertEqual(json.loads(f.readline()), {"epoch": "new_epoch"})
+            self.assertEqual(f.read(), "")
+
+    def test_broken_tail(self):
+        j = self.open_journal()
+        j.append({"op": "path"})
+        j.close()
+        # a crash during the write of the second record
+        with open(self.path, "a") as f:
+            f.write('{"seq": 2, "op": "pa')
+
+        j = self.open_journal()
+        self.assertEqual(len(self.replayed), 1)
+        j.append({"op": "rm_path"})
+        j.close()
+
+        self.open_journal()
+        self.assertEqual(
+            [r["op"] for r in self.replayed], ["path", "rm_path"]
+        )
+
+    def test_group_commit(self):
+        fsync_calls = []
+        real_fsync = journal.os.fsync
+
+        def counting_fsync(fd):
+            fsync_calls.append(fd)
+            real_fsync(fd)
+
+        j = self.open_journal()
+        journal.os.fsync = counting_fsync
+        try:
+            # the records appended by everybody are written together
+            seqs = [j.append({"op": "path", "n": n}) for n in range(10)]
+            j.commit(seqs[0])
+            self.assertEqual(len(fsync_calls), 1)
+            for seq in seqs:
+                j.commit(seq)
+            self.assertEqual(len(fsync_calls), 1)
+
+            def writer(n):
+                for i in range(20):
+                    j.commit(j.append({"op": "path", "thread": n}))
+
+            threads = [
+                threading.Thread(target=writer, args=(n,)) for n in range(8)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            journal.os.fsync = real_fsync
+        j.close()
+
+        self.assertEqual(j.durable_seq, 170)
+        self.open_journal()
+        self.assertEqual(len(self.replayed), 170)
+
+    def test_compaction(self):
+        j = self.open_journal()
+        for i in range(3):
+            j.append({"op": "path"})
+        seq, offset = j.start_compaction()
+        self.assertEqual(seq, 3)
+        # a second compaction can't start while the first is running
+        self.assertIsNone(j.start_compaction())
+
+        # changes made while the checkpoint is written
+        j.commit(j.append({"op": "rm_path"}))
+        j.end_compaction(offset)
+        self.assertEqual(j.records, 1)
+        j.append({"op": "timestamp"})
+        j.close()
+
+        self.open_journal(after_seq=seq)
+        self.assertEqual(
+            [(r["seq"], r["op"]) for r in self.replayed],
+            [(4, "rm_path"), (5, "timestamp")]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import tempfile
+import unittest
+import shutil
+import time
+import os
+
+from locks import UserLocks, SharedExclusiveLock
+
+
+class TestUserLocks(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.lock")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def held_by_another_process(self, locks, keys):
+        """ True if a forked process can't take the locks of the keys """
+        pid = os.fork()
+        if pid == 0:
+            # the same object, opened again after the fork
+            os._exit(0 if locks.acquire(keys, blocking=False) else 1)
+        return os.waitpid(pid, 0)[1] != 0
+
+    def held_by_another_thread(self, locks, keys):
+        """ True if another thread can't take the locks of the keys """
+        result = []
+
+        def take():
+            slots = locks.acquire(keys, blocking=False)
+            result.append(slots is None)
+            if slots is not None:
+                locks.release(slots)
+
+        thread = threading.Thread(target=take)
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_processes(self):
+        locks = UserLocks(self.path)
+        self.assertNotEqual(locks.slot("a"), locks.slot("b"))
+        self.assertFalse(self.held_by_another_process(locks, ["a"]))
+        with locks.hold(["a"]):
+            # reentrant in the same thread
+            with locks.hold(["a", "b"]):
+                self.assertTrue(self.held_by_another_process(locks, ["b"]))
+            self.assertTrue(self.held_by_another_process(locks, ["a"]))
+            self.assertFalse(self.held_by_another_process(locks, ["b"]))
+        self.assertFalse(self.held_by_another_process(locks, ["a"]))
+
+    def test_threads(self):
+        locks = UserLocks()
+        with locks.hold(["a"]):
+            self.assertTrue(self.held_by_another_thread(locks, ["a", "b"]))
+            if locks.slot("a") != locks.slot("b"):
+                self.assertFalse(self.held_by_another_thread(locks, ["b"]))
+        self.assertFalse(self.held_by_another_thread(locks, ["a", "b"]))
+
+    def test_no_deadlock(self):
+        locks = UserLocks(self.path)
+        errors = []
+
+        def worker(keys):
+            try:
+                for _ in range(200):
+                    with locks.hold(keys):
+                        pass
+            except Exception as e:
+                errors.append(e)
+
+        # the same users in opposite orders
+        threads = [
+            threading.Thread(target=worker, args=(keys,))
+            for keys in (["a", "b", "c"], ["c", "b", "a"], ["b", "a"])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(errors, [])
+
+
+class TestSharedExclusiveLock(unittest.TestCase):
+
+    def test_exclusive_waits_for_shared(self):
+        lock = SharedExclusiveLock()
+        events = []
+
+        def snapshot():
+            with lock.exclusive():
+                events.append("snapshot")
+
+        with lock.shared():
+            # more shared holders at the same time
+            with lock.shared():
+                thread = threading.Thread(target=snapshot)
+                thread.start()
+                time.sleep(0.05)
+                events.append("change")
+        thread.join()
+        self.assertEqual(events, ["change", "snapshot"])
+
+
+if __name__ == "__main__":
+    unittest.main()
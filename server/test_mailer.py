@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import threading
+import unittest
+import asyncore
+import socket
+import smtpd
+import time
+
+from flask import Flask
+from flask.ext.mail import Mail, Message
+
+from mailer import MailQueue, MailQueueFull
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """ A SMTP server keeping the messages received, in a thread """
+    def __init__(self):
+        self.map = {}
+        self.messages = []
+        self.connections = 0
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self._map = self.map
+        self.port = self.socket.getsockname()[1]
+        self.thread = threading.Thread(
+            target=asyncore.loop,
+            kwargs={"timeout": 0.05, "map": self.map}
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_channel(self, map=None):
+        # every channel of this server in its own map
+        asyncore.dispatcher.add_channel(self, self.map)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.connections += 1
+            conn, addr = pair
+            channel = smtpd.SMTPChannel(self, conn, addr)
+            # moved from the default map to the one of the server
+            del asyncore.socket_map[channel._fileno]
+            channel._map = self.map
+            channel.add_channel()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((rcpttos, data))
+
+    def stop(self):
+        for channel in self.map.values():
+            channel.close()
+        self.thread.join()
+
+
+class FailingConnection(object):
+    """ A connection to a SMTP server failing the first sends """
+    def __init__(self, mail):
+        self.mail = mail
+
+    def __enter__(self):
+        self.mail.connections += 1
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, message):
+        if self.mail.failures:
+            self.mail.failures -= 1
+            raise socket.error("connection reset")
+        self.mail.sent.append(message)
+
+
+class FailingMail(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.connections = 0
+        self.sent = []
+
+    def connect(self):
+        return FailingConnection(self)
+
+
+class RefusingMail(object):
+    """ A mail whose first connections are refused by the SMTP server """
+    def __init__(self, mail, refused, refusals):
+        self.mail = mail
+        self.refused = refused
+        self.refusals = refusals
+        self.attempts = 0
+
+    def connect(self):
+        self.attempts += 1
+        if self.refusals:
+            self.refusals -= 1
+            return self.refused.connect()
+        return self.mail.connect()
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def message(receiver):
+    msg = Message("subject", sender="RawBoxTeam", recipients=[receiver])
+    msg.body = "content"
+    return msg
+
+
+class TestMailQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.smtp = LocalSMTPServer()
+        self.app = Flask(__name__)
+        self.app.config.update(
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=self.smtp.port,
+            MAIL_SUPPRESS_SEND=False
+        )
+
+    def tearDown(self):
+        self.smtp.stop()
+
+    def test_delivery(self):
+        queue = MailQueue(Mail(self.app), self.app)
+        queue.start()
+        receivers = ["user_{}@rawbox.com".format(n) for n in range(5)]
+        for receiver in receivers:
+            queue.put(message(receiver))
+        queue.stop()
+        self.assertEqual(
+            [rcpttos for rcpttos, data in self.smtp.messages],
+            [[receiver] for receiver in receivers]
+        )
+        # all through the same connection
+        self.assertEqual(self.smtp.connections, 1)
+
+    def test_idle_connection_closed(self):
+        queue = MailQueue(Mail(self.app), self.app, idle_timeout=0.05)
+        queue.start()
+        queue.put(message("first@rawbox.com"))
+        queue.join()
+        while queue.connection is not None:
+            time.sleep(0.01)
+        queue.put(message("second@rawbox.com"))
+        queue.stop()
+        self.assertEqual(len(self.smtp.messages), 2)
+        self.assertEqual(self.smtp.connections, 2)
+
+    def test_retry(self):
+        mail = FailingMail(failures=2)
+        queue = MailQueue(mail, self.app, retries=2, retry_delay=0)
+        queue.start()
+        queue.put(message("retried@rawbox.com"))
+        queue.join()
+        self.assertEqual(len(mail.sent), 1)
+        # a new connection after every failure
+        self.assertEqual(mail.connections, 3)
+
+        # too many failures: the message is dropped, not the next ones
+        mail.failures = 3
+        queue.put(message("dropped@rawbox.com"))
+        queue.put(message("sent@rawbox.com"))
+        queue.stop()
+        self.assertEqual(
+            [msg.recipients for msg in mail.sent],
+            [["retried@rawbox.com"], ["sent@rawbox.com"]]
+        )
+
+    def test_connection_refused(self):
+        refused_app = Flask(__name__)
+        refused_app.config.update(
+            MAIL_SERVER="127.0.0.1",
+            MAIL_PORT=closed_port(),
+            MAIL_SUPPRESS_SEND=False
+        )
+        mail = RefusingMail(Mail(self.app), Mail(refused_app), refusals=2)
+        queue = MailQueue(mail, self.app, retries=2, retry_delay=0)
+        queue.start()
+        queue.put(message("retried@rawbox.com"))
+        queue.stop()
+        self.assertEqual(mail.attempts, 3)
+        self.assertEqual(
+            [rcpttos for rcpttos, data in self.smtp.messages],
+            [["retried@rawbox.com"]]
+        )
+
+    def test_full(self):
+        # not started: nothing leaves the queue
+        queue = MailQueue(Mail(self.app), self.app, size=2)
+        queue.put(message("first@rawbox.com"))
+        queue.put(message("second@rawbox.com"))
+        with self.assertRaises(MailQueueFull):
+            queue.put(message("third@rawbox.com"), timeout=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,21 +3,28 @@
 
 from passlib.hash import sha256_crypt
 from base64 import b64encode
+from StringIO import StringIO
 import ConfigParser
+import collections
+import threading
 import tempfile
 import unittest
 import hashlib
 import shutil
+import copy
+import sys
 import json
 import time
 import os
 
+import metadata
 import server
 from server import _API_PREFIX
 
 
 TEST_DIRECTORY = "test_users_dirs/"
 TEST_USER_DATA = "test_user_data.json"
+TEST_USER_JOURNAL = "test_user_data.journal"
 TEST_PENDING_USERS = "test_user_pending.tmp"
 
 
@@ -25,6 +32,9 @@ def server_setup(root):
     server.SERVER_ROOT = root
     server.USERS_DIRECTORIES = os.path.join(root, "user_dirs/")
     server.USERS_DATA = os.path.join(root, "user_data.json")
+    server.USERS_JOURNAL = os.path.join(root, "user_data.journal")
+    server.blobs = server.BlobStore(os.path.join(root, "blobs/"))
+    server.uploads = server.UploadSessions(os.path.join(root, "uploads/"))
     if not os.path.isdir(server.USERS_DIRECTORIES):
         os.makedirs(server.USERS_DIRECTORIES)
     server.User.user_class_init()
@@ -136,6 +146,8 @@ class TestFilesAPI(unittest.TestCase):
 
     def tearDown(self):
         os.remove(os.path.join(TestFilesAPI.root, "user_data.json"))
+        os.remove(server.USERS_JOURNAL)
+        shutil.rmtree(server.blobs.root, ignore_errors=True)
 
     def test_fail_auth_post(self):
         # test fail authentication
@@ -204,6 +216,75 @@ class TestFilesAPI(unittest.TestCase):
         # restore
         os.remove(uploaded_file)
 
+    def test_upload_deduplication(self):
+        user_dir = os.path.join(
+            TestFilesAPI.root, "user_dirs", TestFilesAPI.user_test
+        )
+        for filename in ("same_1.txt", "same_2.txt"):
+            with open(TestFilesAPI.demo_file1, "r") as f:
+                rv = self.tc.post(
+                    "{}{}{}".format(
+                        _API_PREFIX, TestFilesAPI.url_radix, filename
+                    ),
+                    data=get_data(f),
+                    headers=self.headers
+                )
+            self.assertEqual(rv.status_code, 201)
+
+        # the same content is stored once
+        first = os.stat(os.path.join(user_dir, "same_1.txt"))
+        second = os.stat(os.path.join(user_dir, "same_2.txt"))
+        self.assertEqual(first.st_ino, second.st_ino)
+
+        os.remove(os.path.join(user_dir, "same_1.txt"))
+        os.remove(os.path.join(user_dir, "same_2.txt"))
+        self.assertEqual(server.blobs.collect(), 1)
+
+    def test_upload_single_pass(self):
+        url = "{}{}single_pass.txt".format(
+            _API_PREFIX, TestFilesAPI.url_radix
+        )
+        spool = os.path.join(server.blobs.root, "spool")
+        real_to_md5 = server.to_md5
+
+        def to_md5(*args, **kwargs):
+            self.fail("the uploaded file is read again")
+
+        server.to_md5 = to_md5
+        try:
+            # the md5 is wrong: the content is thrown away
+            rv = self.tc.post(
+                url,
+                data={
+                    "file_content": (StringIO("content"), "single_pass.txt"),
+                    "file_md5": "wrong md5"
+                },
+                headers=self.headers
+            )
+            self.assertEqual(rv.status_code, 400)
+            self.assertEqual(os.listdir(spool), [])
+
+            rv = self.tc.post(
+                url,
+                data={
+                    "file_content": (StringIO("content"), "single_pass.txt"),
+                    "file_md5": hashlib.md5("content").hexdigest()
+                },
+                headers=self.headers
+            )
+            self.assertEqual(rv.status_code, 201)
+        finally:
+            server.to_md5 = real_to_md5
+        self.assertEqual(os.listdir(spool), [])
+        u = server.User.users[TestFilesAPI.user_test]
+        self.assertEqual(
+            u.paths["single_pass.txt"][1], hashlib.md5("content").hexdigest()
+        )
+        os.remove(os.path.join(
+            TestFilesAPI.root, "user_dirs", TestFilesAPI.user_test,
+            "single_pass.txt"
+        ))
+
     def test_fail_auth_get(self):
         # fail authentication
         received = self.tc.get(
@@ -222,8 +303,9 @@ class TestFilesAPI(unittest.TestCase):
             headers=self.headers
         )
         self.assertEqual(received.status_code, 200)
-        with open(server_path, "r") as f:
-            self.assertEqual(json.loads(received.data), f.read())
+        with open(server_path, "rb") as f:
+            self.assertEqual(received.data, f.read())
+        self.assertEqual(received.headers["Accept-Ranges"], "bytes")
 
         # try to download file not present
         url = "{}{}".format(TestFilesAPI.url_radix, "NO_SERVER_PATH")
@@ -233,6 +315,42 @@ class TestFilesAPI(unittest.TestCase):
         )
         self.assertEqual(rv.status_code, 404)
 
+    def test_get_range(self):
+        url = "{}{}{}".format(
+            _API_PREFIX, TestFilesAPI.url_radix, "random_file.txt"
+        )
+        with open(TestFilesAPI.test_file_name, "rb") as f:
+            content = f.read()
+        etag = self.tc.get(url, headers=self.headers).headers["ETag"]
+
+        def get(**headers):
+            headers.update(self.headers)
+            return self.tc.get(url, headers=headers)
+
+        received = get(Range="bytes=2-5")
+        self.assertEqual(received.status_code, 206)
+        self.assertEqual(received.data, content[2:6])
+        self.assertEqual(
+            received.headers["Content-Range"],
+            "bytes 2-5/{}".format(len(content))
+        )
+
+        # resume from a byte until the end
+        received = get(Range="bytes=3-", **{"If-Range": etag})
+        self.assertEqual(received.status_code, 206)
+        self.assertEqual(received.data, content[3:])
+
+        # the file changed: the whole new file
+        received = get(Range="bytes=3-", **{"If-Range": '"old_etag"'})
+        self.assertEqual(received.status_code, 200)
+        self.assertEqual(received.data, content)
+
+        received = get(Range="bytes={}-".format(len(content) + 10))
+        self.assertEqual(received.status_code, 416)
+        self.assertEqual(
+            received.headers["Content-Range"], "bytes */{}".format(len(content))
+        )
+
     def test_fail_auth_put(self):
         # fail authentication
         with open(TestFilesAPI.demo_file1, "r") as f:
@@ -398,6 +516,93 @@ class TestFilesAPI(unittest.TestCase):
             os.path.join(TestFilesAPI.root, "user_dirs", data["user"])
         )
 
+    def test_snapshot_etag(self):
+        url = _API_PREFIX + self.url_radix
+        builds = []
+        build_snapshot = server.Files._build_snapshot
+
+        def counting_build(resource, namespace):
+            builds.append(namespace)
+            return build_snapshot(resource, namespace)
+
+        server.Files._build_snapshot = counting_build
+        try:
+            rv = self.tc.get(url, headers=self.headers)
+            self.assertEqual(rv.status_code, 200)
+            etag = rv.headers["ETag"]
+
+            # unchanged files: the cached snapshot, not sent again
+            headers = dict(self.headers, **{"If-None-Match": etag})
+            rv = self.tc.get(url, headers=headers)
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.data, "")
+            rv = self.tc.get(url, headers=self.headers)
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.headers["ETag"], etag)
+            self.assertEqual(len(builds), 1)
+
+            # a change of the files invalidates the snapshot
+            with open(TestFilesAPI.demo_file1, "r") as f:
+                rv = self.tc.post(
+                    url + "etag_file.txt",
+                    data=get_data(f),
+                    headers=self.headers
+                )
+            self.assertEqual(rv.status_code, 201)
+            rv = self.tc.get(url, headers=headers)
+            self.assertEqual(rv.status_code, 200)
+            self.assertNotEqual(rv.headers["ETag"], etag)
+            self.assertIn(
+                "etag_file.txt",
+                [f["path"] for files in json.loads(rv.data)["snapshot"]
+                    .values() for f in files]
+            )
+            self.assertEqual(len(builds), 2)
+        finally:
+            server.Files._build_snapshot = build_snapshot
+            os.remove(os.path.join(
+                TestFilesAPI.root, "user_dirs", TestFilesAPI.user_test,
+                "etag_file.txt"
+            ))
+
+    def test_journal_replay_and_compaction(self):
+        with open(TestFilesAPI.demo_file1, "r") as f:
+            rv = self.tc.post(
+                "{}{}{}".format(
+                    _API_PREFIX, TestFilesAPI.url_radix, "journaled/file.txt"
+                ),
+                data=get_data(f),
+                headers=self.headers
+            )
+        self.assertEqual(rv.status_code, 201)
+        paths = server.User.users[TestFilesAPI.user_test].paths
+
+        # the checkpoint is untouched: the change is only in the journal
+        with open(server.USERS_DATA) as f:
+            saved = json.load(f)["users"][TestFilesAPI.user_test]["paths"]
+        self.assertNotIn("journaled/file.txt", saved)
+
+        # restart: the journal is replayed
+        server_setup(TestFilesAPI.root)
+        self.assertEqual(
+            server.User.users[TestFilesAPI.user_test].paths, paths
+        )
+
+        # compaction: the change goes in the checkpoint
+        server.User.store.compact().join()
+        self.assertEqual(server.User.store.journal.records, 0)
+        with open(server.USERS_DATA) as f:
+            saved = json.load(f)["users"][TestFilesAPI.user_test]["paths"]
+        self.assertIn("journaled/file.txt", saved)
+
+        # restore
+        shutil.rmtree(
+            os.path.join(
+                TestFilesAPI.root, "user_dirs", TestFilesAPI.user_test,
+                "journaled"
+            )
+        )
+
     def test_create_server_path(self):
         # check if aborts when you pass invalid paths:
         invalid_paths = [
@@ -415,6 +620,801 @@ class TestFilesAPI(unittest.TestCase):
             self.assertEqual(rv.status_code, 400)
 
 
+class TestTokens(unittest.TestCase):
+    user_test = "action_man"
+    password_test = "password"
+    url = _API_PREFIX + "tokens/"
+    root = os.path.join(
+        os.path.dirname(__file__),
+        "demo_test/test_file"
+    )
+
+    def setUp(self):
+        server.app.config.update(TESTING=True)
+        server.app.testing = True
+        shutil.copy(
+            os.path.join(TestTokens.root, "demo_user_data.json"),
+            os.path.join(TestTokens.root, "user_data.json")
+        )
+        server_setup(TestTokens.root)
+        self.tc = server.app.test_client()
+        self.tokens_bak = server.tokens
+        server.tokens = server.TokenCache()
+
+    def tearDown(self):
+        server.tokens = self.tokens_bak
+        os.remove(os.path.join(TestTokens.root, "user_data.json"))
+        os.remove(server.USERS_JOURNAL)
+
+    def get_token(self):
+        rv = self.tc.post(
+            TestTokens.url,
+            headers=make_headers(TestTokens.user_test, TestTokens.password_test)
+        )
+        self.assertEqual(rv.status_code, 201)
+        return json.loads(rv.data)
+
+    def test_issue_and_use_token(self):
+        received = self.get_token()
+        self.assertEqual(received["ttl"], server.TOKEN_TTL)
+        token_headers = make_headers(TestTokens.user_test, received["token"])
+
+        # the token works as a password...
+        rv = self.tc.get(_API_PREFIX + "files/", headers=token_headers)
+        self.assertEqual(rv.status_code, 200)
+
+        # ...but only for its owner
+        rv = self.tc.get(
+            _API_PREFIX + "files/",
+            headers=make_headers("complex_user@gmail.com", received["token"])
+        )
+        self.assertEqual(rv.status_code, 401)
+
+        # the password is still accepted
+        rv = self.tc.get(
+            _API_PREFIX + "files/",
+            headers=make_headers(
+                TestTokens.user_test, TestTokens.password_test
+            )
+        )
+        self.assertEqual(rv.status_code, 200)
+
+    def test_refresh_token(self):
+        token = self.get_token()["token"]
+        token_headers = make_headers(TestTokens.user_test, token)
+
+        # only a token can be refreshed
+        rv = self.tc.put(
+            TestTokens.url,
+            headers=make_headers(
+                TestTokens.user_test, TestTokens.password_test
+            )
+        )
+        self.assertEqual(rv.status_code, 400)
+
+        rv = self.tc.put(TestTokens.url, headers=token_headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data)["token"], token)
+
+    def test_revoke_token(self):
+        token = self.get_token()["token"]
+        token_headers = make_headers(TestTokens.user_test, token)
+
+        rv = self.tc.delete(TestTokens.url, headers=token_headers)
+        self.assertEqual(rv.status_code, 200)
+
+        rv = self.tc.get(_API_PREFIX + "files/", headers=token_headers)
+        self.assertEqual(rv.status_code, 401)
+
+    def test_token_cache(self):
+        cache = server.TokenCache(ttl=60, max_size=2)
+        first, _ = cache.issue("user")
+        second, _ = cache.issue("user")
+        self.assertTrue(cache.verify("user", first))
+        self.assertFalse(cache.verify("other_user", first))
+        self.assertFalse(cache.verify("user", "not_a_token"))
+
+        # the oldest token is evicted when the cache is full
+        third, _ = cache.issue("user")
+        self.assertFalse(cache.verify("user", first))
+        self.assertTrue(cache.verify("user", second))
+        self.assertTrue(cache.verify("user", third))
+
+        # expired tokens are refused
+        cache.ttl = -1
+        expired, _ = cache.issue("user")
+        self.assertFalse(cache.verify("user", expired))
+        self.assertFalse(cache.refresh("user", expired))
+
+        cache.revoke_user("user")
+        self.assertFalse(cache.verify("user", third))
+
+
+class TestChanges(unittest.TestCase):
+    user_test = "action_man"
+    password_test = "password"
+    url = _API_PREFIX + "changes"
+    root = os.path.join(
+        os.path.dirname(__file__),
+        "demo_test/test_file"
+    )
+
+    def setUp(self):
+        server.app.config.update(TESTING=True)
+        server.app.testing = True
+        shutil.copy(
+            os.path.join(TestChanges.root, "demo_user_data.json"),
+            os.path.join(TestChanges.root, "user_data.json")
+        )
+        server_setup(TestChanges.root)
+        self.tc = server.app.test_client()
+        self.headers = make_headers(
+            TestChanges.user_test, TestChanges.password_test
+        )
+        self.user_dir = os.path.join(
+            TestChanges.root, "user_dirs", TestChanges.user_test
+        )
+
+    def tearDown(self):
+        for filename in ("new_file.txt", "moved_file.txt"):
+            if os.path.exists(os.path.join(self.user_dir, filename)):
+                os.remove(os.path.join(self.user_dir, filename))
+        os.remove(os.path.join(TestChanges.root, "user_data.json"))
+        os.remove(server.USERS_JOURNAL)
+        shutil.rmtree(server.blobs.root, ignore_errors=True)
+
+    def get_changes(self, since):
+        rv = self.tc.get(
+            "{}?since={}".format(TestChanges.url, since),
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.data)
+
+    def test_changes_since_cursor(self):
+        rv = self.tc.get(_API_PREFIX + "files/", headers=self.headers)
+        first_cursor = json.loads(rv.data)["cursor"]
+
+        # nothing changed
+        received = self.get_changes(first_cursor)
+        self.assertEqual(received["changes"], [])
+
+        demo_file = create_temporary_file()
+        with open(demo_file, "r") as f:
+            rv = self.tc.post(
+                _API_PREFIX + "files/new_file.txt",
+                data=get_data(f),
+                headers=self.headers
+            )
+        os.unlink(demo_file)
+        self.assertEqual(rv.status_code, 201)
+        received = self.get_changes(received["cursor"])
+        self.assertEqual(len(received["changes"]), 1)
+        change = received["changes"][0]
+        self.assertEqual(change["op"], "add")
+        self.assertEqual(change["path"], "new_file.txt")
+        self.assertEqual(received["timestamp"], float(rv.data))
+
+        rv = self.tc.post(
+            _API_PREFIX + "actions/move",
+            data={"file_src": "new_file.txt", "file_dest": "moved_file.txt"},
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 201)
+        received = self.get_changes(received["cursor"])
+        self.assertEqual(len(received["changes"]), 1)
+        change = received["changes"][0]
+        self.assertEqual(change["op"], "move")
+        self.assertEqual(change["src"], "new_file.txt")
+        self.assertEqual(change["path"], "moved_file.txt")
+
+        # only the last change of each path since the first cursor
+        received = self.get_changes(first_cursor)
+        self.assertEqual(
+            [(c["op"], c["path"]) for c in received["changes"]],
+            [("move", "moved_file.txt")]
+        )
+
+    def test_wrong_cursor(self):
+        rv = self.tc.get(TestChanges.url, headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        # a cursor of a previous run of the server
+        rv = self.tc.get(
+            "{}?since={}".format(TestChanges.url, 0), headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 410)
+
+    def test_change_feed(self):
+        feed = server.ChangeFeed(max_changes=2)
+        start = feed.current()
+        feed.record("user", "add", "a.txt", "md5_a")
+        feed.record("user", "update", "a.txt", "md5_a2")
+        self.assertEqual(
+            [(c["op"], c["md5"]) for c in feed.since("user", start)],
+            [("update", "md5_a2")]
+        )
+        self.assertEqual(feed.since("other_user", start), [])
+
+        # the oldest change is dropped: its cursor is too old now
+        cursor = feed.record("user", "delete", "b.txt", "md5_b")
+        self.assertIsNone(feed.since("user", start))
+        self.assertEqual(feed.since("user", cursor), [])
+
+        feed.reset()
+        self.assertIsNone(feed.since("user", cursor))
+
+    def test_change_feed_wait(self):
+        feed = server.ChangeFeed()
+        cursor = feed.current()
+        self.assertFalse(feed.wait("user", cursor, 0.05))
+        # a cursor out of date doesn't wait
+        self.assertTrue(feed.wait("user", cursor - 1, 10))
+
+        # woken up by a change of the user, not of the others
+        def record():
+            time.sleep(0.1)
+            feed.record("other_user", "add", "b.txt", "md5_b")
+            time.sleep(0.1)
+            feed.record("user", "add", "a.txt", "md5_a")
+
+        thread = threading.Thread(target=record)
+        thread.start()
+        start = time.time()
+        self.assertTrue(feed.wait("user", cursor, 10))
+        self.assertLess(time.time() - start, 5)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        thread.join()
+
+    def test_long_poll(self):
+        rv = self.tc.get(_API_PREFIX + "files/", headers=self.headers)
+        cursor = json.loads(rv.data)["cursor"]
+        start = time.time()
+        rv = self.tc.get(
+            "{}?since={}&wait=0.1".format(TestChanges.url, cursor),
+            headers=self.headers
+        )
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(json.loads(rv.data)["changes"], [])
+
+        # answered as soon as a file changes
+        def upload():
+            time.sleep(0.1)
+            server.app.test_client().post(
+                _API_PREFIX + "files/new_file.txt",
+                data={
+                    "file_content": (StringIO("new content"), "file"),
+                    "file_md5": hashlib.md5("new content").hexdigest()
+                },
+                headers=self.headers
+            )
+
+        thread = threading.Thread(target=upload)
+        thread.start()
+        start = time.time()
+        rv = self.tc.get(
+            "{}?since={}&wait=30".format(TestChanges.url, cursor),
+            headers=self.headers
+        )
+        self.assertLess(time.time() - start, 10)
+        thread.join()
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(
+            [c["path"] for c in json.loads(rv.data)["changes"]],
+            ["new_file.txt"]
+        )
+
+
+class TestSharedState(unittest.TestCase):
+    """ A worker process sharing the state with another one """
+    user_test = "action_man"
+    password_test = "password"
+    root = os.path.join(
+        os.path.dirname(__file__),
+        "demo_test/test_file"
+    )
+
+    def setUp(self):
+        server.app.config.update(TESTING=True)
+        server.app.testing = True
+        shutil.copy(
+            os.path.join(TestSharedState.root, "demo_user_data.json"),
+            os.path.join(TestSharedState.root, "user_data.json")
+        )
+        server_setup(TestSharedState.root)
+        self.db = os.path.join(TestSharedState.root, "user_data.db")
+        store = server.SQLiteStore(self.db)
+        store.import_metadata(
+            server.User.store.users, server.User.store.shares
+        )
+        server.STATE_LOCK = os.path.join(TestSharedState.root, ".state.lock")
+        server.use_shared_state(store)
+        # the store of the other worker
+        self.other = server.SQLiteStore(self.db)
+        self.tc = server.app.test_client()
+        self.headers = make_headers(
+            TestSharedState.user_test, TestSharedState.password_test
+        )
+
+    def tearDown(self):
+        server.tokens = server.TokenCache()
+        server.changes = server.ChangeFeed()
+        server.User.locks = server.UserLocks()
+        server.User.shared = False
+        server.User.store.close()
+        self.other.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db + suffix):
+                os.remove(self.db + suffix)
+        os.remove(server.STATE_LOCK)
+        os.remove(os.path.join(TestSharedState.root, "user_data.json"))
+        os.remove(server.USERS_JOURNAL)
+        shutil.rmtree(server.blobs.root, ignore_errors=True)
+
+    def get_snapshot(self):
+        rv = self.tc.get(_API_PREFIX + "files/", headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.data)
+
+    def test_changes_of_another_worker(self):
+        first = self.get_snapshot()
+
+        # the other worker adds a file and a user
+        now = time.time()
+        self.other.set_path(
+            TestSharedState.user_test, "other_file.txt",
+            ["action_man/other_file.txt", "other_md5", now]
+        )
+        self.other.set_timestamp(TestSharedState.user_test, now)
+        server.SharedChangeFeed(self.other).record(
+            TestSharedState.user_test, "add", "other_file.txt", "other_md5",
+            now
+        )
+        self.other.add_user(
+            "other_user", server.sha256_crypt.encrypt("other_password"), now
+        )
+        self.other.commit()
+
+        # the snapshot cached before is not valid anymore
+        snapshot = self.get_snapshot()
+        self.assertEqual(snapshot["timestamp"], now)
+        self.assertIn("other_md5", snapshot["snapshot"])
+        rv = self.tc.get(
+            "{}changes?since={}".format(_API_PREFIX, first["cursor"]),
+            headers=self.headers
+        )
+        self.assertEqual(
+            [c["path"] for c in json.loads(rv.data)["changes"]],
+            ["other_file.txt"]
+        )
+        rv = self.tc.get(
+            _API_PREFIX + "files/",
+            headers=make_headers("other_user", "other_password")
+        )
+        self.assertEqual(rv.status_code, 200)
+
+        self.other.del_user("other_user")
+        self.other.commit()
+        rv = self.tc.get(
+            _API_PREFIX + "files/",
+            headers=make_headers("other_user", "other_password")
+        )
+        self.assertEqual(rv.status_code, 401)
+
+    def test_tokens_of_another_worker(self):
+        rv = self.tc.post(_API_PREFIX + "tokens/", headers=self.headers)
+        token = json.loads(rv.data)["token"]
+        other_tokens = server.SharedTokens(self.other)
+        self.assertTrue(
+            other_tokens.verify(TestSharedState.user_test, token)
+        )
+        self.assertTrue(other_tokens.revoke(token))
+        rv = self.tc.get(
+            _API_PREFIX + "files/",
+            headers=make_headers(TestSharedState.user_test, token)
+        )
+        self.assertEqual(rv.status_code, 401)
+
+    def test_shared_change_feed(self):
+        feed = server.SharedChangeFeed(self.other, max_changes=2)
+        start = feed.current()
+        feed.record("user", "add", "a.txt", "md5_a")
+        feed.record("user", "update", "a.txt", "md5_a2")
+        self.assertEqual(
+            [(c["op"], c["md5"]) for c in feed.since("user", start)],
+            [("update", "md5_a2")]
+        )
+        self.assertEqual(feed.since("other_user", start), [])
+
+        # the oldest change is dropped: its cursor is too old now
+        cursor = feed.record("user", "delete", "b.txt", "md5_b")
+        self.assertIsNone(feed.since("user", start))
+        self.assertEqual(feed.since("user", cursor), [])
+        # a cursor of the future
+        self.assertIsNone(feed.since("user", cursor + 1))
+
+        # the changes survive the restart of the workers
+        feed.reset()
+        self.assertEqual(feed.since("user", cursor), [])
+
+    def test_long_poll_another_worker(self):
+        first = self.get_snapshot()
+        now = time.time()
+
+        def change():
+            # the other worker doesn't wake up this one: it checks the store
+            time.sleep(0.1)
+            self.other.set_timestamp(TestSharedState.user_test, now)
+            server.SharedChangeFeed(self.other).record(
+                TestSharedState.user_test, "add", "other_file.txt",
+                "other_md5", now
+            )
+            self.other.commit()
+
+        thread = threading.Thread(target=change)
+        thread.start()
+        rv = self.tc.get(
+            "{}changes?since={}&wait=30".format(_API_PREFIX, first["cursor"]),
+            headers=self.headers
+        )
+        thread.join()
+        received = json.loads(rv.data)
+        self.assertEqual(
+            [c["path"] for c in received["changes"]], ["other_file.txt"]
+        )
+        self.assertEqual(received["timestamp"], now)
+
+
+class TestSQLiteStore(unittest.TestCase):
+    """ The transactions of the threads of a process """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = server.SQLiteStore(
+            os.path.join(self.dir, "user_data.db")
+        )
+        self.store.add_user("user", "psw", 0)
+        self.store.commit()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_transaction_of_a_thread(self):
+        changed = threading.Event()
+        rollback = threading.Event()
+
+        def half_done():
+            self.store.set_path(
+                "user", "half.txt", ["user/half.txt", "md5", 1, 3]
+            )
+            changed.set()
+            rollback.wait(10)
+            # a failed request: its change is lost, and only its change
+            self.store.conn.rollback()
+            self.store.end()
+        writer = threading.Thread(target=half_done)
+        writer.start()
+        changed.wait(10)
+        # not read by the others before it's committed
+        self.assertIsNone(self.store._old_meta("user", "half.txt"))
+
+        def other_change():
+            self.store.set_path(
+                "user", "done.txt", ["user/done.txt", "md5", 1, 3]
+            )
+            self.store.commit()
+        other = threading.Thread(target=other_change)
+        other.start()
+        # the other writer waits for the transaction: it doesn't commit it
+        other.join(0.2)
+        self.assertTrue(other.is_alive())
+        rollback.set()
+        writer.join()
+        other.join()
+        self.assertIsNone(self.store._old_meta("user", "half.txt"))
+        self.assertEqual(
+            self.store._old_meta("user", "done.txt"),
+            ["user/done.txt", "md5", 1, 3]
+        )
+
+
+class TestUploads(unittest.TestCase):
+    user_test = "action_man"
+    password_test = "password"
+    url = _API_PREFIX + "uploads/"
+    root = os.path.join(
+        os.path.dirname(__file__),
+        "demo_test/test_file"
+    )
+    content = "a file sent in some chunks"
+
+    def setUp(self):
+        server.app.config.update(TESTING=True)
+        server.app.testing = True
+        shutil.copy(
+            os.path.join(TestUploads.root, "demo_user_data.json"),
+            os.path.join(TestUploads.root, "user_data.json")
+        )
+        server_setup(TestUploads.root)
+        server.uploads.chunk_size = 10
+        self.tc = server.app.test_client()
+        self.headers = make_headers(
+            TestUploads.user_test, TestUploads.password_test
+        )
+        self.uploaded = os.path.join(
+            TestUploads.root, "user_dirs", TestUploads.user_test,
+            "chunked", "file.txt"
+        )
+
+    def tearDown(self):
+        if os.path.exists(self.uploaded):
+            shutil.rmtree(os.path.dirname(self.uploaded))
+        shutil.rmtree(server.uploads.root, ignore_errors=True)
+        shutil.rmtree(server.blobs.root, ignore_errors=True)
+        os.remove(os.path.join(TestUploads.root, "user_data.json"))
+        os.remove(server.USERS_JOURNAL)
+
+    def create_session(self, md5=None):
+        rv = self.tc.post(
+            TestUploads.url,
+            data={
+                "path": "chunked/file.txt",
+                "size": len(TestUploads.content),
+                "file_md5": md5 or hashlib.md5(TestUploads.content).hexdigest()
+            },
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 201)
+        return json.loads(rv.data)
+
+    def put_chunk(self, session, index, chunk_md5=None):
+        chunk = TestUploads.content[index * 10:(index + 1) * 10]
+        return self.tc.put(
+            "{}{}/{}".format(TestUploads.url, session["id"], index),
+            data={
+                "file_content": (StringIO(chunk), "chunk"),
+                "chunk_md5": chunk_md5 or hashlib.md5(chunk).hexdigest()
+            },
+            headers=self.headers
+        )
+
+    def received(self, session):
+        rv = self.tc.get(TestUploads.url + session["id"], headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        return json.loads(rv.data)["received"]
+
+    def test_chunked_upload(self):
+        session = self.create_session()
+        self.assertEqual(session["chunks"], 3)
+
+        self.assertEqual(self.put_chunk(session, 2).status_code, 201)
+        self.assertEqual(
+            self.put_chunk(session, 0, chunk_md5="wrong").status_code, 400
+        )
+        self.assertEqual(self.put_chunk(session, 3).status_code, 400)
+        self.assertEqual(self.received(session), [2])
+
+        # the commit fails while chunks are missing
+        rv = self.tc.post(TestUploads.url + session["id"], headers=self.headers)
+        self.assertEqual(rv.status_code, 409)
+        self.assertEqual(json.loads(rv.data)["missing"], [0, 1])
+        self.assertNotIn(
+            "chunked/file.txt", server.User.users[TestUploads.user_test].paths
+        )
+
+        # resume: only the missing chunks
+        for index in (0, 1):
+            self.assertEqual(self.put_chunk(session, index).status_code, 201)
+        rv = self.tc.post(TestUploads.url + session["id"], headers=self.headers)
+        self.assertEqual(rv.status_code, 201)
+        with open(self.uploaded) as f:
+            self.assertEqual(f.read(), TestUploads.content)
+        self.assertEqual(
+            server.User.users[TestUploads.user_test].paths["chunked/file.txt"][1],
+            hashlib.md5(TestUploads.content).hexdigest()
+        )
+        # the session is over
+        rv = self.tc.get(TestUploads.url + session["id"], headers=self.headers)
+        self.assertEqual(rv.status_code, 404)
+
+    def test_wrong_session(self):
+        session = self.create_session(md5="not_the_md5")
+        # the sessions of other users are not visible
+        rv = self.tc.get(
+            TestUploads.url + session["id"],
+            headers=make_headers("complex_user@gmail.com", "password")
+        )
+        self.assertEqual(rv.status_code, 404)
+
+        for index in range(session["chunks"]):
+            self.put_chunk(session, index)
+        # the whole file has not the declared md5
+        rv = self.tc.post(TestUploads.url + session["id"], headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertFalse(os.path.exists(self.uploaded))
+
+        session = self.create_session()
+        rv = self.tc.delete(
+            TestUploads.url + session["id"], headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 200)
+        rv = self.tc.get(TestUploads.url + session["id"], headers=self.headers)
+        self.assertEqual(rv.status_code, 404)
+
+
+class TestUsage(unittest.TestCase):
+    user_test = "action_man"
+    password_test = "password"
+    root = os.path.join(
+        os.path.dirname(__file__),
+        "demo_test/test_file"
+    )
+
+    def setUp(self):
+        server.app.config.update(TESTING=True)
+        server.app.testing = True
+        shutil.copy(
+            os.path.join(TestUsage.root, "demo_user_data.json"),
+            os.path.join(TestUsage.root, "user_data.json")
+        )
+        server_setup(TestUsage.root)
+        self.tc = server.app.test_client()
+        self.headers = make_headers(
+            TestUsage.user_test, TestUsage.password_test
+        )
+        self.user_dir = os.path.join(
+            TestUsage.root, "user_dirs", TestUsage.user_test
+        )
+        self.addCleanup(setattr, server, "USER_QUOTA", server.USER_QUOTA)
+
+    def tearDown(self):
+        for name in ("dir", "copy.txt"):
+            path = os.path.join(self.user_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(server.blobs.root, ignore_errors=True)
+        shutil.rmtree(server.uploads.root, ignore_errors=True)
+        os.remove(os.path.join(TestUsage.root, "user_data.json"))
+        os.remove(server.USERS_JOURNAL)
+
+    def restart(self):
+        server.User.user_class_init()
+
+    def usage(self, client_path=""):
+        rv = self.tc.get(
+            _API_PREFIX + "usage/" + client_path, headers=self.headers
+        )
+        if rv.status_code != 200:
+            return rv.status_code
+        data = json.loads(rv.data)
+        self.assertEqual(data["quota"], server.USER_QUOTA)
+        return data["bytes"], data["files"]
+
+    def upload(self, client_path, content, method="post"):
+        return getattr(self.tc, method)(
+            _API_PREFIX + "files/" + client_path,
+            data={
+                "file_content": (StringIO(content), "file"),
+                "file_md5": hashlib.md5(content).hexdigest()
+            },
+            headers=self.headers
+        )
+
+    def test_usage(self):
+        # the size of the file saved without it is read at the start
+        self.assertEqual(self.usage(), (11, 1))
+
+        rv = self.upload("dir/sub/file.txt", "0123456789")
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.usage(), (21, 2))
+        self.assertEqual(self.usage("dir"), (10, 1))
+        self.assertEqual(self.usage("dir/sub"), (10, 1))
+
+        rv = self.upload("dir/sub/file.txt", "01234", method="put")
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.usage("dir"), (5, 1))
+
+        rv = self.tc.post(
+            _API_PREFIX + "actions/copy",
+            data={"file_src": "random_file.txt", "file_dest": "copy.txt"},
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.usage(), (27, 3))
+
+        rv = self.tc.post(
+            _API_PREFIX + "actions/move",
+            data={"file_src": "copy.txt", "file_dest": "dir/copy.txt"},
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.usage(), (27, 3))
+        self.assertEqual(self.usage("dir"), (16, 2))
+
+        rv = self.tc.post(
+            _API_PREFIX + "actions/delete",
+            data={"path": "dir/sub/file.txt"},
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.usage(), (22, 2))
+        self.assertEqual(self.usage("dir/sub"), 404)
+        # only directories
+        self.assertEqual(self.usage("random_file.txt"), 404)
+
+        # the same counters after a restart
+        self.restart()
+        self.assertEqual(self.usage(), (22, 2))
+        self.assertEqual(self.usage("dir"), (11, 1))
+
+    def test_quota(self):
+        server.USER_QUOTA = 1000
+        rv = self.upload("dir/file.txt", "0" * 2000)
+        self.assertEqual(
+            rv.status_code, server.HTTP_REQUEST_ENTITY_TOO_LARGE
+        )
+        # nothing written
+        self.assertFalse(os.path.exists(os.path.join(self.user_dir, "dir")))
+        self.assertNotIn("dir", server.User.users[TestUsage.user_test].paths)
+        self.assertEqual(self.usage(), (11, 1))
+
+        rv = self.tc.post(
+            _API_PREFIX + "uploads/",
+            data={
+                "path": "dir/file.txt",
+                "size": 2000,
+                "file_md5": hashlib.md5("0" * 2000).hexdigest()
+            },
+            headers=self.headers
+        )
+        self.assertEqual(
+            rv.status_code, server.HTTP_REQUEST_ENTITY_TOO_LARGE
+        )
+
+        # a file replaced by a smaller one
+        rv = self.upload("random_file.txt", "01234", method="put")
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(self.usage(), (5, 1))
+
+        server.USER_QUOTA = 8
+        rv = self.tc.post(
+            _API_PREFIX + "actions/copy",
+            data={"file_src": "random_file.txt", "file_dest": "copy.txt"},
+            headers=self.headers
+        )
+        self.assertEqual(
+            rv.status_code, server.HTTP_REQUEST_ENTITY_TOO_LARGE
+        )
+
+        server.USER_QUOTA = None
+        rv = self.upload("dir/file.txt", "0" * 2000)
+        self.assertEqual(rv.status_code, 201)
+        with open(os.path.join(self.user_dir, "random_file.txt"), "w") as f:
+            f.write("random text")
+
+
+class TestUsageSQLite(TestUsage):
+    def setUp(self):
+        TestUsage.setUp(self)
+        self.db = os.path.join(TestUsage.root, "user_data.db")
+        store = server.SQLiteStore(self.db)
+        store.import_metadata(
+            server.User.store.users, server.User.store.shares
+        )
+        server.User.user_class_init(store)
+
+    def restart(self):
+        server.User.user_class_init(server.SQLiteStore(self.db))
+
+    def tearDown(self):
+        server.User.store.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db + suffix):
+                os.remove(self.db + suffix)
+        TestUsage.tearDown(self)
+
+
 class TestActionsAPI(unittest.TestCase):
     user_test = "changeman"
     headers = make_headers(user_test, "password")
@@ -467,6 +1467,8 @@ class TestActionsAPI(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(TestActionsAPI.test_folder)
         os.remove(os.path.join(TestActionsAPI.root, "user_data.json"))
+        os.remove(server.USERS_JOURNAL)
+        shutil.rmtree(server.blobs.root, ignore_errors=True)
 
     def test_fail_auth_actions_delete(self):
         #try delete with fake_user
@@ -686,6 +1688,8 @@ class TestShare(unittest.TestCase):
 
     def tearDown(self):
         os.remove(server.USERS_DATA)
+        os.remove(server.USERS_JOURNAL)
+        shutil.rmtree(server.blobs.root, ignore_errors=True)
 
     def test_add_share(self):
         # check if it aborts, when the beneficiary doesn't exist
@@ -728,6 +1732,182 @@ class TestShare(unittest.TestCase):
             server.User.users[self.ben1].paths
         )
 
+    def test_share_twice(self):
+        url = "{}shares/{}/{}".format(_API_PREFIX, "ciao.txt", self.ben1)
+        received = self.tc.post(url, headers=self.owner_headers)
+        self.assertEqual(received.status_code, 200)
+        received = self.tc.post(url, headers=self.owner_headers)
+        self.assertEqual(received.status_code, 400)
+        # the store doesn't grant it twice either
+        server_path = server.User.users[self.owner].paths["ciao.txt"][0]
+        server.User.store.add_beneficiary(server_path, self.owner, self.ben1)
+        self.assertEqual(
+            list(server.User.shared_resources[server_path]),
+            [self.owner, self.ben1]
+        )
+
+        received = self.tc.delete(url, headers=self.owner_headers)
+        self.assertEqual(received.status_code, 200)
+        self.assertNotIn(server_path, server.User.shared_resources)
+        self.assertEqual(server.User.store.shares_of(self.ben1)[1], [])
+        self.assertNotIn(
+            "shares/{}/ciao.txt".format(self.owner),
+            server.User.users[self.ben1].paths
+        )
+
+    def test_share_is_mounted(self):
+        ben_headers = self.ben1_headers
+        rv = self.tc.get(_API_PREFIX + "files/", headers=ben_headers)
+        old_cursor = json.loads(rv.data)["cursor"]
+        received = self.tc.post(
+            "{}shares/{}/{}".format(
+                _API_PREFIX, "shared_directory", self.ben1
+            ),
+            headers=self.owner_headers
+        )
+        self.assertEqual(received.status_code, 200)
+        mount = "shares/{}/shared_directory".format(self.owner)
+        ben = server.User.users[self.ben1]
+        # nothing copied in the beneficiary's paths
+        self.assertEqual(
+            [p for p in ben.paths.own if p.startswith("shares/")], []
+        )
+        self.assertEqual(
+            ben.paths[mount + "/interesting_file.txt"],
+            server.User.users[self.owner].paths[
+                "shared_directory/interesting_file.txt"
+            ]
+        )
+        # the changes before the share can't tell what was mounted
+        rv = self.tc.get(
+            "{}changes?since={}".format(_API_PREFIX, old_cursor),
+            headers=ben_headers
+        )
+        self.assertEqual(rv.status_code, 410)
+
+        rv = self.tc.get(_API_PREFIX + "files/", headers=ben_headers)
+        snapshot = json.loads(rv.data)
+        self.assertIn(
+            mount + "/interesting_file.txt",
+            [f["path"] for files in snapshot["snapshot"].values()
+                for f in files]
+        )
+
+        # a file of the owner is seen in the mount at once
+        with open(TestShare.demo_file2, "r") as f:
+            rv = self.tc.post(
+                _API_PREFIX + "files/shared_directory/new_file.txt",
+                data=get_data(f),
+                headers=self.owner_headers
+            )
+        self.assertEqual(rv.status_code, 201)
+        rv = self.tc.get(
+            "{}changes?since={}".format(_API_PREFIX, snapshot["cursor"]),
+            headers=ben_headers
+        )
+        self.assertEqual(
+            [(c["op"], c["path"]) for c in json.loads(rv.data)["changes"]],
+            [("add", mount + "/new_file.txt")]
+        )
+        rv = self.tc.get(
+            _API_PREFIX + "files/" + mount + "/new_file.txt",
+            headers=ben_headers
+        )
+        self.assertEqual(rv.status_code, 200)
+        with open(TestShare.demo_file2, "r") as f:
+            self.assertEqual(rv.data, f.read())
+        os.remove(os.path.join(
+            server.USERS_DIRECTORIES, self.owner, "shared_directory",
+            "new_file.txt"
+        ))
+
+        # unshared: not mounted anymore
+        received = self.tc.delete(
+            "{}shares/{}/{}".format(
+                _API_PREFIX, "shared_directory", self.ben1
+            ),
+            headers=self.owner_headers
+        )
+        self.assertEqual(received.status_code, 200)
+        self.assertNotIn(mount, ben.paths)
+        self.assertEqual(
+            [p for p in ben.paths if p.startswith("shares/")], []
+        )
+
+    def test_shared_copies_dropped(self):
+        # the metadata of a share saved when it was copied
+        shared = "{}/shared_directory".format(self.owner)
+        store = server.User.store
+        store.add_beneficiary(shared, self.owner, self.ben1)
+        store.set_path(
+            self.ben1, "shares/{}/shared_directory".format(self.owner),
+            [shared, None, 0]
+        )
+        store.commit()
+        self.assertEqual(store.drop_shared_copies(), 1)
+        self.assertEqual(store.drop_shared_copies(), 0)
+        # mounted again
+        self.assertIn(
+            "shares/{}/shared_directory".format(self.owner),
+            server.User.users[self.ben1].paths
+        )
+
+    def test_store_queries(self):
+        store = server.User.store
+        self.assertIsInstance(server.User.shared_resources, collections.Mapping)
+
+        self.tc.post(
+            "{}shares/{}/{}".format(_API_PREFIX, "shared_directory", self.ben1),
+            headers=self.owner_headers
+        )
+        shared = "{}/shared_directory".format(self.owner)
+        owned, granted = store.shares_of(self.ben1)
+        self.assertEqual(owned, [])
+        self.assertEqual(granted, [(self.owner, shared)])
+        self.assertEqual(store.shares_of(self.owner), ([shared], []))
+        prefix = "shared_directory"
+        under = store.paths_under(self.owner, prefix)
+        self.assertTrue(under)
+        self.assertTrue(
+            all(p == prefix or p.startswith(prefix + "/") for p, _ in under)
+        )
+        # a sibling with a common prefix isn't in the range
+        store.set_path(self.owner, prefix + "_other", ["x", None, 0])
+        store.set_path(self.owner, prefix + "/new", ["x", None, 0])
+        under_now = [p for p, _ in store.paths_under(self.owner, prefix)]
+        self.assertNotIn(prefix + "_other", under_now)
+        self.assertIn(prefix + "/new", under_now)
+        store.del_path(self.owner, prefix + "/new")
+        self.assertEqual(
+            sorted(store.paths_under(self.owner, prefix)), sorted(under)
+        )
+        # the share is mounted, not copied
+        self.assertEqual(store.paths_under(self.ben1, "shares"), [])
+
+        self.tc.delete(
+            "{}shares/{}".format(_API_PREFIX, "shared_directory"),
+            headers=self.owner_headers
+        )
+        self.assertEqual(store.shares_of(self.ben1), ([], []))
+        self.assertEqual(store.shares_of(self.owner), ([], []))
+
+    def test_share_of(self):
+        store = server.User.store
+        shared = "{}/shared_directory".format(self.owner)
+        store.add_beneficiary(shared, self.owner, self.ben1)
+        self.assertEqual(
+            store.share_of("{}/interesting_file.txt".format(shared)), shared
+        )
+        self.assertEqual(store.share_of(shared), shared)
+        # a path starting with the same characters is not inside the share
+        self.assertIsNone(store.share_of(shared + "_2/file.txt"))
+        self.assertIsNone(store.share_of("{}/ciao.txt".format(self.owner)))
+
+        # the nearest share wins
+        nested = "{}/sub_directory".format(shared)
+        store.add_beneficiary(nested, self.owner, self.ben2)
+        self.assertEqual(store.share_of(nested + "/file.txt"), nested)
+
     def test_can_write(self):
         # share a file with an user (create a share)
         # TODO: load this from json when the shares will be saved on file
@@ -1033,6 +2213,35 @@ class TestShare(unittest.TestCase):
         self.assertTrue(json.loads(received.get_data())["my_shares"])
 
 
+class TestShareSQLite(TestShare):
+    """ The tests of TestShare, with the metadata in a SQLite database """
+
+    @classmethod
+    def setUpClass(cls):
+        # the tests use the demo files of TestShare
+        TestShare.setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        TestShare.tearDownClass()
+
+    def setUp(self):
+        TestShare.setUp(self)
+        self.db = os.path.join(TestShare.root, "user_data.db")
+        store = server.SQLiteStore(self.db)
+        store.import_metadata(
+            server.User.store.users, server.User.store.shares
+        )
+        server.User.user_class_init(store)
+
+    def tearDown(self):
+        server.User.store.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db + suffix):
+                os.remove(self.db + suffix)
+        TestShare.tearDown(self)
+
+
 
 class TestServerInternalErrors(unittest.TestCase):
     root = os.path.join(
@@ -1040,6 +2249,7 @@ class TestServerInternalErrors(unittest.TestCase):
         "demo_test/internal_errors"
     )
     user_data = os.path.join(root, "user_data.json")
+    user_journal = os.path.join(root, "user_data.journal")
     user_dirs = os.path.join(root, "user_dirs")
 
     def setUp(self):
@@ -1061,6 +2271,10 @@ class TestServerInternalErrors(unittest.TestCase):
             os.remove(cls.user_data)
         except OSError:
             pass
+        try:
+            os.remove(cls.user_journal)
+        except OSError:
+            pass
 
     def test_corrupted_users_data_json(self):
         """
@@ -1195,6 +2409,8 @@ class EmailTest(unittest.TestCase):
     def setUp(self):
         self.mail_init_bak = server.mail_config_init
         server.mail_config_init = mock_mail_init
+        server.mail_queue = server.MailQueue(mock_mail_init(), server.app)
+        server.mail_queue.start()
 
         EmailTest.pending_users_bak = server.PENDING_USERS
         server.PENDING_USERS = TEST_PENDING_USERS
@@ -1211,6 +2427,8 @@ class EmailTest(unittest.TestCase):
 
         server.mail_config_init = self.mail_init_bak
         server.PENDING_USERS = EmailTest.pending_users_bak
+        server.mail_queue.stop()
+        server.mail_queue = None
 
     def test_mail_correct_data(self):
         with self.mail.record_messages() as outbox:
@@ -1219,6 +2437,8 @@ class EmailTest(unittest.TestCase):
                 EmailTest.obj,
                 EmailTest.content
             )
+            # sent in background
+            server.mail_queue.join()
             self.assertEqual(len(outbox), 1)
             self.assertEqual(outbox[0].subject, EmailTest.obj)
             self.assertEqual(outbox[0].body, EmailTest.content)
@@ -1229,10 +2449,25 @@ class EmailTest(unittest.TestCase):
         }
         with self.mail.record_messages() as outbox:
             self.tc.post(self.url, data=data)
+            server.mail_queue.join()
             with open(server.PENDING_USERS, "r") as pending_file:
                 code = json.load(pending_file)[EmailTest.user]["code"]
                 self.assertEqual(outbox[0].body, code)
 
+    def test_create_user_mail_queue_full(self):
+        server.mail_queue.stop()
+        # not started: nothing leaves the queue
+        server.mail_queue = server.MailQueue(
+            mock_mail_init(), server.app, size=1
+        )
+        server.send_mail("other@rawbox.com", "obj", "content")
+        server.mail_queue.stop = lambda: None
+
+        rv = self.tc.post(self.url, data={"psw": EmailTest.psw})
+        self.assertEqual(rv.status_code, 503)
+        # not a pending user: it can register again
+        self.assertFalse(os.path.exists(server.PENDING_USERS))
+
 
 class UserActions(unittest.TestCase):
 
@@ -1295,18 +2530,26 @@ class UserActions(unittest.TestCase):
 
         server.PENDING_USERS = TEST_PENDING_USERS
 
-        open(TEST_USER_DATA, "w").close()
         server.USERS_DATA = TEST_USER_DATA
+        server.USERS_JOURNAL = TEST_USER_JOURNAL
+        server.User.user_class_init()
+        open(TEST_USER_DATA, "w").close()
 
         self.url = "".join((server._API_PREFIX, "Users/", UserActions.user))
 
     def tearDown(self):
         server.mail_config_init = self.mail_init_bak
+        if server.mail_queue is not None:
+            # started by the first mail, with the mock settings
+            server.mail_queue.stop()
+            server.mail_queue = None
         server.User.users = {}
         if os.path.exists(TEST_PENDING_USERS):
             os.remove(TEST_PENDING_USERS)
         if os.path.exists(TEST_USER_DATA):
             os.remove(TEST_USER_DATA)
+        if os.path.exists(TEST_USER_JOURNAL):
+            os.remove(TEST_USER_JOURNAL)
         if os.path.exists(TEST_DIRECTORY):
             try:
                 os.mkdir(TEST_DIRECTORY)
@@ -1327,6 +2570,8 @@ class UserActions(unittest.TestCase):
 
         response = self.tc.post(self.url, data=data, headers=None)
         self.assertEqual(response.status_code, server.HTTP_NOT_ACCEPTABLE)
+        # found in the blocklist compiled from PASSWORD_NOT_ACCEPTED_DATA
+        self.assertIn("too common", response.data)
 
         data = {
             "psw": "provasemplice"
@@ -1450,6 +2695,273 @@ class UserActions(unittest.TestCase):
         server.app.testing = True
 
 
+
+class TestConcurrency(unittest.TestCase):
+    """ Requests of more users in parallel threads """
+    users = ["user_0", "user_1", "user_2", "user_3"]
+    files_per_thread = 15
+    threads_per_user = 3
+
+    def setUp(self):
+        server.app.config.update(TESTING=True)
+        server.app.testing = True
+        self.root = tempfile.mkdtemp()
+        server_setup(self.root)
+        self.headers = {}
+        for username in TestConcurrency.users:
+            server.User(username, "password")
+            token, ttl = server.tokens.issue(username)
+            self.headers[username] = make_headers(username, token)
+        # compactions of the journal while the users change things
+        self.compaction_records = metadata.JOURNAL_COMPACTION_RECORDS
+        metadata.JOURNAL_COMPACTION_RECORDS = 50
+
+        tc = server.app.test_client()
+        self.upload(tc, "user_0", "shared/first.txt")
+        tc.post(
+            "{}shares/shared/user_1".format(_API_PREFIX),
+            headers=self.headers["user_0"]
+        )
+
+    def tearDown(self):
+        metadata.JOURNAL_COMPACTION_RECORDS = self.compaction_records
+        shutil.rmtree(self.root)
+
+    def upload(self, tc, username, path):
+        content = "{} of {}".format(path, username)
+        rv = tc.post(
+            "{}files/{}".format(_API_PREFIX, path),
+            data={
+                "file_content": (StringIO(content), "file"),
+                "file_md5": hashlib.md5(content).hexdigest()
+            },
+            headers=self.headers[username]
+        )
+        self.assertEqual(rv.status_code, 201)
+
+    def test_no_lost_updates(self):
+        errors = []
+        # switch thread as often as possible
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        self.addCleanup(sys.setcheckinterval, check_interval)
+
+        def uploads(username, directory, thread_number):
+            tc = server.app.test_client()
+            try:
+                for n in range(TestConcurrency.files_per_thread):
+                    self.upload(tc, username, "{}/{}_{}.txt".format(
+                        directory, thread_number, n
+                    ))
+            except Exception as e:
+                errors.append(e)
+
+        def share():
+            # shared and unshared while the owner adds files in it
+            tc = server.app.test_client()
+            url = "{}shares/shared/user_2".format(_API_PREFIX)
+            for _ in range(TestConcurrency.files_per_thread):
+                for method in (tc.post, tc.delete):
+                    rv = method(url, headers=self.headers["user_0"])
+                    if rv.status_code != 200:
+                        errors.append(rv.status_code)
+
+        threads = [threading.Thread(target=share)]
+        for username in TestConcurrency.users:
+            directory = "shared" if username == "user_0" else "mine"
+            for t in range(TestConcurrency.threads_per_user):
+                threads.append(threading.Thread(
+                    target=uploads, args=(username, directory, t)
+                ))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        uploaded = set(
+            "{}_{}.txt".format(t, n)
+            for t in range(TestConcurrency.threads_per_user)
+            for n in range(TestConcurrency.files_per_thread)
+        )
+        for username in TestConcurrency.users:
+            u = server.User.users[username]
+            directory = "shared" if username == "user_0" else "mine"
+            for name in uploaded:
+                self.assertIn("{}/{}".format(directory, name), u.paths)
+        # the beneficiary has every file of the shared directory, the
+        # user not sharing it anymore has nothing
+        ben_paths = server.User.users["user_1"].paths
+        for name in uploaded | set(["first.txt"]):
+            self.assertIn("shares/user_0/shared/{}".format(name), ben_paths)
+        self.assertEqual(
+            [p for p in server.User.users["user_2"].paths
+             if p.startswith("shares/")],
+            []
+        )
+
+        # the journal and the checkpoints have every change too
+        store = server.User.store
+        while store.journal.compacting:
+            time.sleep(0.01)
+        users = copy.deepcopy(store.users)
+        shares = copy.deepcopy(store.shares)
+        store.close()
+        server.User.store = None
+        reloaded = server.DictStore(server.USERS_DATA, server.USERS_JOURNAL)
+        self.assertEqual(reloaded.load(), users)
+        self.assertEqual(reloaded.shares, shares)
+        reloaded.close()
+
+    def test_body_received_before_locks(self):
+        received = []
+        real_locked = server.User.locked
+
+        def locked(username, *others):
+            received.append("files" in server.request.__dict__)
+            return real_locked(username, *others)
+        server.User.locked = staticmethod(locked)
+        self.addCleanup(
+            setattr, server.User, "locked", staticmethod(real_locked)
+        )
+        tc = server.app.test_client()
+        self.upload(tc, "user_1", "mine/received.txt")
+        rv = tc.put(
+            "{}files/mine/received.txt".format(_API_PREFIX),
+            data={
+                "file_content": (StringIO("changed"), "file"),
+                "file_md5": hashlib.md5("changed").hexdigest()
+            },
+            headers=self.headers["user_1"]
+        )
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(received, [True, True])
+
+        # refused before the content is received
+        rv = tc.post(
+            "{}files/mine/received.txt".format(_API_PREFIX),
+            data={
+                "file_content": (StringIO("content"), "file"),
+                "file_md5": hashlib.md5("content").hexdigest()
+            },
+            headers=self.headers["user_1"]
+        )
+        self.assertEqual(rv.status_code, 409)
+        self.assertEqual(received, [True, True])
+
+    def test_readers_not_blocked(self):
+        url = "{}files/".format(_API_PREFIX)
+        changing = threading.Event()
+        done = threading.Event()
+        u = server.User.users["user_1"]
+        # read once: a namespace is published
+        u.current_namespace()
+
+        def writer():
+            # a change half done, under the lock of the user
+            with server.User.locked("user_1"):
+                u._set_path("mine/half.txt", ["path", "md5", 1])
+                changing.set()
+                done.wait(10)
+
+        def read(results):
+            rv = server.app.test_client().get(
+                url, headers=self.headers["user_1"]
+            )
+            results.append(rv)
+
+        write_thread = threading.Thread(target=writer)
+        write_thread.start()
+        changing.wait(10)
+        results = []
+        read_thread = threading.Thread(target=read, args=(results,))
+        read_thread.start()
+        read_thread.join(5)
+        self.assertFalse(read_thread.is_alive())
+        done.set()
+        write_thread.join()
+
+        # the last namespace published, without the change being made
+        snapshot = json.loads(results[0].data)["snapshot"]
+        self.assertNotIn("md5", snapshot)
+        # published by the next reader
+        self.assertTrue(u.unpublished)
+        self.assertIn(
+            ("mine/half.txt", "md5", 1), u.current_namespace().files
+        )
+        self.assertFalse(u.unpublished)
+        read(results)
+        self.assertIn("md5", json.loads(results[1].data)["snapshot"])
+
+    def test_publish_on_read(self):
+        tc = server.app.test_client()
+        for ben in ["user_2", "user_3"]:
+            tc.post(
+                "{}shares/shared/{}".format(_API_PREFIX, ben),
+                headers=self.headers["user_0"]
+            )
+        sharing = ["user_0", "user_1", "user_2", "user_3"]
+        published = []
+        real_publish = server.User.publish
+
+        def publish(user):
+            published.append(user.username)
+            real_publish(user)
+        server.User.publish = publish
+        self.addCleanup(setattr, server.User, "publish", real_publish)
+
+        # the writes of the owner never rebuild the namespaces, however
+        # many files they hold
+        for n in range(20):
+            self.upload(tc, "user_0", "shared/{}.txt".format(n))
+        self.assertEqual(published, [])
+        for username in sharing:
+            self.assertTrue(server.User.users[username].unpublished)
+
+        # published once, by the first reader after the changes
+        url = "{}files/".format(_API_PREFIX)
+        for username in sharing * 2:
+            rv = tc.get(url, headers=self.headers[username])
+            self.assertEqual(rv.status_code, 200)
+        self.assertEqual(sorted(published), sharing)
+
+    def test_publish_without_lock(self):
+        tc = server.app.test_client()
+        u = server.User.users["user_0"]
+        u.current_namespace()
+        self.upload(tc, "user_0", "mine/first.txt")
+        building = threading.Event()
+        uploaded = threading.Event()
+        waited = []
+        real_build = server.User._build_namespace
+
+        def build(user):
+            # a writer changes the user meanwhile
+            building.set()
+            waited.append(uploaded.wait(5))
+            return real_build(user)
+        server.User._build_namespace = build
+        self.addCleanup(
+            setattr, server.User, "_build_namespace", real_build
+        )
+
+        def read():
+            u.current_namespace()
+        reader = threading.Thread(target=read)
+        reader.start()
+        building.wait(10)
+        # the upload isn't blocked by the reader building the namespace
+        self.upload(tc, "user_0", "mine/second.txt")
+        uploaded.set()
+        reader.join()
+        self.assertEqual(waited, [True])
+        # built before the end of the upload: dropped
+        self.assertTrue(u.unpublished)
+        server.User._build_namespace = real_build
+        paths = [p for p, md5, timestamp in u.current_namespace().files]
+        self.assertIn("mine/second.txt", paths)
+        self.assertFalse(u.unpublished)
+
 if __name__ == "__main__":
     # make tests!
     unittest.main()
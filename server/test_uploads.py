@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import tempfile
+import unittest
+import hashlib
+import shutil
+import time
+import os
+
+from StringIO import StringIO
+
+from uploads import UploadSessions
+
+
+class TestUploadSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uploads = UploadSessions(self.directory, chunk_size=4, ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def put(self, session, index, content):
+        self.uploads.put_chunk(
+            session, index, StringIO(content),
+            hashlib.md5(content).hexdigest()
+        )
+
+    def test_chunks(self):
+        session = self.uploads.create("user", "file.txt", 10, "md5")
+        self.assertEqual(session["chunks"], 3)
+        self.assertEqual(
+            [self.uploads.chunk_length(session, i) for i in range(3)],
+            [4, 4, 2]
+        )
+        # the last chunk is shorter
+        with self.assertRaises(ValueError):
+            self.put(session, 2, "abcd")
+        self.put(session, 2, "ij")
+        self.put(session, 0, "abcd")
+
+        session = self.uploads.get("user", session["id"])
+        self.assertEqual(session["received"], [0, 2])
+        with self.assertRaises(ValueError):
+            self.uploads.assemble(session)
+
+        self.put(session, 1, "efgh")
+        session = self.uploads.get("user", session["id"])
+        path, sha256, md5 = self.uploads.assemble(session)
+        with open(path) as f:
+            self.assertEqual(f.read(), "abcdefghij")
+        self.assertEqual(sha256, hashlib.sha256("abcdefghij").hexdigest())
+        self.assertEqual(md5, hashlib.md5("abcdefghij").hexdigest())
+
+        # an empty file is a single empty chunk
+        session = self.uploads.create("user", "empty.txt", 0, "md5")
+        self.assertEqual(session["chunks"], 1)
+        self.put(session, 0, "")
+
+    def test_same_chunk_at_once(self):
+        session = self.uploads.create("user", "file.txt", 4, "md5")
+        directory = os.path.join(self.directory, session["id"])
+        written = []
+        real_rename = os.rename
+
+        def rename(src, dst):
+            # the other request writes its temporary file meanwhile
+            if not written:
+                written.append(src)
+                self.put(session, 0, "abcd")
+            written.append(src)
+            real_rename(src, dst)
+        os.rename = rename
+        try:
+            self.put(session, 0, "abcd")
+        finally:
+            os.rename = real_rename
+        self.assertEqual(len(set(written)), 2)
+        with open(os.path.join(directory, "0")) as f:
+            self.assertEqual(f.read(), "abcd")
+        # no temporary file left
+        self.assertEqual(
+            sorted(os.listdir(directory)), ["0", "session.json"]
+        )
+
+    def test_get(self):
+        session = self.uploads.create("user", "file.txt", 10, "md5")
+        self.assertIsNone(self.uploads.get("other_user", session["id"]))
+        self.assertIsNone(self.uploads.get("user", "../" + session["id"]))
+        self.assertIsNone(self.uploads.get("user", "not_a_session"))
+
+    def test_purge(self):
+        old = self.uploads.create("user", "old.txt", 10, "md5")
+        alive = self.uploads.create("user", "alive.txt", 10, "md5")
+        long_ago = time.time() - 120
+        for session in (old, alive):
+            os.utime(
+                os.path.join(self.directory, session["id"], "session.json"),
+                (long_ago, long_ago)
+            )
+        # a chunk received keeps the session alive
+        self.put(alive, 0, "abcd")
+
+        self.uploads.purge()
+        self.assertIsNone(self.uploads.get("user", old["id"]))
+        self.assertIsNotNone(self.uploads.get("user", alive["id"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import tempfile
+import hashlib
+import shutil
+import errno
+import json
+import time
+import os
+
+"""
+Upload sessions: a file sent in numbered chunks, which can be sent again
+or resumed until the session is committed.
+
+Every session is a directory of the uploads root, so it survives a restart
+of the server:
+    <root>/<session id>/session.json   {"id", "user", "path", "size",
+                                        "md5", "chunk_size", "chunks"}
+    <root>/<session id>/<n>             the n-th chunk, once received
+A session is expired when no chunk is received for UPLOAD_SESSION_TTL.
+"""
+
+# size of every chunk, but the last one
+UPLOAD_CHUNK_SIZE = 4 * 2 ** 20
+# seconds after which an upload session not committed is removed
+UPLOAD_SESSION_TTL = 7 * 24 * 60 * 60
+
+SESSION_FILE = "session.json"
+
+
+class UploadSessions(object):
+    def __init__(self, root, chunk_size=UPLOAD_CHUNK_SIZE,
+                 ttl=UPLOAD_SESSION_TTL):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.ttl = ttl
+
+    def _session_dir(self, session_id):
+        return os.path.join(self.root, session_id)
+
+    def _session_file(self, session_id):
+        return os.path.join(self._session_dir(session_id), SESSION_FILE)
+
+    def _chunk_path(self, session, index):
+        return os.path.join(self._session_dir(session["id"]), str(index))
+
+    def create(self, username, client_path, size, md5):
+        """ Start the upload of a file. Return the new session. """
+        self.purge()
+        session = {
+            "id": os.urandom(16).encode("hex"),
+            "user": username,
+            "path": client_path,
+            "size": size,
+            "md5": md5,
+            "chunk_size": self.chunk_size,
+            # an empty file is an empty chunk
+            "chunks": max(1, -(-size // self.chunk_size))
+        }
+        os.makedirs(self._session_dir(session["id"]))
+        with open(self._session_file(session["id"]), "w") as f:
+            json.dump(session, f)
+        return session
+
+    def get(self, username, session_id):
+        """
+        Return the session of the user, with the list of the chunks
+        received. Return None if the user has not such a session.
+        """
+        if not session_id.isalnum():
+            return None
+        try:
+            with open(self._session_file(session_id)) as f:
+                session = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if session["user"] != username:
+            return None
+        session["received"] = [
+            index for index in range(session["chunks"])
+            if os.path.exists(self._chunk_path(session, index))
+        ]
+        return session
+
+    def chunk_length(self, session, index):
+        if index == session["chunks"] - 1:
+            return session["size"] - index * session["chunk_size"]
+        return session["chunk_size"]
+
+    def put_chunk(self, session, index, file_object, chunk_md5):
+        """
+        Save a chunk. Raise ValueError if the index, the length or the md5
+        of the chunk are wrong.
+        """
+        if not 0 <= index < session["chunks"]:
+            raise ValueError("chunk {} out of range".format(index))
+        content = file_object.read(session["chunk_size"] + 1)
+        if len(content) != self.chunk_length(session, index):
+            raise ValueError("wrong length of chunk {}".format(index))
+        if hashlib.md5(content).hexdigest() != chunk_md5:
+            raise ValueError("wrong md5 of chunk {}".format(index))
+        # a chunk is present only when it's complete. The same chunk can be
+        # sent again while the first request is still written (a retry):
+        # every request writes its own temporary file
+        chunk_path = self._chunk_path(session, index)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix="{}.".format(index), suffix=".tmp",
+            dir=self._session_dir(session["id"])
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.rename(tmp_path, chunk_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        # the session is still alive
+        os.utime(self._session_file(session["id"]), None)
+
+    def assemble(self, session):
+        """
+        Join the chunks in a single file. Return its path, its sha256 and
+        its md5. Raise ValueError if some chunk is missing.
+        """
+        missing = set(range(session["chunks"])) - set(session["received"])
+        if missing:
+            raise ValueError(sorted(missing))
+        path = os.path.join(self._session_dir(session["id"]), "assembled")
+        sha256 = hashlib.sha256()
+        md5 = hashlib.md5()
+        with open(path, "wb") as f:
+            for index in range(session["chunks"]):
+                with open(self._chunk_path(session, index), "rb") as chunk:
+                    content = chunk.read()
+                sha256.update(content)
+                md5.update(content)
+                f.write(content)
+        return path, sha256.hexdigest(), md5.hexdigest()
+
+    def remove(self, session):
+        shutil.rmtree(self._session_dir(session["id"]), ignore_errors=True)
+
+    def purge(self):
+        """ Remove the expired sessions """
+        try:
+            session_ids = os.listdir(self.root)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        now = time.time()
+        for session_id in session_ids:
+            try:
+                expired = os.path.getmtime(
+                    self._session_file(session_id)
+                ) + self.ttl < now
+            except OSError:
+                # a session being created
+                continue
+            if expired:
+                shutil.rmtree(
+                    self._session_dir(session_id), ignore_errors=True
+                )
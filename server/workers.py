@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+from werkzeug.serving import make_server
+import multiprocessing
+import argparse
+import signal
+import os
+
+import server
+
+"""
+Production entry point: the server in a pool of pre-forked worker
+processes, sharing the listening socket and the state kept in the SQLite
+store (see server.use_shared_state). Every worker serves its requests in
+threads.
+    python workers.py --workers 4 --port 5000
+A worker which dies is replaced.
+"""
+
+# default number of worker processes: one for each core
+WORKERS = multiprocessing.cpu_count()
+
+
+def _worker(httpd):
+    """ Run in the forked process: open its own store and serve """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    server.use_shared_state(server.SQLiteStore(server.USERS_DB))
+    # a thread of the parent doesn't survive the fork
+    server.start_mail_queue()
+    httpd.serve_forever()
+
+
+def _spawn(httpd):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            _worker(httpd)
+            status = 0
+        finally:
+            # never go back to the loop of the parent
+            os._exit(status)
+    return pid
+
+
+def serve(host="0.0.0.0", port=5000, workers=WORKERS):
+    # the database is created (and the old data imported) once, before
+    # forking: a SQLite connection must not cross a fork
+    server.open_store().close()
+    # wrong mail settings stop the server now, not every worker
+    server.mail_config_init()
+    # compiled once, mapped by every worker
+    server.load_password_blocklist()
+    httpd = make_server(host, port, server.app, threaded=True)
+    children = set(_spawn(httpd) for _ in range(workers))
+    server.blobs.start_collector(server.BLOBS_GC_INTERVAL)
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError:
+            # interrupted by a signal
+            continue
+        children.discard(pid)
+        if not stopping:
+            children.add(_spawn(httpd))
+    httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="RawBox server workers",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main()